@@ -3,12 +3,14 @@ Cache Manager: This is the generic place to store all data.
 
 There will be locking once you are into a bucket, so we have locks, but can also work faster than globally locking all changes.
 
-This can be backed with DBs or other persistent storage (file system), or run just in memory.  The Bundle specifies how to store the cache values.
+Reads are lock-free:  Values are never changed in place, writers publish a new value with a single dict assignment.  Queues are appended in
+place, so readers get their snapshot list instead.
+
+This is backed by a storage backend per Bundle (see cache_storage):  JSON files or SQLite.  The Bundle specifies how to store the cache values.
 """
 
 import threading
-import statistics
-import re
+import concurrent.futures
 import time
 import pprint
 
@@ -16,15 +18,35 @@ from logic.log import LOG
 
 from logic import thread_manager
 from logic import utility
-from logic import local_cache
+from logic import key_index
+from logic import ring_buffer
+from logic import summary_stats
+from logic import summary_column
+from logic import quantile_sketch
+from logic import memory_budget
+from logic import cache_snapshot
+from logic import cache_storage
+from logic import codec
+from logic import cache_stats
+
+from logic.threaded import cache_flusher
 
 
 # Default max queue size
 DEFAULT_MAX_QUEUE_SIZE = 1000
 
+# Threads used to read the cache files at startup
+LOAD_WORKERS = 8
+
+# Default time between writing Cache Snapshots, for Bundles with a `path.snapshot`
+DEFAULT_SNAPSHOT_INTERVAL = '5m'
+
 # Wait before we reload a file to avoid "tearing" if it is being saved as we are reloading it
 STATIC_MTIME_DELAY = 1
 
+# Returned by dict.get() for keys that arent in memory, so a key whose stored value is None isnt mistaken for a missing one
+MISSING = object()
+
 
 class CacheManager():
   """This is the primary database interface.  Everything is treated as a big bucket system."""
@@ -42,48 +64,83 @@ class CacheManager():
     # Every bundles cache is a Silo, and we need locks for all of them
     self.lock_bundles_each = {}
 
+    # Every bundles cache also has a sorted Key Index, so globs only walk the matching range of keys.  Protected by the same locks as the silo
+    self.key_indexes = {}
+
+    # Storage backend for every Bundle, from its `path.storage`
+    self.storages = {}
+
+    # Cold keys, which are in storage and the Key Index, but not in memory (lazy loaded or evicted):  {bundle_name: set(cache_key)}.  Protected by the Bundle locks
+    self.cold_keys = {}
+
+    # Bundles whose cold keys are not tracked in memory at all, because their storage is queryable.  Misses and globs ask the storage instead
+    self.cold_queries = set()
+
+    # Bundles with a `path.memory_budget`, evict their least recently used `unique_key` entries to disk:  {bundle_name: memory_budget.MemoryBudget}
+    self.memory_budgets = {}
+
+    # Last time we wrote a Cache Snapshot for each Bundle.  Bundles are only in here once their initial cache load is done, so we never snapshot a partial cache
+    self.snapshot_times = {}
+
+    # Hit, miss and write counts per Bundle and key prefix, and sizes on request, for the `/opsland/cache` pages
+    self.stats = cache_stats.CacheStats()
+
     # Keep a list of our static imports, so we can check them for reloads
     self.static_imports = {}
 
+    # Online statistics for every summary field, keyed on tuple: (bundle_name, summary_key).  Protected by the Bundle locks
+    self.summary_stats = {}
+
+    # Columns for every `group_by` summary field, keyed on tuple: (bundle_name, summary_key).  Protected by the Bundle locks
+    self.summary_columns = {}
+
+    # Quantile sketches for summaries with `quantiles`, keyed on tuple: (bundle_name, summary_key), with the group suffixed for `group_by`.  Protected by the Bundle locks
+    self.summary_sketches = {}
+
+    # Groups we have published keys for, per `group_by` summary field, keyed on tuple: (bundle_name, summary_key).  Protected by the Bundle locks
+    self.summary_groups = {}
+
 
   def LoadInitialBundleCache(self, bundle_name, bundles):
-    """As we load bundles for the first time, load any cached data they had as well"""
+    """As we load bundles for the first time, load any cached data they had as well, from their Snapshot first if they have one"""
     if bundle_name not in bundles:
       LOG.error(f'Missing Bundle, cant load initial bundle cache: {bundle_name}')
       return
     
     bundle_data = bundles[bundle_name]
+    is_lazy = bundle_data['path'].get('cache_load', 'eager') == 'lazy'
 
-    # Load the Cache files
-    cache_glob = bundle_data['path']['cache'].replace('{key}', '*')
-    paths = utility.Glob(cache_glob)
-    for path in paths:
-      path_key = utility.GlobReverse(cache_glob, path)
-      # LOG.info(f'Loaded Cache Path Key: {cache_glob} -> {path} -> {path_key}')
+    # On a reload, memory can be newer than storage, so write out what is dirty first.  Keys already in memory are skipped when loading below
+    if thread_manager.CACHE_FLUSHER:
+      thread_manager.CACHE_FLUSHER.Flush(force=True)
 
-      cache_value = local_cache.GetData(path)
+    # Set up our Memory Budget before loading anything, so the loaded entries are tracked
+    self.UpdateMemoryBudget(bundle_name, bundle_data)
+
+    storage = self.UpdateStorage(bundle_name, bundle_data)
+
+    # With a queryable storage, keys that arent in memory dont need to be tracked, the storage can answer for them
+    if storage.is_queryable and (is_lazy or bundle_name in self.memory_budgets):
+      self.cold_queries.add(bundle_name)
+    else:
+      self.cold_queries.discard(bundle_name)
+
+    # Open our Cache Snapshot, if we have one.  It is memory mapped, and we only decode the values we load from it
+    snapshot = cache_snapshot.Open(bundle_data['path']['snapshot']) if bundle_data['path'].get('snapshot', None) else None
+
+    # The Key Index sorts the loaded keys in on the next glob, so loading isnt a copy of the sorted key list per key
+    self._LoadBundleKeys(bundle_name, storage, snapshot, is_lazy)
+
+    if snapshot:
+      snapshot.Close()
+
+    # Our cache is complete, so it can be snapshotted now.  Wait a full interval, we just loaded it
+    self.snapshot_times.setdefault(bundle_name, time.time())
+
+    # Loading changes keys without Set(), so the worker processes get the whole silo again
+    if thread_manager.CACHE_SERVER:
+      thread_manager.CACHE_SERVER.SyncBundle(bundle_name)
 
-      try:
-        self.Set(bundle_name, path_key, cache_value, set_all_data=True, save=True)
-      except Exception as e:
-        # Ignore errors, because this means we dont have the configuration to match a glob, which is not a problem
-        LOG.info(f'Cache file found, but no config exists to set it to: {path_key}')
-
-    # Load the Summary files
-    cache_glob = bundle_data['path']['summary'].replace('{key}', '*')
-    paths = utility.Glob(cache_glob)
-    for path in paths:
-      path_key = utility.GlobReverse(cache_glob, path)
-      # LOG.info(f'Summary Path Key: {cache_glob} -> {path} -> {path_key}')
-
-      summary_fields = local_cache.GetData(path)
-
-      # If we got the cache value, and we have this bundle to lock (since we are doing things directly, check)
-      if summary_fields and bundle_name in self.lock_bundles_each:
-        with self.lock_bundles_each[bundle_name]:
-          # Set all the `summary_fields` into this bundle cache data
-          self.bundles[bundle_name].update(summary_fields)
-    
     # Load the static content
     if 'static' in bundle_data:
       for item_key, item_path in bundle_data['static'].items():
@@ -94,6 +151,191 @@ class CacheManager():
     self.LoadStaticImports()
 
 
+  def _LoadBundleKeys(self, bundle_name, storage, snapshot, is_lazy):
+    """Load the Summaries, then the Cache and Queues, from the Snapshot and storage on the warm-up thread pool.  Keys already in memory are newer
+    than storage and the Snapshot, so they are kept"""
+    bundle = self._GetBundleSilo(bundle_name)
+    with self.lock_bundles_each[bundle_name]:
+      loaded_keys = set(bundle)
+    # Load the Summaries first.  Queues we load below recompute their window summaries over these, but long horizon data like quantile sketches is restored from here
+    summary_keys = storage.GetKeys(cache_storage.KIND_SUMMARY)
+
+    # Summaries are always in memory, so the Snapshot has all of them, and we only need the ones written since
+    if snapshot:
+      self._LoadSnapshotSummaries(bundle_name, snapshot, loaded_keys)
+      summary_keys = [summary_key for summary_key in summary_keys if IsNewerThanSnapshot(storage, cache_storage.KIND_SUMMARY, summary_key, snapshot)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+      list(executor.map(lambda summary_key: self._LoadSummaryKey(bundle_name, storage, summary_key, loaded_keys), summary_keys))
+
+    # Load the Cache.  Lazy keys in a queryable storage are left there, so we dont even list them
+    cache_keys = storage.GetKeys(cache_storage.KIND_CACHE) if bundle_name not in self.cold_queries or not is_lazy else []
+
+    # Queues are replayed after the regular values.  If a key has a queue, its older full-queue value is skipped
+    queue_keys = set(storage.GetKeys(cache_storage.KIND_QUEUE))
+    replay_keys = [cache_key for cache_key in queue_keys if cache_key not in loaded_keys]
+    cache_keys = [cache_key for cache_key in cache_keys if cache_key not in loaded_keys]
+
+    # Keys in the Snapshot are only read if they changed after it was written.  Keys that werent in memory (lazy, evicted) are only in storage
+    if snapshot:
+      cache_keys = [cache_key for cache_key in cache_keys if cache_key not in snapshot or IsNewerThanSnapshot(storage, cache_storage.KIND_CACHE, cache_key, snapshot)]
+      replay_keys = [cache_key for cache_key in replay_keys if cache_key not in snapshot or IsNewerThanSnapshot(storage, cache_storage.KIND_QUEUE, cache_key, snapshot)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=LOAD_WORKERS) as executor:
+      if snapshot:
+        snapshot_keys = [cache_key for cache_key in snapshot.GetKeys(cache_snapshot.KIND_CACHE) if cache_key not in loaded_keys]
+        list(executor.map(lambda cache_key: self._LoadSnapshotKey(bundle_name, snapshot, cache_key, queue_keys), snapshot_keys))
+
+      list(executor.map(lambda cache_key: self._LoadCacheKey(bundle_name, storage, cache_key, queue_keys, is_lazy), cache_keys))
+
+      # Replay the tail of each queue.  The queue is already the persisted data, so we dont save it again
+      list(executor.map(lambda cache_key: self._LoadQueueKey(bundle_name, storage, cache_key), replay_keys))
+
+
+  def _LoadSummaryKey(self, bundle_name, storage, summary_key, loaded_keys):
+    """Load a Summary from storage into this Bundle cache, except fields in `loaded_keys`.  Runs on the warm-up thread pool."""
+    summary_fields = storage.Get(cache_storage.KIND_SUMMARY, summary_key)
+    if summary_fields:
+      summary_fields = {key: value for (key, value) in summary_fields.items() if key not in loaded_keys}
+
+    # If we got the cache value, set all the `summary_fields` into this bundle cache data
+    if summary_fields:
+      bundle = self._GetBundleSilo(bundle_name)
+      with self.lock_bundles_each[bundle_name]:
+        bundle.update(summary_fields)
+        for summary_field_key in summary_fields:
+          self.key_indexes[bundle_name].Add(summary_field_key)
+          self.stats.CountChange(bundle_name, summary_field_key)
+
+
+  def _LoadSnapshotSummaries(self, bundle_name, snapshot, loaded_keys):
+    """Restore the Summary values from this Snapshot into the Bundle cache, except those in `loaded_keys`"""
+    summary_fields = {summary_key: snapshot.GetValue(summary_key) for summary_key in snapshot.GetKeys(cache_snapshot.KIND_SUMMARY) if summary_key not in loaded_keys}
+
+    bundle = self._GetBundleSilo(bundle_name)
+    with self.lock_bundles_each[bundle_name]:
+      bundle.update(summary_fields)
+      for summary_key in summary_fields:
+        self.key_indexes[bundle_name].Add(summary_key)
+        self.stats.CountChange(bundle_name, summary_key)
+
+
+  def _LoadSnapshotKey(self, bundle_name, snapshot, cache_key, queue_keys):
+    """Load a cache value from the Snapshot into this Bundle cache.  Runs on the warm-up thread pool."""
+    (_, resolution) = self.ResolveKey(bundle_name, cache_key)
+
+    # The Bundle spec changed since the Snapshot, and doesnt have this key anymore
+    if not resolution:
+      LOG.info(f'Cache snapshot has a key, but no config exists to set it to: {cache_key}')
+      return
+
+    # A queue without its queue records is saved once to create them, otherwise its next append would start a queue without its older records
+    save = resolution.store == 'queue' and cache_key not in queue_keys
+
+    try:
+      self.Set(bundle_name, cache_key, snapshot.GetValue(cache_key), set_all_data=True, save=save)
+    except Exception as e:
+      LOG.error(f'Failed to load cache snapshot key: {cache_key}: {e}')
+
+
+  def _LoadCacheKey(self, bundle_name, storage, cache_key, queue_keys, is_lazy):
+    """Load a Cache value from storage into this Bundle cache, or only index it if we are lazy loading.  Runs on the warm-up thread pool."""
+    if cache_key in queue_keys: return
+
+    (_, resolution) = self.ResolveKey(bundle_name, cache_key)
+
+    # Ignore these, because this means we dont have the configuration to match a glob, which is not a problem
+    if not resolution:
+      LOG.info(f'Cache value found, but no config exists to set it to: {cache_key}')
+      return
+
+    # Lazy: Index the key now so globs find it, and read it on the first Get().  Only `single` values, queues feed summaries so they are always loaded
+    if is_lazy and resolution.store == 'single' and not cache_key.startswith('static.'):
+      bundle = self._GetBundleSilo(bundle_name)
+      with self.lock_bundles_each[bundle_name]:
+        if cache_key not in bundle:
+          self.cold_keys.setdefault(bundle_name, set()).add(cache_key)
+          self.key_indexes[bundle_name].Add(cache_key)
+      return
+
+    cache_value = storage.Get(cache_storage.KIND_CACHE, cache_key)
+
+    # Storage already has this, so we dont save it again.  Except a queue without its queue records yet, which we save once to create them
+    save = resolution.store == 'queue' and not cache_key.startswith('static.')
+
+    try:
+      self.Set(bundle_name, cache_key, cache_value, set_all_data=True, save=save)
+    except Exception as e:
+      LOG.error(f'Failed to load cache value: {cache_key}: {e}')
+
+
+  def _LoadQueueKey(self, bundle_name, storage, cache_key):
+    """Replay the tail of a queue from storage into this Bundle cache.  Runs on the warm-up thread pool."""
+    try:
+      (_, cache_info, _) = self.GetBundleAndCacheInfo(bundle_name, cache_key)
+      records = storage.ReplayQueue(cache_key, cache_info.get('max', DEFAULT_MAX_QUEUE_SIZE))
+
+      self.Set(bundle_name, cache_key, records, set_all_data=True, save=False)
+    except Exception as e:
+      LOG.info(f'Queue found, but no config exists to set it to: {cache_key}')
+
+
+  def _GetCold(self, bundle_name, cache_key):
+    """Returns the value for a cold key, reading it from storage now.  Returns None if it isnt a cold key"""
+    cold_keys = self.cold_keys.get(bundle_name, None)
+
+    # Only ask storage about keys we know are cold, unless the storage is queryable, then it tells us
+    if bundle_name not in self.cold_queries and (not cold_keys or cache_key not in cold_keys):
+      return None
+
+    storage = self.storages.get(bundle_name, None)
+    if storage is None: return None
+
+    # Read outside the lock.  If a Set() published a newer value while we were reading, it wins
+    cache_value = storage.Get(cache_storage.KIND_CACHE, cache_key)
+
+    # Misses to a queryable storage are normal, dont take the lock for them
+    if cache_value is None and bundle_name in self.cold_queries:
+      return None
+
+    # If this is tracked by our Memory Budget, it is back in memory, so count it again
+    budget = self.memory_budgets.get(bundle_name, None)
+    value_size = ring_buffer.GetJsonSize(cache_value) if budget is not None and cache_value is not None else 0
+
+    bundle = self._GetBundleSilo(bundle_name)
+    with self.lock_bundles_each[bundle_name]:
+      if cold_keys is not None:
+        cold_keys.discard(cache_key)
+
+      if cache_key not in bundle and cache_value is not None:
+        bundle[cache_key] = cache_value
+        self.key_indexes[bundle_name].Add(cache_key)
+        self.stats.CountChange(bundle_name, cache_key)
+
+        if budget is not None and self.IsEvictable(bundle_name, cache_key):
+          budget.Add(cache_key, value_size, clean=True)
+
+        if thread_manager.CACHE_SERVER:
+          thread_manager.CACHE_SERVER.PublishSet(bundle_name, {cache_key: cache_value})
+
+      value = bundle.get(cache_key, None)
+
+    if budget is not None and budget.IsOver():
+      self.EnforceMemoryBudget(bundle_name)
+
+    return value
+
+
+  def _GetColdKeys(self, bundle_name, pattern):
+    """Returns list of the keys in a queryable storage that match the glob `pattern`.  Only the pattern's literal prefix range is queried."""
+    storage = self.storages.get(bundle_name, None)
+    if storage is None: return []
+
+    key_regex_compiled = key_index.CompileGlob(pattern)
+
+    return [key for key in storage.GetKeys(cache_storage.KIND_CACHE, prefix=key_index.GetGlobPrefix(pattern)) if key_regex_compiled.match(key)]
+
+
   def LoadStaticImports(self):
     """Load all our static imports, tests for mtime, so it wont reload them if not needed"""
     for static_key, static_data in self.static_imports.items():
@@ -110,61 +352,27 @@ class CacheManager():
 
 
   def GetBundleAndCacheInfo(self, bundle_name, name):
-    """Returns a tuple of (bundle_info, cache_info)"""
-    bundles = thread_manager.BUNDLE_MANAGER.GetBundles()
-    bundle_info = bundles[bundle_name]
-
-    (cache_info, base_cache_key) = self.GetCacheInfo(bundle_info, name)
-
-    return (bundle_info, cache_info, base_cache_key)
-
+    """Returns a tuple of (bundle_info, cache_info, base_cache_key).  `cache_info` and `base_cache_key` are None if the Bundle has no spec for this key."""
+    (bundle_info, resolution) = self.ResolveKey(bundle_name, name)
 
-  def GetCacheInfo(self, bundle_info, cache_key):
-    """From the Bundle Info spec: Get the spec for this `cache_key`, because its strictly-named, we can reverse it.
-    
-    Returns tuple: (dict, str): (cache_info, base_cache_key) or (None, None) if not found
-    """
-    part_cache_key = cache_key
-    
-    # Schedule Job keys
-    if part_cache_key.startswith('schedule.'):
-      part_cache_key = part_cache_key.replace('schedule.', '', 1)
+    if not resolution:
+      return (bundle_info, None, None)
 
-      # Periodic job keys
-      if part_cache_key.startswith('period.'):
-        part_cache_key = part_cache_key.replace('period.', '', 1)
+    return (bundle_info, resolution.cache_info, resolution.base_cache_key)
 
-        if 'schedule' in bundle_info and 'period' in bundle_info['schedule'] and part_cache_key in bundle_info['schedule']['period']:
-          return (bundle_info['schedule']['period'][part_cache_key], f'schedule.period.{part_cache_key}')
 
-    # Execute
-    elif part_cache_key.startswith('execute.'):
-      part_cache_key = part_cache_key.replace('execute.', '', 1)
+  def ResolveKey(self, bundle_name, cache_key):
+    """Returns tuple (bundle_info, KeyResolution) from the Bundle's Key Table.  Either is None if the Bundle or key isnt found"""
+    key_table = thread_manager.BUNDLE_MANAGER.GetKeyTable(bundle_name)
+    if not key_table:
+      return (None, None)
 
-      # Periodic job keys
-      if part_cache_key.startswith('api.'):
-        part_cache_key = part_cache_key.replace('api.', '', 1)
+    resolution = key_table.Resolve(cache_key)
 
-        # If we have this entire remaining key, return the Cache Info
-        if 'execute' in bundle_info and 'api' in bundle_info['execute'] and part_cache_key in bundle_info['execute']['api']:
-          return (bundle_info['execute']['api'][part_cache_key], f'execute.api.{part_cache_key}')
-
-        # Else, we didnt find it
-        else:
-          # Check if this is a `unique_key` by splitting off the first dotted section and testing it
-          prefix_cache_key = part_cache_key.split('.', 1)[0]
-          if 'execute' in bundle_info and 'api' in bundle_info['execute'] and prefix_cache_key in bundle_info['execute']['api']:
-            return (bundle_info['execute']['api'][prefix_cache_key], f'execute.api.{prefix_cache_key}')
-
-    # Static
-    elif part_cache_key.startswith('static.'):
-      part_cache_key = part_cache_key.replace('static.', '', 1)
-      if part_cache_key in bundle_info['static']:
-        return (bundle_info['static'][part_cache_key], cache_key)
-      else:
-        LOG.error(f'''Couldnt find cache key in the bundle: Key: "{cache_key}"  Bundle: {bundle_info['name']}''')
+    if not resolution and cache_key.startswith('static.'):
+      LOG.error(f'''Couldnt find cache key in the bundle: Key: "{cache_key}"  Bundle: {key_table.bundle_info['name']}''')
 
-    return (None, None)
+    return (key_table.bundle_info, resolution)
 
 
   def SaveBundle(self, bundle_name, cache_key, bundle_info=None, cache_info=None):
@@ -180,75 +388,284 @@ class CacheManager():
       LOG.error(f'Couldnt get our Bundle or Cache data for: {bundle_name}  Key: {cache_key}\nBundle Data: {bundle_info}')
       return
 
-    # Get the path, using the base cache key
-    path = bundle_info['path']['cache'].replace('{key}', cache_key)
-
-    # LOG.debug(f'Save Bundle: {bundle_name}   Key: {cache_key}  Path: {path}')
+    # LOG.debug(f'Save Bundle: {bundle_name}   Key: {cache_key}')
 
     # Store the data into the cache
-    local_cache.Set(path, bundle[cache_key])
+    self.PersistKey(bundle_name, bundle_info, cache_storage.KIND_CACHE, cache_key, bundle[cache_key])
+
+
+  def SaveQueue(self, bundle_name, bundle_info, cache_info, cache_key, records, rewrite=None):
+    """Append new queue `records` to storage.  If `rewrite` is a list, the whole queue is replaced with it first"""
+    storage = self.storages[bundle_name]
+    max_records = cache_info.get('max', DEFAULT_MAX_QUEUE_SIZE)
+
+    if thread_manager.CACHE_FLUSHER:
+      window = utility.ConvertStringDurationToSeconds(bundle_info['path'].get('flush_window', cache_flusher.DEFAULT_FLUSH_WINDOW))
+      thread_manager.CACHE_FLUSHER.MarkQueueAppend(storage, cache_key, records, max_records, rewrite=rewrite, window=window)
+    else:
+      storage.AppendQueue(cache_key, records, max_records, rewrite=rewrite)
+
+
+  def PersistKey(self, bundle_name, bundle_info, kind, key, value):
+    """Persist this value to storage, through the Cache Flusher when it is running"""
+    storage = self.storages[bundle_name]
+
+    if thread_manager.CACHE_FLUSHER:
+      window = utility.ConvertStringDurationToSeconds(bundle_info['path'].get('flush_window', cache_flusher.DEFAULT_FLUSH_WINDOW))
+      thread_manager.CACHE_FLUSHER.MarkDirty(storage, kind, key, value, window=window)
+      return
+
+    # Without the Cache Flusher there is nothing to retry it, so a failed write is only logged
+    try:
+      storage.Write([(kind, key, codec.Dumps(value, default=ring_buffer.JsonDefault))])
+    except Exception as e:
+      LOG.error(f'Cache Manager: Failed to write: {bundle_name}  Key: {key}  Error: {e}')
+
+
+  def UpdateStorage(self, bundle_name, bundle_info):
+    """Returns the storage backend for this Bundle, creating it if this is new, or if the Bundle changed its storage"""
+    storage = self.storages.get(bundle_name, None)
+
+    if storage is None or storage.spec != cache_storage.GetStorageSpec(bundle_info):
+      # Anything still pending for the old storage is flushed to it first
+      if storage is not None and thread_manager.CACHE_FLUSHER:
+        thread_manager.CACHE_FLUSHER.Flush(force=True)
+
+      storage = cache_storage.Create(bundle_info)
+      self.storages[bundle_name] = storage
+
+      LOG.info(f'''Cache storage: {bundle_name}  Storage: {bundle_info['path'].get('storage', cache_storage.DEFAULT_STORAGE)}''')
+
+    return storage
+
+
+  def UpdateMemoryBudget(self, bundle_name, bundle_info):
+    """Create, resize or remove the Memory Budget for this Bundle from its `path.memory_budget`"""
+    memory_budget_text = bundle_info['path'].get('memory_budget', None)
+
+    if not memory_budget_text:
+      self.memory_budgets.pop(bundle_name, None)
+      return
+
+    max_bytes = utility.ConvertStringSizeToBytes(memory_budget_text)
+
+    budget = self.memory_budgets.get(bundle_name, None)
+    if budget is None:
+      self.memory_budgets[bundle_name] = memory_budget.MemoryBudget(max_bytes)
+
+    # Keep what we are tracking, only the limit changed
+    elif budget.max_bytes != max_bytes:
+      budget.max_bytes = max_bytes
+      budget.target_bytes = int(max_bytes * memory_budget.LOW_WATERMARK)
+
+
+  def IsEvictable(self, bundle_name, cache_key, resolution=None):
+    """Returns boolean, True if this key can be evicted to disk by the Memory Budget.  Only `single` store `unique_key` entries"""
+    if resolution is None:
+      (_, resolution) = self.ResolveKey(bundle_name, cache_key)
+
+    if not resolution or not resolution.unique_key or resolution.store != 'single':
+      return False
+
+    return cache_key != resolution.base_cache_key and not cache_key.startswith('static.')
+
+
+  def EnforceMemoryBudget(self, bundle_name):
+    """Evict the least recently used entries from memory until we are back under the Memory Budget"""
+    budget = self.memory_budgets.get(bundle_name, None)
+    if budget is None or not budget.IsOver(): return
+
+    bundle = self._GetBundleSilo(bundle_name)
+
+    # Pick our victims, and the value each one has now
+    with self.lock_bundles_each[bundle_name]:
+      victims = [(key, bundle.get(key, None), key in budget.clean) for key in budget.GetEvictionCandidates()]
+
+    storage = self.storages[bundle_name]
+
+    # Make sure the cold tier has the value before we drop it from memory.  Outside the lock, because this is storage I/O
+    evictions = []
+    for (key, value, is_clean) in victims:
+      if value is None: continue
+
+      if not is_clean:
+        try:
+          if thread_manager.CACHE_FLUSHER:
+            thread_manager.CACHE_FLUSHER.WriteNow(storage, cache_storage.KIND_CACHE, key, value)
+          else:
+            storage.Write([(cache_storage.KIND_CACHE, key, codec.Dumps(value, default=ring_buffer.JsonDefault))])
+        except Exception as e:
+          LOG.error(f'Memory Budget: Failed to write before evicting, keeping it in memory: {bundle_name}  Key: {key}  Error: {e}')
+          continue
+
+      evictions.append((key, value))
+
+    with self.lock_bundles_each[bundle_name]:
+      cold_keys = self.cold_keys.setdefault(bundle_name, set())
+      is_queryable = bundle_name in self.cold_queries
+      evicted_keys = []
+
+      for (key, value) in evictions:
+        # If it was set again while we were writing, it is not cold anymore
+        if bundle.get(key, None) is not value: continue
+
+        # Mark it cold before removing the value, so a lock-free Get() always finds one or the other.  A queryable storage finds its own cold keys
+        if is_queryable:
+          self.key_indexes[bundle_name].Remove(key)
+        else:
+          cold_keys.add(key)
+
+        del bundle[key]
+        budget.Remove(key)
+        evicted_keys.append(key)
+
+      # Worker processes drop them too, and ask us for them from now on
+      if thread_manager.CACHE_SERVER:
+        thread_manager.CACHE_SERVER.PublishEvict(bundle_name, evicted_keys)
+
+    # The Cache Flusher only needs to remember what it wrote for keys in memory
+    if thread_manager.CACHE_FLUSHER:
+      for key in evicted_keys:
+        thread_manager.CACHE_FLUSHER.Forget(storage, cache_storage.KIND_CACHE, key)
+
+    # LOG.debug(f'Memory Budget: Evicted: {bundle_name}  Count: {len(evictions)}  Bytes: {budget.total_bytes} / {budget.max_bytes}')
+
+
+  def WriteSnapshots(self, force=False):
+    """Write a Cache Snapshot for every Bundle with a `path.snapshot` that is due.  If `force`, write them all now"""
+    for bundle_name in list(self.snapshot_times.keys()):
+      key_table = thread_manager.BUNDLE_MANAGER.GetKeyTable(bundle_name)
+      if not key_table or not key_table.bundle_info['path'].get('snapshot', None): continue
+
+      bundle_info = key_table.bundle_info
+      interval = utility.ConvertStringDurationToSeconds(bundle_info['path'].get('snapshot_interval', DEFAULT_SNAPSHOT_INTERVAL))
+
+      if not force and self.snapshot_times[bundle_name] + interval > time.time(): continue
+
+      try:
+        self.WriteSnapshot(bundle_name, bundle_info)
+      except Exception as e:
+        LOG.error(f'Failed to write cache snapshot: {bundle_name}  Error: {e}')
+
+
+  def WriteSnapshot(self, bundle_name, bundle_info):
+    """Write everything in memory for this Bundle to its Cache Snapshot.  Reads are lock-free, so this never blocks writers."""
+    # Take the time before we read anything.  Any file written after this is at least as new as what we snapshot, so it will be loaded over it
+    snapshot_time = time.time()
+    self.snapshot_times[bundle_name] = snapshot_time
+
+    bundle = self._GetBundleSilo(bundle_name)
+
+    # Static data is reloaded from its own files
+    records = [(key, cache_snapshot.KIND_SUMMARY if key.startswith('summary.') else cache_snapshot.KIND_CACHE, GetSnapshotValue(value))
+               for (key, value) in list(bundle.items()) if not key.startswith('static.')]
+
+    count = cache_snapshot.Write(bundle_info['path']['snapshot'], records, snapshot_time)
+
+    LOG.debug(f'Wrote cache snapshot: {bundle_name}  Records: {count}  Duration: {time.time() - snapshot_time:.3f}s')
 
 
   def _GetBundleSilo(self, bundle_name):
     """Returns the entire Bundle dict, with all items inside the bundle.  Bundle is created if doesnt exist yet, so always returns real dict"""
+    # Fast path: Once a Bundle silo exists it is never replaced, so we dont need the global lock to find it
+    bundle = self.bundles.get(bundle_name, None)
+    if bundle is not None:
+      return bundle
+
     with self.lock_bundles_all:
-      # Ensure we have a dictionary to store the Bundle data, and a lock for each
+      # Ensure we have a dictionary to store the Bundle data, and a lock for each.  Publish the silo last, so the fast path never finds a silo without its lock and index
       if bundle_name not in self.bundles:
-        self.bundles[bundle_name] = {}
         self.lock_bundles_each[bundle_name] = threading.Lock()
+        self.key_indexes[bundle_name] = key_index.KeyIndex()
+        self.bundles[bundle_name] = {}
       
       return self.bundles[bundle_name]
 
 
-  def Get(self, bundle_name, cache_key, default=None):
+  def Get(self, bundle_name, cache_key, default=None, count_read=True):
+    """Returns a single Bundle dict item.  If not found, returns `default`.  If `cache_key` is a glob, returns a dict of all the matching items.
+    Reads forwarded by a Cache Replica arent counted again with `count_read`"""
     # Get the bundle, so we have direct access
     bundle = self._GetBundleSilo(bundle_name)
 
-    # print('------------START----------------')
-    # import pprint
-    # pprint.pprint(bundle)
-    # print('------------STOP----------------')
+    # Only Bundles with a `path.memory_budget` track access, for LRU eviction
+    budget = self.memory_budgets.get(bundle_name, None)
 
-    """Returns a single Bundle dict item.  If not found, returns `default`.  If `single`==True will only return 1 value, otherwise the raw values"""
-    #TODO(geoff): Do I need to lock all?  I think I do because things could be changing, and Im working through indexing.  So I should switch to silo mode, and verify I can write to it
-    #   or write a new GetWritableSilo() func so I can write into it without using the global lock, because the get-by-itself is safe
-    with self.lock_bundles_each[bundle_name]:
-      # If this is not a glob, then return the key or default
-      if '*' not in cache_key:
-        return bundle.get(cache_key, default)
-      
-      # Else, this is a glob, so return all the matching records as a dict of dicts
-      else:
-        data = {}
+    # If this is not a glob, then return the key or default
+    if '*' not in cache_key:
+      value = bundle.get(cache_key, MISSING)
+      if value is MISSING:
+        value = self._GetCold(bundle_name, cache_key)
+        if value is None:
+          if count_read: self.stats.CountRead(bundle_name, cache_key, False)
+          return default
+
+      if count_read: self.stats.CountRead(bundle_name, cache_key, True)
+      if budget is not None: budget.Touch(cache_key)
+
+      return GetSnapshotValue(value)
+    
+    # Else, this is a glob, so return all the matching records as a dict of dicts.  The Key Index only walks the range of keys matching the glob prefix
+    else:
+      data = {}
+
+      for key in self.key_indexes[bundle_name].Match(cache_key):
+        value = bundle.get(key, MISSING)
+        if value is MISSING:
+          value = self._GetCold(bundle_name, key)
+          if value is None: continue
+
+        data[key] = GetSnapshotValue(value)
+        if budget is not None: budget.Touch(key)
+
+      # A queryable storage has cold keys that arent in our Key Index, so it runs the glob's prefix range too
+      if bundle_name in self.cold_queries:
+        for key in self._GetColdKeys(bundle_name, cache_key):
+          if key in data: continue
+
+          value = self._GetCold(bundle_name, key)
+          if value is not None:
+            data[key] = GetSnapshotValue(value)
+
+      # LOG.debug(f'Found glob data: {data}')
+
+      if count_read: self.stats.CountRead(bundle_name, cache_key, bool(data))
+
+      return data
 
-        key_regex = utility.GlobToRegex(cache_key)
-        key_regex_compiled = re.compile(key_regex)
-        for (key, value) in bundle.items():
-          if key_regex_compiled.match(key):
-            data[key] = value
 
-        LOG.info(f'Found glob data: {data}')
+  def GetAll(self, bundle_name):
+    """Returns a new dict of every item in this Bundle, with queues as their snapshot lists.  For inspection pages, not hot paths."""
+    bundle = self._GetBundleSilo(bundle_name)
+
+    return {key: GetSnapshotValue(value) for (key, value) in list(bundle.items())}
+
+
+  def GetStats(self, bundle_name=None):
+    """Returns list of dicts, the accounting for every key prefix of this Bundle, or all Bundles if None.  Sorted by bytes.  See cache_stats"""
+    bundle_names = [bundle_name] if bundle_name else list(self.bundles.keys())
 
-        return data
+    return self.stats.GetReport(self.bundles, self.cold_keys, bundle_names)
 
 
   def Set(self, bundle_name, cache_key, value, set_all_data=False, save=True):
-    """Returns a single Bundle dict item.  If not found, returns `default`.  If `single`==True will only return 1 value, otherwise the raw values"""
+    """Set a Bundle dict item, by publishing a new value, or appending to its queue.  If `set_all_data`, `value` is the whole queue"""
     # Get the bundle, so we have direct access
     bundle = self._GetBundleSilo(bundle_name)
 
-    (bundle_info, cache_info, base_cache_key) = self.GetBundleAndCacheInfo(bundle_name, cache_key)
+    (bundle_info, resolution) = self.ResolveKey(bundle_name, cache_key)
 
     # Fail if we cant get this
     if not bundle_info:
-      raise Exception(f'''Failed to get Bundle Info:  Cache Key: {cache_key}  Bundle: {bundle_info}   Cache: {cache_info}''')
-    elif not cache_info:
-      raise Exception(f'''Failed to get Cache Info:  Cache Key: {cache_key}  Bundle: {bundle_info['name']}   Cache: {cache_info}''')
+      raise Exception(f'''Failed to get Bundle Info:  Cache Key: {cache_key}  Bundle: {bundle_name}''')
+    elif not resolution:
+      raise Exception(f'''Failed to get Cache Info:  Cache Key: {cache_key}  Bundle: {bundle_info['name']}''')
 
+    cache_info = resolution.cache_info
 
     # If the cache_data has a `unique_key`
-    if 'unique_key' in cache_info and cache_key == base_cache_key:
-      unique_key = utility.FormatTextFromDictKeys(cache_info['unique_key'], value)
+    if resolution.unique_key and cache_key == resolution.base_cache_key:
+      unique_key = resolution.FormatUniqueKey(value)
 
       if unique_key and '{' not in unique_key:
         # Suffix the unique key to the cache_key
@@ -257,100 +674,329 @@ class CacheManager():
         raise Exception(f'''Unique Key didnt format properly, failing: {bundle_name}  Key: {cache_key}  Unique Key: {unique_key}\nCache Info: {pprint.pformat(cache_info)}\nValue: {pprint.pformat(value)}''')
 
 
+    self.stats.CountWrite(bundle_name, cache_key)
+
+    # Summaries to write to storage after we release the lock, list of tuples: (summary_key, summary_update)
+    summary_writes = []
+
+    # Queues are persisted differently from everything else
+    is_queue = resolution.store == 'queue' and not cache_key.startswith('static.')
+
+    # If this entry counts against our Memory Budget, size it before we take the lock
+    budget = self.memory_budgets.get(bundle_name, None)
+    is_evictable = budget is not None and self.IsEvictable(bundle_name, cache_key, resolution)
+    value_size = ring_buffer.GetJsonSize(value) if is_evictable else 0
+
+    # Writers are serialized per Bundle.  Readers never take this lock, so everything we publish must be a complete new value, never changed in place
     with self.lock_bundles_each[bundle_name]:
+      # If this key was cold, this value replaces whatever is in storage
+      if bundle_name in self.cold_keys:
+        self.cold_keys[bundle_name].discard(cache_key)
+
       # If this is static data, just set it
       if cache_key.startswith('static.'):
         bundle[cache_key] = value
         
       # If Single value storage.  This is the default if nothing is specified
-      elif cache_info.get('store', 'single') == 'single':
+      elif resolution.store == 'single':
         bundle[cache_key] = value
         # LOG.debug(f'Set Cache: {cache_key}')
+
+        # If we arent saving, this value came from disk, so evicting it wont need a write
+        if is_evictable:
+          budget.Add(cache_key, value_size, clean=not save)
       
       # Else, if Queue storage
-      elif cache_info.get('store', None) == 'queue':
-        # Ensure we have our list
-        if cache_key not in bundle: bundle[cache_key] = []
-        
-        # Append the item
+      elif resolution.store == 'queue':
+        max_queue_size = cache_info.get('max', DEFAULT_MAX_QUEUE_SIZE)
+        max_queue_bytes = utility.ConvertStringSizeToBytes(cache_info['max_bytes']) if cache_info.get('max_bytes', None) else None
+
+        # Append the item.  The RingBuffer evicts the oldest item in place once it is full
         if not set_all_data:
           # LOG.debug(f'Set Cache: Appended to Queue: {cache_key}')
-          bundle[cache_key].append(value)
+          queue = bundle.get(cache_key, None)
 
-        # Else, set all the data at once
-        else:
-          # LOG.debug(f'Set Cache: Set All Queue: {cache_key}')
-          bundle[cache_key] = value
+          # Make our RingBuffer if we dont have one yet, or resize it if the bundle `max` or `max_bytes` changed
+          if type(queue) != ring_buffer.RingBuffer or queue.max_size != max_queue_size or queue.max_bytes != max_queue_bytes:
+            queue = ring_buffer.RingBuffer(max_queue_size, queue, max_bytes=max_queue_bytes)
+            bundle[cache_key] = queue
 
-        # Test for max and crop
-        max_queue_size = cache_info.get('max', DEFAULT_MAX_QUEUE_SIZE)
+          queue.Append(value)
 
-        if max_queue_size < len(bundle[cache_key]):
-          # Slice to crop queue, we always chop from the 0 side because we append new items
-          bundle[cache_key] = bundle[cache_key][-max_queue_size:]
-          # LOG.debug(f'Reduced queue length: {bundle_name}: {name}: {len(bundle[name])}')
-        
+        # Else, set all the data at once, loaded in bulk
         else:
-          # LOG.debug(f'Queue length: {bundle_name}: {cache_key}: {len(bundle[cache_key])}')
-          pass
+          # LOG.debug(f'Set Cache: Set All Queue: {cache_key}')
+          bundle[cache_key] = ring_buffer.RingBuffer(max_queue_size, value, max_bytes=max_queue_bytes)
 
         # If this key is in our `summary` system
-        self.ProcessSummary(bundle_info, bundle_name, bundle, cache_key, bundle[cache_key])
+        summary_writes = self.ProcessSummary(bundle_info, bundle_name, bundle, cache_key, bundle[cache_key], new_items=None if set_all_data else [value])
+
+        # Queues are saved by appending to their Queue Log.  Inside the lock, so records are logged in the same order they are queued.  With the Cache Flusher running this is only bookkeeping, not I/O
+        if save:
+          if not set_all_data:
+            self.SaveQueue(bundle_name, bundle_info, cache_info, cache_key, [value])
+          else:
+            self.SaveQueue(bundle_name, bundle_info, cache_info, cache_key, [], rewrite=bundle[cache_key])
     
       # Else, unknown data type
       else:
         LOG.error(f'''Unknown data type for caching: {bundle_name}   Key: {cache_key}  Cache Data: {cache_info}''')
 
-    # If we want to save this.  Normally we do, but when we are initially loading values, we dont  
-    if save:
-      self.SaveBundle(bundle_name, cache_key)
+      # Keep our Key Index current, after the value is published so indexed keys always have a value.  Only new keys cost anything
+      self.key_indexes[bundle_name].Add(cache_key)
+      self.stats.CountChange(bundle_name, cache_key)
+
+      # Stream this change to the worker processes.  Inside the lock, so they get changes in the same order we made them
+      if thread_manager.CACHE_SERVER and cache_key in bundle:
+        self.PublishChange(bundle_name, bundle, cache_key, value, is_queue and not set_all_data, summary_writes)
+
+    # All file I/O happens outside of the lock
+    for (summary_key, summary_update) in summary_writes:
+      self.PersistKey(bundle_name, bundle_info, cache_storage.KIND_SUMMARY, summary_key, summary_update)
+      # LOG.debug(f'Summary written: {summary_key}')
+
+    # If we want to save this.  Normally we do, but when we are initially loading values, we dont.  Queues were already saved above
+    if save and not is_queue:
+      self.SaveBundle(bundle_name, cache_key, bundle_info=bundle_info, cache_info=cache_info)
+
+    # Over our Memory Budget, so move the coldest entries to disk.  After the save, so this value is already marked dirty
+    if is_evictable and budget.IsOver():
+      self.EnforceMemoryBudget(bundle_name)
+
+
+  def PublishChange(self, bundle_name, bundle, cache_key, value, is_append, summary_writes):
+    """Publish a Set() to the Cache Server, for the worker processes.  Called with the Bundle lock held."""
+    if is_append:
+      queue = bundle[cache_key]
+      thread_manager.CACHE_SERVER.PublishAppend(bundle_name, cache_key, value, queue.max_size, queue.max_bytes)
+      items = {}
+    else:
+      # Queues set all at once are sent as their snapshot, because the RingBuffer keeps changing in place after we release the lock
+      items = {cache_key: GetSnapshotValue(bundle[cache_key])}
 
+    # Summaries are replaced whole, so their timeseries RingBuffers and sketches are sent as whatever they have when the Cache Server sends them
+    for (_, summary_update) in summary_writes:
+      items.update(summary_update)
+
+    thread_manager.CACHE_SERVER.PublishSet(bundle_name, items)
+
+
+  def ProcessSummary(self, bundle_data, bundle_name, bundle, bundle_key, raw_data, new_items=None):
+    """Update the summaries for this queue.  Returns list of tuples (summary_key, summary_update) to save after the lock is released"""
+    summary_writes = []
 
-  def ProcessSummary(self, bundle_data, bundle_name, bundle, bundle_key, raw_data):
     # If this key is in our `summary` system
-    if not bundle_data.get('summary', {}) or not bundle_data['summary'].get(bundle_key, None): return
+    if not bundle_data.get('summary', {}) or not bundle_data['summary'].get(bundle_key, None): return summary_writes
 
     summary_data = bundle_data['summary'][bundle_key]
 
     for (suffix_field, field_list) in summary_data['fields'].items():
       summary_key = f'summary.{bundle_key}.{suffix_field}'
 
+      # If group_by exists, we make N results, 1 per each group found
+      if summary_data.get('group_by', None):
+        summary_update = self.ProcessSummaryGrouped(bundle, summary_data, field_list, bundle_name, bundle_key, summary_key, raw_data, new_items)
+
+      else:
+        summary_update = self.ProcessSummaryField(bundle, summary_data, field_list, bundle_name, bundle_key, summary_key, raw_data, new_items)
+
+      if summary_update:
+        # Update the bundle with all our summary data.  Same as setting it directly, but now we can cache the summary data separately for cleanliness
+        bundle.update(summary_update)
+        for summary_update_key in summary_update:
+          self.key_indexes[bundle_name].Add(summary_update_key)
+          self.stats.CountChange(bundle_name, summary_update_key)
+
+        # LOG.debug(f'''Summary: {summary_key}  Min: {bundle[f'{summary_key}.min']}  Max: {bundle[f'{summary_key}.max']}  Mean: {bundle[f'{summary_key}.mean']}''')
+
+        summary_writes.append((summary_key, summary_update))
+
+    return summary_writes
+
+
+  def ProcessSummaryField(self, bundle, summary_data, field_list, bundle_name, bundle_key, summary_key, raw_data, new_items):
+    """Update the online statistics for 1 summary field.  Returns the dict of summary keys to update, or None if we dont have enough data yet"""
+    stats = self.summary_stats.get((bundle_name, summary_key), None)
+
+    # Rebuild from the whole queue if we set all the data, dont have stats yet, or the queue `max` changed.  Otherwise we only add the new items
+    if new_items is None or stats is None or stats.values.max_size != raw_data.max_size:
+      stats = summary_stats.WindowStats(raw_data.max_size)
+      self.summary_stats[(bundle_name, summary_key)] = stats
+      items = raw_data
+    else:
+      items = new_items
+
+    values = []
+    for item in items:
+      value = self.GetSummaryValue(summary_data, field_list, item, bundle_name, bundle_key)
+      if value is not None:
+        stats.Add(value)
+        values.append(value)
+
+    sketch_update = self.UpdateSummarySketch(bundle, summary_data, bundle_name, summary_key, values, new_items is None)
+    
+    # We have all the values, so now we can get our summaries.  `stdev` requires at least 2 data points, so we will just require that for all summaries
+    if len(stats) <= 2:
+      return None
+
+    summary_update = {}
+    summary_update[f'{summary_key}.max'] = stats.Max()
+    summary_update[f'{summary_key}.min'] = stats.Min()
+    summary_update[f'{summary_key}.mean'] = stats.Mean()
+    summary_update[f'{summary_key}.median'] = stats.Median()
+    summary_update[f'{summary_key}.stdev'] = stats.Stdev()
+    # The window RingBuffer itself, readers get its snapshot list.  Saves copying the timeseries on every append
+    summary_update[f'{summary_key}.timeseries'] = stats.values
+    summary_update.update(sketch_update)
+
+    return summary_update
+
+
+  def ProcessSummaryGrouped(self, bundle, summary_data, field_list, bundle_name, bundle_key, summary_key, raw_data, new_items):
+    """Update the column for 1 `group_by` summary field.  Returns the dict of summary keys to update, or None if no group has enough data yet"""
+    column = self.summary_columns.get((bundle_name, summary_key), None)
+
+    # Rebuild from the whole queue if we set all the data, dont have a column yet, or the queue `max` changed.  Otherwise we only add the new items
+    if new_items is None or column is None or column.max_size != raw_data.max_size:
+      column = summary_column.GroupedColumn(raw_data.max_size)
+      self.summary_columns[(bundle_name, summary_key)] = column
+      items = raw_data
+    else:
+      items = new_items
+
+    # Values added per group, for the quantile sketches
+    group_values = {}
+
+    for item in items:
+      value = self.GetSummaryValue(summary_data, field_list, item, bundle_name, bundle_key)
+      group = self.GetSummaryValue(summary_data, summary_data['group_by'], item, bundle_name, bundle_key, coerce=False)
+      if value is not None and group is not None:
+        group = str(group).replace('.', '_')
+        column.Append(group, value)
+        group_values.setdefault(group, []).append(value)
+
+    # Groups that left the window dont keep their keys forever
+    self.RemoveSummaryGroups(bundle_name, bundle, summary_key, column)
+
+    # `stdev` requires at least 2 data points, so we will just require that for all summaries, same as ungrouped
+    group_summaries = column.GetGroupSummaries(min_count=3)
+    if not group_summaries:
+      return None
+
+    summary_update = {}
+    for (group, group_summary) in group_summaries.items():
+      for (stat_name, stat_value) in group_summary.items():
+        summary_update[f'{summary_key}.{group}.{stat_name}'] = stat_value
+
+    for (group, values) in group_values.items():
+      summary_update.update(self.UpdateSummarySketch(bundle, summary_data, bundle_name, f'{summary_key}.{group}', values, new_items is None))
+
+    return summary_update
+
+
+  def RemoveSummaryGroups(self, bundle_name, bundle, summary_key, column):
+    """Delete the keys and sketches of groups that have left the window.  Called with the Bundle lock held"""
+    groups = column.GetGroups()
+    published = self.summary_groups.setdefault((bundle_name, summary_key), set())
+
+    removed_keys = []
+    for group in published - groups:
+      removed_keys += self.key_indexes[bundle_name].GetPrefixRange(f'{summary_key}.{group}.')
+      self.summary_sketches.pop((bundle_name, f'{summary_key}.{group}'), None)
+
+    for key in removed_keys:
+      bundle.pop(key, None)
+      self.key_indexes[bundle_name].Remove(key)
+
+    if removed_keys and thread_manager.CACHE_SERVER:
+      thread_manager.CACHE_SERVER.PublishDelete(bundle_name, removed_keys)
+
+    self.summary_groups[(bundle_name, summary_key)] = groups
+
+
+  def UpdateSummarySketch(self, bundle, summary_data, bundle_name, summary_key, values, is_set_all):
+    """If the summary spec has `quantiles`, add these values to the quantile sketch for `summary_key`.  Returns dict of summary keys to update"""
+    if not summary_data.get('quantiles', None): return {}
+
+    sketch = self.summary_sketches.get((bundle_name, summary_key), None)
+
+    if sketch is None:
+      saved_sketch = bundle.get(f'{summary_key}.sketch', None)
+
+      # Restore our saved sketch, which already counted any queue data we are loading now.  It is still live if we only dropped our reference
+      if type(saved_sketch) == quantile_sketch.DDSketch:
+        sketch = saved_sketch
+      elif saved_sketch:
+        sketch = quantile_sketch.FromDict(saved_sketch)
+        is_set_all = False
+        values = []
+      else:
+        sketch_spec = summary_data.get('sketch', {})
+        sketch = quantile_sketch.DDSketch(sketch_spec.get('relative_accuracy', quantile_sketch.DEFAULT_RELATIVE_ACCURACY), sketch_spec.get('max_bins', quantile_sketch.DEFAULT_MAX_BINS))
+        is_set_all = False
+
+      self.summary_sketches[(bundle_name, summary_key)] = sketch
+
+    # Existing sketch, and all the data was set again, so it was already counted
+    if is_set_all:
       values = []
 
-      # Walk the fields to get to our data
-      for item in raw_data:
-        # Start at the root of each item
-        cur_data = item
+    for value in values:
+      sketch.Add(value)
 
-        # Walk the field list to get to our desired data
-        for field in field_list:
-          cur_data = cur_data[field]
+    if not sketch.count: return {}
 
-        # Float
-        if summary_data.get('type', 'float') == 'float':
-          #TODO(g): Handle other cases than Float
-          value = float(cur_data)
-          values.append(value)
-        
-        else:
-          LOG.error(f'''Summary has unknown type: {summary_data['type']} for {bundle_name} key {bundle_key}''')
+    sketch_update = {}
+    for quantile in summary_data['quantiles']:
+      sketch_update[f'{summary_key}.{quantile_sketch.GetQuantileName(quantile)}'] = sketch.Quantile(quantile)
+
+    # The live sketch itself, like the timeseries RingBuffer.  It is only serialized when it is flushed, published or read, not on every append
+    sketch_update[f'{summary_key}.sketch'] = sketch
+
+    return sketch_update
+
+
+  def GetSummaryValue(self, summary_data, field_list, item, bundle_name, bundle_key, coerce=True):
+    """Walk the `field_list` into this queue item to get our summary value.  Returns float, or None if it couldnt be found.  If not `coerce`, returns the raw value."""
+    # Start at the root of each item
+    cur_data = item
+
+    try:
+      # Walk the field list to get to our desired data
+      for field in field_list:
+        cur_data = cur_data[field]
+
+      if not coerce:
+        return cur_data
+
+      # Float
+      if summary_data.get('type', 'float') == 'float':
+        #TODO(g): Handle other cases than Float
+        return float(cur_data)
+      
+      else:
+        LOG.error(f'''Summary has unknown type: {summary_data['type']} for {bundle_name} key {bundle_key}''')
     
-      # We have all the values, so now we can get our summaries.  `stdev` requires at least 2 data points, so we will just require that for all summaries
-      if len(values) > 2:
-        summary_update = {}
-        summary_update[f'{summary_key}.max'] = max(values)
-        summary_update[f'{summary_key}.min'] = min(values)
-        summary_update[f'{summary_key}.mean'] = statistics.mean(values)
-        summary_update[f'{summary_key}.median'] = statistics.median(values)
-        summary_update[f'{summary_key}.stdev'] = statistics.stdev(values)
-        summary_update[f'{summary_key}.timeseries'] = values
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+      LOG.error(f'Summary field not found in queue item: {bundle_name} key {bundle_key}  Fields: {field_list}  Error: {e}')
 
-        # Update the bundle with all our summary data.  Same as setting it directly, but now we can cache the summary data separately for cleanliness
-        bundle.update(summary_update)
+    return None
+
+
+
+def GetSnapshotValue(value):
+  """Returns the value readers get for a stored value.  Queues are a RingBuffer, so readers get its snapshot list, and sketches get their dict"""
+  if type(value) == ring_buffer.RingBuffer:
+    return value.Snapshot()
+
+  if type(value) == quantile_sketch.DDSketch:
+    return value.ToDict()
+
+  return value
 
-        # LOG.debug(f'''Summary: {summary_key}  Min: {bundle[f'{summary_key}.min']}  Max: {bundle[f'{summary_key}.max']}  Mean: {bundle[f'{summary_key}.mean']}''')
 
-        summary_path = bundle_data['path']['summary'].replace('{key}', summary_key)
-        local_cache.Set(summary_path, summary_update)
-        # LOG.debug(f'Summary written: {summary_path}')
+def IsNewerThanSnapshot(storage, kind, key, snapshot):
+  """Returns boolean, True if this key was written to storage after the Snapshot was taken"""
+  modified_time = storage.GetModifiedTime(kind, key)
 
+  return modified_time is None or modified_time >= snapshot.time
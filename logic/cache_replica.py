@@ -0,0 +1,397 @@
+"""
+Cache Replica: Shares the leader's cache with the other serving processes, when we run with `--workers`.
+
+The leader process runs all the background threads and owns the Cache Manager.  Its Cache Server (threaded/cache_server) streams every cache
+change over a Unix socket to the worker processes, which each keep a replica of the cache in memory, so reads are in-process dict lookups.
+
+Writes, and reads of cold keys (lazy loaded or evicted, which only the leader can load), are sent to the leader.  Their reply comes back on the
+same stream, after the changes they caused, so a worker always reads its own writes.
+
+Messages are length prefixed JSON (see codec):  uint32 length, then the JSON bytes.
+"""
+
+
+import argparse
+import itertools
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from logic import log
+from logic.log import LOG
+
+from logic import status_manager
+from logic import problem_manager
+from logic import codec
+from logic import dependency_graph
+from logic import key_index
+from logic import ring_buffer
+from logic import cache_stats
+
+
+# Environment variable with the path of the leader's socket.  Worker processes inherit it from the leader
+SOCKET_ENV = 'OPSLAND_CACHE_SOCKET'
+
+# Per message: length of the JSON
+FRAME_HEADER = struct.Struct('<I')
+
+# Bytes to read from the socket at a time
+READ_SIZE = 1024 * 1024
+
+# Seconds a worker waits for the leader to accept it and send the initial cache
+CONNECT_TIMEOUT = 60
+
+# Seconds a worker waits for the leader to answer a request
+REQUEST_TIMEOUT = 30
+
+# Seconds between sending our read counts to the leader, for its cache stats
+READS_INTERVAL = 10
+
+# Returned by dict.get() for keys that arent in our replica, so a key whose value is None isnt mistaken for a missing one
+MISSING = object()
+
+# Leader to worker messages
+OP_CONFIG = 'config'        # The leader's settings, so workers are configured the same:  {'data': {name: value}}
+OP_BUNDLES = 'bundles'      # All the Bundle specs:  {'data': {bundle_name: bundle_data}}
+OP_LOAD = 'load'            # A whole Bundle silo, replacing what we had:  {'bundle', 'items': {key: value}, 'cold': bool}
+OP_SET = 'set'              # Changed keys:  {'bundle', 'items': {key: value}}
+OP_APPEND = 'append'        # Item appended to a queue:  {'bundle', 'key', 'value', 'max', 'max_bytes'}
+OP_EVICT = 'evict'          # Keys moved to the cold tier, only the leader can read them now:  {'bundle', 'keys'}
+OP_DELETE = 'delete'        # Keys that were removed:  {'bundle', 'keys'}
+OP_READY = 'ready'          # The initial cache has been sent
+OP_REPLY = 'reply'          # Answer to a request:  {'id', 'value', 'error'}
+
+# Worker to leader requests.  All have an `id` for their reply
+OP_GET = 'get'              # {'id', 'bundle', 'key'}
+OP_WRITE = 'write'          # {'id', 'bundle', 'key', 'value', 'set_all_data', 'save'}
+OP_STATS = 'stats'          # {'id', 'bundle', 'pid', 'reads'}.  Our current read counts come with it, see OP_READS
+
+# Worker to leader notices, which arent answered
+OP_READS = 'reads'          # Our read counts, which are totals, see cache_stats.GetReadRows():  {'pid', 'reads'}
+OP_CHANGED = 'changed'      # A command finished, for the leader's Dependency Manager:  {'bundle', 'key', 'hash'}.  `hash` is its content hash, as hex
+
+
+def GetSocketPath():
+  """Returns the path of the leader's socket.  The leader makes a new one per process, and workers get it from the environment"""
+  return os.environ.get(SOCKET_ENV, None) or os.path.join(tempfile.gettempdir(), f'opsland_cache_{os.getpid()}.sock')
+
+
+def EncodeFrame(message):
+  """Returns the bytes for this message, with its length header"""
+  data = codec.Dumps(message, default=ring_buffer.JsonDefault)
+
+  return FRAME_HEADER.pack(len(data)) + data
+
+
+class FrameReader():
+  """Splits a stream of bytes back into messages"""
+
+  def __init__(self):
+    self.buffer = bytearray()
+
+
+  def Feed(self, data):
+    """Add bytes read from the socket.  Returns list of the messages that are now complete"""
+    self.buffer += data
+
+    messages = []
+    offset = 0
+    while len(self.buffer) - offset >= FRAME_HEADER.size:
+      (length,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+      end = offset + FRAME_HEADER.size + length
+      if len(self.buffer) < end: break
+
+      messages.append(codec.Loads(memoryview(self.buffer)[offset + FRAME_HEADER.size:end]))
+      offset = end
+
+    del self.buffer[:offset]
+
+    return messages
+
+
+class CacheReplica():
+  """Read replica of the leader's Cache Manager, for a worker process.  Has the same Get/Set interface, so the webserver uses it the same way.
+
+  Only our reader thread changes the replica, so like the Cache Manager, reads never take a lock.
+  """
+
+  def __init__(self, config, path):
+    self.config = config
+    self.path = path
+
+    # Replica of each Bundle silo, and its Key Index for globs.  A silo is replaced whole when the leader sends it again
+    self.bundles = {}
+    self.key_indexes = {}
+
+    # Bundles where the leader has cold keys, which we dont have.  Misses and globs for these ask the leader
+    self.cold_bundles = set()
+
+    # We count all our reads ourselves, including the cold ones the leader answers for us.  Everything else is accounted by the leader
+    self.stats = cache_stats.CacheStats()
+
+    # Requests waiting for their reply:  {id: [threading.Event, reply]}
+    self.pending = {}
+    self.lock_pending = threading.Lock()
+    self._request_ids = itertools.count(1)
+
+    # Only 1 thread writes to the socket at a time
+    self.lock_send = threading.Lock()
+
+    # Set when the leader has sent us the initial cache
+    self.ready = threading.Event()
+
+    self.sock = None
+
+
+  def Connect(self):
+    """Connect to the leader and wait until we have the initial cache.  The leader may still be starting, so we retry until CONNECT_TIMEOUT"""
+    timeout_time = time.time() + CONNECT_TIMEOUT
+
+    while True:
+      try:
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        break
+      except (FileNotFoundError, ConnectionRefusedError) as e:
+        self.sock.close()
+        if time.time() > timeout_time:
+          raise Exception(f'Cache Replica: Couldnt connect to the leader: {self.path}  Error: {e}')
+        time.sleep(0.1)
+
+    threading.Thread(target=self._ReadLoop, name='Cache Replica', daemon=True).start()
+    threading.Thread(target=self._ReportReadsLoop, name='Cache Replica Reads', daemon=True).start()
+
+    if not self.ready.wait(CONNECT_TIMEOUT):
+      raise Exception(f'Cache Replica: Timed out waiting for the initial cache: {self.path}')
+
+    LOG.info(f'Cache Replica: Connected: {self.path}  Bundles: {len(self.bundles)}  PID: {os.getpid()}')
+
+
+  def _ReadLoop(self):
+    """Apply everything the leader sends us, in order.  If the leader goes away, so do we, a worker cant serve without its cache"""
+    reader = FrameReader()
+
+    while True:
+      try:
+        data = self.sock.recv(READ_SIZE)
+      except OSError:
+        data = b''
+
+      if not data:
+        LOG.error(f'Cache Replica: Lost the connection to the leader, exiting: PID: {os.getpid()}')
+        os._exit(1)
+
+      for message in reader.Feed(data):
+        try:
+          self._Apply(message)
+        except Exception as e:
+          LOG.error(f'''Cache Replica: Failed to apply: {message.get('op', None)}  Error: {e}''')
+
+
+  def _ReportReadsLoop(self):
+    """Send our read counts to the leader every READS_INTERVAL, so its cache stats include the reads every worker does locally"""
+    while True:
+      time.sleep(READS_INTERVAL)
+
+      try:
+        self._Send({'op': OP_READS, 'pid': os.getpid(), 'reads': self.stats.GetReadRows()})
+      except OSError as e:
+        LOG.error(f'Cache Replica: Failed to send our read counts: {e}')
+
+
+  def _Apply(self, message):
+    """Apply 1 message from the leader to our replica"""
+    op = message['op']
+
+    if op == OP_REPLY:
+      with self.lock_pending:
+        waiting = self.pending.pop(message['id'], None)
+      if waiting:
+        waiting[1] = message
+        waiting[0].set()
+
+    elif op == OP_SET:
+      (bundle, index) = self._GetBundleSilo(message['bundle'])
+      for (key, value) in message['items'].items():
+        bundle[key] = value
+        index.Add(key)
+
+    elif op == OP_APPEND:
+      (bundle, index) = self._GetBundleSilo(message['bundle'])
+      key = message['key']
+
+      # Same as the Cache Manager, so our RingBuffer evicts the same items the leader's did
+      queue = bundle.get(key, None)
+      if type(queue) != ring_buffer.RingBuffer or queue.max_size != message['max'] or queue.max_bytes != message['max_bytes']:
+        queue = ring_buffer.RingBuffer(message['max'], queue, max_bytes=message['max_bytes'])
+        bundle[key] = queue
+
+      queue.Append(message['value'])
+      index.Add(key)
+
+    elif op == OP_EVICT:
+      (bundle, index) = self._GetBundleSilo(message['bundle'])
+      self.cold_bundles.add(message['bundle'])
+
+      for key in message['keys']:
+        bundle.pop(key, None)
+        index.Remove(key)
+
+    elif op == OP_DELETE:
+      (bundle, index) = self._GetBundleSilo(message['bundle'])
+
+      for key in message['keys']:
+        bundle.pop(key, None)
+        index.Remove(key)
+
+    elif op == OP_LOAD:
+      bundle_name = message['bundle']
+
+      # Build the new silo and its index completely, then publish them
+      index = key_index.KeyIndex()
+      index.AddMany(message['items'])
+
+      self.key_indexes[bundle_name] = index
+      self.bundles[bundle_name] = dict(message['items'])
+
+      if message['cold']:
+        self.cold_bundles.add(bundle_name)
+      else:
+        self.cold_bundles.discard(bundle_name)
+
+    elif op == OP_CONFIG:
+      vars(self.config).update(message['data'])
+
+    elif op == OP_BUNDLES:
+      self.config.data = message['data']
+
+    elif op == OP_READY:
+      self.ready.set()
+
+    else:
+      LOG.error(f'Cache Replica: Unknown message: {op}')
+
+
+  def _GetBundleSilo(self, bundle_name):
+    """Returns tuple (dict, KeyIndex) for this Bundle, creating them if needed.  Only called from our reader thread"""
+    if bundle_name not in self.bundles:
+      self.key_indexes[bundle_name] = key_index.KeyIndex()
+      self.bundles[bundle_name] = {}
+
+    return (self.bundles[bundle_name], self.key_indexes[bundle_name])
+
+
+  def _Send(self, message):
+    """Send a message to the leader"""
+    frame = EncodeFrame(message)
+
+    with self.lock_send:
+      self.sock.sendall(frame)
+
+
+  def _Request(self, op, **kwargs):
+    """Send a request to the leader, and return its reply value.  Raises if the leader had an error"""
+    request_id = next(self._request_ids)
+    waiting = [threading.Event(), None]
+
+    with self.lock_pending:
+      self.pending[request_id] = waiting
+
+    self._Send(dict(kwargs, op=op, id=request_id))
+
+    if not waiting[0].wait(REQUEST_TIMEOUT):
+      with self.lock_pending:
+        self.pending.pop(request_id, None)
+      raise Exception(f'''Cache Replica: Timed out waiting for the leader: {op}  Bundle: {kwargs.get('bundle', None)}  Key: {kwargs.get('key', None)}''')
+
+    reply = waiting[1]
+    if reply.get('error', None):
+      raise Exception(reply['error'])
+
+    return reply['value']
+
+
+  def Get(self, bundle_name, cache_key, default=None):
+    """Returns a single Bundle dict item.  If not found, returns `default`.  If `cache_key` is a glob, returns a dict of all the matching items.
+
+    Reads our replica without a lock.  Only Bundles with cold keys ask the leader, for misses and globs.
+    """
+    bundle = self.bundles.get(bundle_name, {})
+    is_cold = bundle_name in self.cold_bundles
+
+    if '*' not in cache_key:
+      value = bundle.get(cache_key, MISSING)
+      if value is MISSING:
+        value = self._Request(OP_GET, bundle=bundle_name, key=cache_key) if is_cold else None
+
+        if value is None:
+          self.stats.CountRead(bundle_name, cache_key, False)
+          return default
+
+      self.stats.CountRead(bundle_name, cache_key, True)
+
+      return value.Snapshot() if type(value) == ring_buffer.RingBuffer else value
+
+    # Cold keys arent in our Key Index, so the leader runs the whole glob
+    if is_cold:
+      data = self._Request(OP_GET, bundle=bundle_name, key=cache_key)
+
+    else:
+      data = {}
+      for key in self.key_indexes.get(bundle_name, key_index.KeyIndex()).Match(cache_key):
+        value = bundle.get(key, MISSING)
+        if value is not MISSING:
+          data[key] = value.Snapshot() if type(value) == ring_buffer.RingBuffer else value
+
+    self.stats.CountRead(bundle_name, cache_key, bool(data))
+
+    return data
+
+
+  def GetAll(self, bundle_name):
+    """Returns a new dict of every item in this Bundle, with queues as their snapshot lists.  For inspection pages, not hot paths."""
+    bundle = self.bundles.get(bundle_name, {})
+
+    return {key: value.Snapshot() if type(value) == ring_buffer.RingBuffer else value for (key, value) in list(bundle.items())}
+
+
+  def GetStats(self, bundle_name=None):
+    """Returns list of dicts, the leader's accounting for every key prefix, with the reads of every worker.  See cache_stats"""
+    return self._Request(OP_STATS, bundle=bundle_name, pid=os.getpid(), reads=self.stats.GetReadRows())
+
+
+  def Set(self, bundle_name, cache_key, value, set_all_data=False, save=True):
+    """Set this value in the leader's cache.  Returns once the leader has it, and the change is in our replica"""
+    self._Request(OP_WRITE, bundle=bundle_name, key=cache_key, value=value, set_all_data=set_all_data, save=save)
+
+
+  def Changed(self, bundle_name, cache_key, payload):
+    """A command finished with this payload.  Tell the leader's Dependency Manager, which only runs there, so it recomputes what is downstream"""
+    content_hash = dependency_graph.GetContentHash(payload)
+
+    self._Send({'op': OP_CHANGED, 'bundle': bundle_name, 'key': cache_key, 'hash': content_hash.hex()})
+
+
+def StartWorker(path):
+  """Returns the config for a worker process, with a Cache Replica connected to the leader at `path`.  Set up like opsland.Main() does, with
+  the leader's settings and Bundle specs"""
+  config = argparse.Namespace()
+  config.data = {}
+
+  # Connecting gets the leader's settings into our config, before the initial cache
+  config.cache = CacheReplica(config, path)
+  config.cache.Connect()
+
+  if config.debug:
+    log.SetLogLevel(log.logging.DEBUG)
+
+  config.status = status_manager.StatusManager(config)
+  config.problems = problem_manager.ProblemManager(config)
+
+  # Same as thread_manager.StartThreads().  Only the leader runs the background threads
+  config.lock_all = threading.Lock()
+
+  return config
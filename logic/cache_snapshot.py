@@ -0,0 +1,142 @@
+"""
+Cache Snapshot: A whole Bundle cache in 1 file, so a restart opens 1 file instead of thousands of small JSON files.
+
+Binary container, little endian:
+  - Header: magic, snapshot time (float64), record count (uint64)
+  - Records: key length (uint32), value length (uint32), key (UTF-8), value (JSON)
+  - Index: JSON dict of {key: [record offset, kind]}
+  - Footer: index offset (uint64), index length (uint64), magic
+
+The file is memory mapped for reading, and the footer gives us the index, so we only decode the values we actually use.  Snapshots are written
+to a temp file and renamed into place, so a reader never sees a partial snapshot.
+"""
+
+
+import mmap
+import os
+import struct
+
+from logic.log import LOG
+
+from logic import ring_buffer
+from logic import codec
+
+
+# Marks the start and end of a valid snapshot, and the format version
+MAGIC = b'OPSLSNP1'
+
+# Header: magic, snapshot time, record count
+HEADER = struct.Struct('<8sdQ')
+
+# Per record: key length, value length
+RECORD_HEADER = struct.Struct('<II')
+
+# Footer: index offset, index length, magic
+FOOTER = struct.Struct('<QQ8s')
+
+# Record kinds.  Cache values are Set() back into the Bundle, Summary values are restored as-is
+KIND_CACHE = 'cache'
+KIND_SUMMARY = 'summary'
+
+
+def Write(path_raw, records, snapshot_time):
+  """Write a snapshot of `records`, an iterable of tuples: (key, kind, value).  Returns the number of records written."""
+  path = os.path.expanduser(path_raw)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+
+  temp_path = f'{path}.tmp'
+  index = {}
+
+  with open(temp_path, 'wb') as fp:
+    # Record count isnt known yet, so we write the header again at the end
+    fp.write(HEADER.pack(MAGIC, snapshot_time, 0))
+
+    for (key, kind, value) in records:
+      key_bytes = key.encode()
+      value_bytes = codec.Dumps(value, default=ring_buffer.JsonDefault)
+
+      index[key] = [fp.tell(), kind]
+
+      fp.write(RECORD_HEADER.pack(len(key_bytes), len(value_bytes)))
+      fp.write(key_bytes)
+      fp.write(value_bytes)
+
+    index_bytes = codec.Dumps(index)
+    index_offset = fp.tell()
+
+    fp.write(index_bytes)
+    fp.write(FOOTER.pack(index_offset, len(index_bytes), MAGIC))
+
+    fp.seek(0)
+    fp.write(HEADER.pack(MAGIC, snapshot_time, len(index)))
+
+    fp.flush()
+    os.fsync(fp.fileno())
+
+  os.replace(temp_path, path)
+
+  return len(index)
+
+
+class Snapshot():
+  """Read-only, memory mapped snapshot.  Values are decoded on demand."""
+
+  def __init__(self, path_raw):
+    self.path = os.path.expanduser(path_raw)
+
+    with open(self.path, 'rb') as fp:
+      self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+      (magic, self.time, self.count) = HEADER.unpack_from(self._mmap, 0)
+      (index_offset, index_length, footer_magic) = FOOTER.unpack_from(self._mmap, len(self._mmap) - FOOTER.size)
+
+      if magic != MAGIC or footer_magic != MAGIC:
+        raise Exception(f'Not a cache snapshot, or it was not completely written: {self.path}')
+
+      # Key to tuple: (offset, kind)
+      self.index = {key: (offset, kind) for (key, (offset, kind)) in codec.Loads(self._mmap[index_offset:index_offset + index_length]).items()}
+
+    except Exception:
+      self._mmap.close()
+      raise
+
+
+  def __len__(self):
+    return len(self.index)
+
+
+  def __contains__(self, key):
+    return key in self.index
+
+
+  def GetKeys(self, kind=None):
+    """Returns list of the keys in this snapshot, optionally only of 1 `kind`"""
+    return [key for (key, (_, key_kind)) in self.index.items() if kind is None or key_kind == kind]
+
+
+  def GetValue(self, key):
+    """Returns the decoded value for this key.  Raises KeyError if it isnt in the snapshot."""
+    (offset, _) = self.index[key]
+
+    (key_length, value_length) = RECORD_HEADER.unpack_from(self._mmap, offset)
+    start = offset + RECORD_HEADER.size + key_length
+
+    return codec.Loads(self._mmap[start:start + value_length])
+
+
+  def Close(self):
+    self._mmap.close()
+
+
+def Open(path_raw):
+  """Returns a Snapshot for this path, or None if there isnt a valid one"""
+  path = os.path.expanduser(path_raw)
+  if not os.path.isfile(path):
+    return None
+
+  try:
+    return Snapshot(path)
+  except Exception as e:
+    LOG.error(f'Cache snapshot could not be read, loading from cache files instead: {path}  Error: {e}')
+    return None
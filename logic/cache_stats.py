@@ -0,0 +1,221 @@
+"""
+Cache Stats: Accounting for the Cache Manager, per Bundle and per key prefix, for the `/opsland/cache` pages.
+
+Get() and Set() only bump counters:  hits, misses and writes are plain dict counts updated without a lock.  Under contention a count can be lost,
+which is fine for accounting, and keeps the overhead low enough to leave on in production.
+
+Item counts, sizes and queue fill levels are only computed when a report is asked for.  Each value's size is cached with the version of its key,
+which is bumped every time a new value is published, so a report only serializes the values that changed since the last one.
+
+With `--workers`, reads happen in the worker processes' Cache Replicas.  They send their read counts to the leader, which adds them to its own.
+"""
+
+
+import functools
+import time
+
+from logic import ring_buffer
+
+
+# Keys are accounted under their first N dotted sections.  ex: `execute.api.site_user.alice` -> `execute.api.site_user`
+PREFIX_DEPTH = 3
+
+# Read and write rates are measured over at least this many seconds
+RATE_WINDOW = 60
+
+# Fields of a report row, which are counts we can add together
+ROW_COUNT_FIELDS = ['items', 'cold_items', 'bytes', 'queues', 'queue_items', 'queue_capacity', 'hits', 'misses', 'writes']
+
+
+@functools.lru_cache(maxsize=65536)
+def GetKeyPrefix(cache_key):
+  """Returns the prefix we account this key under.  Globs are accounted under their literal sections, ex: `execute.api.site_user.*` -> `execute.api.site_user`"""
+  sections = cache_key.split('.', PREFIX_DEPTH)[:PREFIX_DEPTH]
+
+  # Drop the wildcard sections of a glob, so it counts with the keys it reads
+  while len(sections) > 1 and '*' in sections[-1]:
+    sections.pop()
+
+  return '.'.join(sections)
+
+
+class CacheStats():
+  """Counters for 1 process.  Counting needs no lock, reports should be requested from 1 thread at a time."""
+
+  def __init__(self):
+    # Counts keyed on tuple: (bundle_name, prefix)
+    self.hits = {}
+    self.misses = {}
+    self.writes = {}
+
+    self.start_time = time.time()
+
+    # Counts at the start of our rate window, tuple: (time, hits, misses, writes).  We keep the last 2 windows, so a rate always covers at least RATE_WINDOW
+    self.samples = [(self.start_time, {}, {}, {})]
+
+    # Version of each key's value, bumped after every change:  {(bundle_name, key): int}
+    self.versions = {}
+
+    # Cached value sizes:  {(bundle_name, key): (version, size)}.  Only used while the key still has that version
+    self.sizes = {}
+
+    # Read counts of the worker processes, which are their totals, so the last ones they sent win:  {process_id: (hits, misses)}
+    self.replica_reads = {}
+
+
+  def CountRead(self, bundle_name, cache_key, is_hit):
+    """Count a Get().  Globs count once, as a hit if they matched anything"""
+    key = (bundle_name, GetKeyPrefix(cache_key))
+    counts = self.hits if is_hit else self.misses
+
+    counts[key] = counts.get(key, 0) + 1
+
+
+  def CountWrite(self, bundle_name, cache_key):
+    """Count a Set()"""
+    key = (bundle_name, GetKeyPrefix(cache_key))
+
+    self.writes[key] = self.writes.get(key, 0) + 1
+
+
+  def CountChange(self, bundle_name, cache_key):
+    """Bump the version of a key that has a new value, from Set(), a summary or a load.  Called after it is published, so its size is measured again"""
+    key = (bundle_name, cache_key)
+
+    self.versions[key] = self.versions.get(key, 0) + 1
+
+
+  def GetSize(self, bundle_name, key, value):
+    """Returns the approximate size in bytes of this value, as JSON.  Cached until its key has a new version"""
+    # Take the version before we measure, so a change while we measure is measured again next time
+    version = self.versions.get((bundle_name, key), 0)
+
+    cached = self.sizes.get((bundle_name, key), None)
+    if cached is not None and cached[0] == version:
+      return cached[1]
+
+    size = ring_buffer.GetJsonSize(value)
+    self.sizes[(bundle_name, key)] = (version, size)
+
+    return size
+
+
+  def GetReadRows(self):
+    """Returns list of our read counts, to send to the leader, lists: [bundle_name, prefix, hits, misses]"""
+    keys = set(self.hits) | set(self.misses)
+
+    return [[key[0], key[1], self.hits.get(key, 0), self.misses.get(key, 0)] for key in keys]
+
+
+  def SetReplicaReads(self, process_id, rows):
+    """Keep the read counts a worker process sent us, from its GetReadRows()"""
+    hits = {}
+    misses = {}
+    for (bundle_name, prefix, hit_count, miss_count) in rows:
+      hits[(bundle_name, prefix)] = hit_count
+      misses[(bundle_name, prefix)] = miss_count
+
+    self.replica_reads[process_id] = (hits, misses)
+
+
+  def _GetReadCounts(self):
+    """Returns tuple of dicts (hits, misses), our read counts with every worker process's added in"""
+    hits = dict(self.hits)
+    misses = dict(self.misses)
+
+    for (replica_hits, replica_misses) in list(self.replica_reads.values()):
+      for (key, count) in replica_hits.items():
+        hits[key] = hits.get(key, 0) + count
+      for (key, count) in replica_misses.items():
+        misses[key] = misses.get(key, 0) + count
+
+    return (hits, misses)
+
+
+  def _GetRateSample(self, hits, misses):
+    """Returns the oldest sample in our rate window, and starts a new window with these counts if the current one is old enough"""
+    cur_time = time.time()
+
+    if cur_time - self.samples[-1][0] >= RATE_WINDOW:
+      self.samples = self.samples[-1:] + [(cur_time, hits, misses, dict(self.writes))]
+
+    return self.samples[0]
+
+
+  def GetReport(self, bundles, cold_keys, bundle_names):
+    """Returns list of dicts, 1 row per (bundle, prefix), sorted by bytes.  `bundles` and `cold_keys` are the Cache Manager's"""
+    rows = {}
+
+    def GetRow(key):
+      if key not in rows:
+        rows[key] = {'bundle': key[0], 'prefix': key[1]}
+        rows[key].update({field: 0 for field in ROW_COUNT_FIELDS})
+      return rows[key]
+
+    for bundle_name in bundle_names:
+      bundle = bundles.get(bundle_name, {})
+
+      # Forget the sizes and versions of keys that are gone, so they dont grow forever
+      for size_key in [size_key for size_key in self.sizes if size_key[0] == bundle_name and size_key[1] not in bundle]:
+        del self.sizes[size_key]
+      for version_key in [version_key for version_key in list(self.versions) if version_key[0] == bundle_name and version_key[1] not in bundle]:
+        self.versions.pop(version_key, None)
+
+      for (key, value) in list(bundle.items()):
+        row = GetRow((bundle_name, GetKeyPrefix(key)))
+        row['items'] += 1
+        row['bytes'] += self.GetSize(bundle_name, key, value)
+
+        if type(value) == ring_buffer.RingBuffer:
+          row['queues'] += 1
+          row['queue_items'] += len(value)
+          row['queue_capacity'] += value.max_size
+
+      for key in list(cold_keys.get(bundle_name, ())):
+        GetRow((bundle_name, GetKeyPrefix(key)))['cold_items'] += 1
+
+    # Counters, including prefixes that only ever missed.  Reads include the worker processes
+    (hits, misses) = self._GetReadCounts()
+    (sample_time, sample_hits, sample_misses, sample_writes) = self._GetRateSample(hits, misses)
+    duration = max(time.time() - sample_time, 1)
+
+    for (field, counts, sample_counts) in [('hits', hits, sample_hits), ('misses', misses, sample_misses), ('writes', self.writes, sample_writes)]:
+      for (key, count) in list(counts.items()):
+        if key[0] not in bundle_names: continue
+
+        row = GetRow(key)
+        row[field] = count
+        row[f'{field}_rate'] = (count - sample_counts.get(key, 0)) / duration
+
+    for row in rows.values():
+      FinishRow(row)
+
+    return sorted(rows.values(), key=lambda row: row['bytes'], reverse=True)
+
+
+def FinishRow(row):
+  """Fill in the derived fields of a report row"""
+  for field in ['hits_rate', 'misses_rate', 'writes_rate']:
+    row.setdefault(field, 0)
+
+  reads = row['hits'] + row['misses']
+  row['hit_rate'] = row['hits'] / reads if reads else None
+  row['queue_fill'] = row['queue_items'] / row['queue_capacity'] if row['queue_capacity'] else None
+
+
+def GetTotals(rows):
+  """Returns list of dicts, 1 per Bundle, with the counts of all its rows added together"""
+  totals = {}
+
+  for row in rows:
+    total = totals.setdefault(row['bundle'], {'bundle': row['bundle'], 'prefixes': 0, 'hits_rate': 0, 'misses_rate': 0, 'writes_rate': 0})
+    total.update({field: total.get(field, 0) + row[field] for field in ROW_COUNT_FIELDS})
+    total['prefixes'] += 1
+
+    for field in ['hits_rate', 'misses_rate', 'writes_rate']:
+      total[field] += row[field]
+
+  for total in totals.values():
+    FinishRow(total)
+
+  return sorted(totals.values(), key=lambda total: total['bytes'], reverse=True)
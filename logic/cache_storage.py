@@ -0,0 +1,325 @@
+"""
+Cache Storage: Persistent storage backends under the Cache Manager.  Each Bundle picks its backend with `path.storage`.
+
+  - `file`: The default.  A JSON file per cache key and per summary, at `path.cache` and `path.summary`, and an append-only `.jsonl` Queue Log per queue.
+  - `sqlite`: An embedded SQLite database at `path.sqlite`, in WAL mode.  Writes are batched into 1 transaction, and keys are a primary key,
+      so prefix ranges (glob lookups) are indexed queries.  The database can answer for keys that are not in memory, so globs and misses go to it.
+
+Values are given to storage already serialized as JSON bytes (see codec), so the Cache Flusher can hash them without serializing twice.
+"""
+
+
+import os
+import sqlite3
+import threading
+import time
+
+from logic.log import LOG
+
+from logic import utility
+from logic import local_cache
+from logic import queue_log
+from logic import codec
+
+
+# Kinds of data we store.  Cache and Summary are whole values, Queue is an ordered log of records
+KIND_CACHE = 'cache'
+KIND_SUMMARY = 'summary'
+KIND_QUEUE = 'queue'
+
+# Default backend, if the Bundle doesnt specify `path.storage`
+DEFAULT_STORAGE = 'file'
+
+# Seconds to wait for a SQLite lock before failing
+SQLITE_TIMEOUT = 30
+
+# Upper bound for SQLite prefix ranges.  Sorts after any character a key can have
+PREFIX_RANGE_END = '\U0010ffff'
+
+class WriteError(Exception):
+  """Some items of a Write() failed.  `failed` is the list of tuple (kind, key) that werent written, the rest were"""
+
+  def __init__(self, message, failed):
+    Exception.__init__(self, message)
+    self.failed = failed
+
+
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cache (kind TEXT NOT NULL, key TEXT NOT NULL, time REAL NOT NULL, data BLOB NOT NULL, PRIMARY KEY (kind, key)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS queue (key TEXT NOT NULL, seq INTEGER NOT NULL, time REAL NOT NULL, data BLOB NOT NULL, PRIMARY KEY (key, seq)) WITHOUT ROWID;
+'''
+
+
+class Storage():
+  """Storage backend interface.  Every method is safe to call from any thread."""
+
+  # True if the backend can cheaply answer Get() and GetKeys() for keys that are not in memory, so the Cache Manager doesnt track them itself
+  is_queryable = False
+
+  def __init__(self, bundle_info):
+    # What this was created from, so the Cache Manager knows when a Bundle change needs a new backend
+    self.spec = GetStorageSpec(bundle_info)
+
+
+  def GetLocation(self, kind, key):
+    """Returns a string which is unique to this kind and key across all backends.  Used to track dirty writes."""
+    raise NotImplementedError()
+
+
+  def Get(self, kind, key):
+    """Returns the value for this key, or None if we dont have it"""
+    raise NotImplementedError()
+
+
+  def Write(self, items):
+    """Write a batch of items, list of tuples: (kind, key, data_json), where `data_json` is bytes"""
+    raise NotImplementedError()
+
+
+  def GetKeys(self, kind, prefix=''):
+    """Returns list of all the keys of this kind, which start with `prefix`"""
+    raise NotImplementedError()
+
+
+  def GetModifiedTime(self, kind, key):
+    """Returns the time this key was last written, or None if we dont have it"""
+    raise NotImplementedError()
+
+
+  def AppendQueue(self, key, records, max_records, rewrite=None):
+    """Append `records` to this queue, keeping at least the newest `max_records`.  If `rewrite` is a list, the whole queue is replaced with it first."""
+    raise NotImplementedError()
+
+
+  def ReplayQueue(self, key, max_records):
+    """Returns list of the newest `max_records` records in this queue, oldest first"""
+    raise NotImplementedError()
+
+
+class FileStorage(Storage):
+  """A JSON file per key.  This is how OpsLand has always stored its cache."""
+
+  def __init__(self, bundle_info):
+    Storage.__init__(self, bundle_info)
+
+    self.cache_path = bundle_info['path']['cache']
+    self.summary_path = bundle_info['path']['summary']
+
+    # Append-only Queue Logs for all our `store: queue` keys
+    self.queue_logs = {}
+
+
+  def GetPath(self, kind, key):
+    """Returns the file path for this key"""
+    if kind == KIND_SUMMARY:
+      return self.summary_path.replace('{key}', key)
+    elif kind == KIND_QUEUE:
+      return os.path.expanduser(self.cache_path.replace('{key}', key)) + queue_log.QUEUE_LOG_SUFFIX
+    else:
+      return self.cache_path.replace('{key}', key)
+
+
+  def GetLocation(self, kind, key):
+    return os.path.expanduser(self.GetPath(kind, key))
+
+
+  def Get(self, kind, key):
+    return local_cache.GetData(self.GetPath(kind, key))
+
+
+  def Write(self, items):
+    """Write each file, and raise WriteError with the ones that failed, so the caller can retry them"""
+    failed = []
+    for (kind, key, data_json) in items:
+      try:
+        local_cache.SetJson(self.GetPath(kind, key), data_json)
+      except Exception as e:
+        LOG.error(f'File Storage: Failed to write: {self.GetPath(kind, key)}  Error: {e}')
+        failed.append((kind, key))
+
+    if failed:
+      raise WriteError(f'File Storage: Failed to write {len(failed)} of {len(items)} items', failed)
+
+
+  def GetKeys(self, kind, prefix=''):
+    path_glob = (self.summary_path if kind == KIND_SUMMARY else self.cache_path).replace('{key}', '*')
+
+    keys = []
+    for path in utility.Glob(path_glob):
+      # Queue Logs are next to the cache files, and any temp files from an interrupted compaction are skipped
+      if path.endswith('.tmp'): continue
+
+      is_queue_log = path.endswith(queue_log.QUEUE_LOG_SUFFIX)
+      if kind == KIND_QUEUE and not is_queue_log: continue
+      if kind == KIND_CACHE and is_queue_log: continue
+
+      key = utility.GlobReverse(path_glob, path)
+      if is_queue_log:
+        key = key[:-len(queue_log.QUEUE_LOG_SUFFIX)]
+
+      if key.startswith(prefix):
+        keys.append(key)
+
+    return keys
+
+
+  def GetModifiedTime(self, kind, key):
+    return utility.GetPathModifiedTime(self.GetLocation(kind, key))
+
+
+  def AppendQueue(self, key, records, max_records, rewrite=None):
+    # Get the Queue Log for this key, or make it
+    log = self.queue_logs.get(key, None)
+    if log is None:
+      log = self.queue_logs.setdefault(key, queue_log.QueueLog(self.cache_path.replace('{key}', key)))
+
+    log.Write(records, max_records, rewrite=rewrite)
+
+
+  def ReplayQueue(self, key, max_records):
+    return queue_log.Replay(self.GetLocation(KIND_QUEUE, key), max_records)
+
+
+class SqliteStorage(Storage):
+  """Embedded SQLite database in WAL mode.  Readers dont block the writer, and each thread uses its own connection."""
+
+  is_queryable = True
+
+  def __init__(self, bundle_info):
+    Storage.__init__(self, bundle_info)
+
+    self.path = os.path.expanduser(bundle_info['path']['sqlite'])
+    local_cache.EnsureCacheDirectory(self.path)
+
+    # SQLite connections cant be shared between threads safely, so every thread gets its own
+    self._local = threading.local()
+
+    # Only 1 write transaction at a time.  WAL allows 1 writer, so this saves us from waiting on SQLite's busy timeout
+    self._lock_write = threading.Lock()
+
+    with self._lock_write:
+      self._GetConnection().executescript(SQLITE_SCHEMA)
+
+
+  def _GetConnection(self):
+    """Returns this thread's connection, making it if needed"""
+    connection = getattr(self._local, 'connection', None)
+    if connection is None:
+      # Autocommit, we start our own transactions when we batch writes
+      connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None, check_same_thread=False)
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      self._local.connection = connection
+
+    return connection
+
+
+  def _Transaction(self, statements):
+    """Run a list of tuples (sql, params_list) as 1 transaction.  Each is run with executemany()."""
+    with self._lock_write:
+      connection = self._GetConnection()
+      connection.execute('BEGIN IMMEDIATE')
+      try:
+        for (sql, params_list) in statements:
+          connection.executemany(sql, params_list)
+        connection.execute('COMMIT')
+      except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+
+  def GetLocation(self, kind, key):
+    return f'sqlite:{self.path}:{kind}:{key}'
+
+
+  def Get(self, kind, key):
+    row = self._GetConnection().execute('SELECT data FROM cache WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+    if row is None:
+      return None
+
+    return codec.Loads(row[0])
+
+
+  def Write(self, items):
+    cur_time = time.time()
+    self._Transaction([('INSERT OR REPLACE INTO cache (kind, key, time, data) VALUES (?, ?, ?, ?)', [(kind, key, cur_time, data_json) for (kind, key, data_json) in items])])
+
+
+  def GetKeys(self, kind, prefix=''):
+    connection = self._GetConnection()
+
+    # Prefix ranges walk the primary key index
+    if kind == KIND_QUEUE:
+      rows = connection.execute('SELECT DISTINCT key FROM queue WHERE key >= ? AND key < ? ORDER BY key', (prefix, prefix + PREFIX_RANGE_END))
+    else:
+      rows = connection.execute('SELECT key FROM cache WHERE kind = ? AND key >= ? AND key < ? ORDER BY key', (kind, prefix, prefix + PREFIX_RANGE_END))
+
+    return [row[0] for row in rows]
+
+
+  def GetModifiedTime(self, kind, key):
+    connection = self._GetConnection()
+
+    if kind == KIND_QUEUE:
+      row = connection.execute('SELECT MAX(time) FROM queue WHERE key = ?', (key,)).fetchone()
+    else:
+      row = connection.execute('SELECT time FROM cache WHERE kind = ? AND key = ?', (kind, key)).fetchone()
+
+    return row[0] if row else None
+
+
+  def AppendQueue(self, key, records, max_records, rewrite=None):
+    cur_time = time.time()
+
+    with self._lock_write:
+      connection = self._GetConnection()
+      connection.execute('BEGIN IMMEDIATE')
+      try:
+        if rewrite is not None:
+          connection.execute('DELETE FROM queue WHERE key = ?', (key,))
+          records = list(rewrite) + list(records)
+
+        last_seq = connection.execute('SELECT COALESCE(MAX(seq), 0) FROM queue WHERE key = ?', (key,)).fetchone()[0]
+
+        connection.executemany('INSERT INTO queue (key, seq, time, data) VALUES (?, ?, ?, ?)',
+                               [(key, last_seq + offset + 1, cur_time, codec.Dumps(record)) for (offset, record) in enumerate(records)])
+
+        # Drop anything older than the queue can hold
+        connection.execute('DELETE FROM queue WHERE key = ? AND seq <= ?', (key, last_seq + len(records) - max_records))
+
+        connection.execute('COMMIT')
+      except Exception:
+        connection.execute('ROLLBACK')
+        raise
+
+
+  def ReplayQueue(self, key, max_records):
+    rows = self._GetConnection().execute('SELECT data FROM queue WHERE key = ? ORDER BY seq DESC LIMIT ?', (key, max_records)).fetchall()
+
+    records = []
+    for (data,) in reversed(rows):
+      try:
+        records.append(codec.Loads(data))
+      except ValueError as e:
+        LOG.error(f'SQLite Storage: Skipping bad queue record: {key}  Error: {e}')
+
+    return records
+
+
+def GetStorageSpec(bundle_info):
+  """Returns a tuple of everything in the Bundle that decides its storage backend"""
+  path_info = bundle_info['path']
+
+  return (path_info.get('storage', DEFAULT_STORAGE), path_info.get('cache', None), path_info.get('summary', None), path_info.get('sqlite', None))
+
+
+def Create(bundle_info):
+  """Returns a new storage backend for this Bundle, from `path.storage`"""
+  storage_type = bundle_info['path'].get('storage', DEFAULT_STORAGE)
+
+  if storage_type == 'file':
+    return FileStorage(bundle_info)
+  elif storage_type == 'sqlite':
+    return SqliteStorage(bundle_info)
+  else:
+    raise Exception(f'''Unknown cache storage: {storage_type}  Bundle: {bundle_info.get('name', None)}  Options: file, sqlite''')
@@ -0,0 +1,58 @@
+"""
+Codec: The 1 place we encode and decode JSON.  Cache values, summaries, queue records, command input and output, and API responses all go through here.
+
+Uses orjson when it is installed, which is several times faster, otherwise the stdlib json module.  Both backends work in bytes:  Dumps() returns
+UTF-8 bytes, and Loads() takes bytes (or str), so we can write to files, SQLite, hashes and HTTP responses without going through str.
+"""
+
+
+import json
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+
+# Which backend we are using, for logging
+BACKEND = 'orjson' if orjson else 'json'
+
+# Raised by Loads() for bad JSON, with either backend.  orjson's error is a subclass of this
+DecodeError = json.JSONDecodeError
+
+# orjson options that keep our output the same as the stdlib:  non-string dict keys become strings, and NumPy values (summary columns) serialize
+ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY if orjson else 0
+
+
+def Dumps(value, default=None, sort_keys=False):
+  """Returns the JSON for this value as UTF-8 bytes.  `default` is called for values that arent serializable, like json.dumps().
+
+  With `sort_keys` equal values always give the same bytes, for hashing.
+  """
+  if orjson:
+    return orjson.dumps(value, default=default, option=ORJSON_OPTIONS | orjson.OPT_SORT_KEYS if sort_keys else ORJSON_OPTIONS)
+
+  return json.dumps(value, default=default, separators=(',', ':'), ensure_ascii=False, sort_keys=sort_keys).encode()
+
+
+def Loads(data):
+  """Returns the value decoded from JSON `data`, which can be bytes, bytearray, memoryview or str.  Raises DecodeError if it isnt valid."""
+  if orjson:
+    return orjson.loads(data)
+
+  if type(data) == memoryview:
+    data = bytes(data)
+
+  return json.loads(data)
+
+
+def Load(path):
+  """Returns the value decoded from the JSON file at `path`"""
+  with open(path, 'rb') as fp:
+    return Loads(fp.read())
+
+
+def Save(path, value, default=None):
+  """Write this value as a JSON file at `path`"""
+  with open(path, 'wb') as fp:
+    fp.write(Dumps(value, default=default))
@@ -0,0 +1,251 @@
+"""
+Command Pool: Long lived worker processes for commands with `mode: persistent`, so we dont pay interpreter startup and imports on every run.
+
+A persistent command is started once, and then serves many runs.  The protocol is JSON lines:  for each run we write the command's input as 1 line
+of JSON to its stdin, and it writes its output as 1 line of JSON to its stdout.  It should exit when its stdin is closed.  stderr is passed through
+to ours, for logging.
+
+A run fails like a normal command exiting non-zero when its reply is an object with `__error` (a message) or a non-zero `__status`, ex:
+`{"__error": "No such user", "__status": 2}`.  Its status is `__status`, or 1 if it only has `__error`.
+
+Each command has a pool of up to `pool_size` workers, each running 1 request at a time.  A worker that crashes, times out or writes something
+that isnt a line is killed, and replaced on the next run.  After `max_requests` runs a worker is retired, so leaks in the command dont build up.
+If the command's `pool_size` or `max_requests` change, its pool is replaced.
+"""
+
+
+import os
+import select
+import shlex
+import subprocess
+import threading
+import time
+
+from logic.log import LOG
+
+from logic import codec
+
+
+# Workers per command, unless the command sets `pool_size`
+DEFAULT_POOL_SIZE = 1
+
+# Runs before a worker is retired and replaced, unless the command sets `max_requests`
+DEFAULT_MAX_REQUESTS = 1000
+
+# Bytes to read from a worker's stdout at a time
+READ_SIZE = 64 * 1024
+
+# Seconds to wait for a retired worker to exit after we close its stdin, before we kill it
+STOP_TIMEOUT = 2
+
+# Reply fields that fail a run, see the module docstring
+REPLY_ERROR_FIELD = '__error'
+REPLY_STATUS_FIELD = '__status'
+
+
+# All the pools:  {(command, cwd): CommandPool}
+POOLS = {}
+LOCK_POOLS = threading.Lock()
+
+
+class PersistentWorker():
+  """1 long lived process running a command"""
+
+  def __init__(self, command, cwd):
+    self.command = command
+    self.requests = 0
+
+    args = shlex.split(command)
+    self.process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=cwd, bufsize=0)
+
+    # We wait on select() to write requests, so a worker that stops reading cant block us past the timeout
+    os.set_blocking(self.process.stdin.fileno(), False)
+
+    # Bytes read after the last complete line
+    self.buffer = b''
+
+    LOG.info(f'Command Pool: Started worker: PID: {self.process.pid}  Command: {command}')
+
+
+  def IsAlive(self):
+    return self.process.poll() is None
+
+
+  def Request(self, input_data, timeout=None):
+    """Send 1 request, and return its reply line as bytes, without the newline.  Raises if the worker died or timed out, it must not be reused"""
+    self.requests += 1
+
+    timeout_time = time.time() + timeout if timeout else None
+
+    self._Write(codec.Dumps(input_data) + b'\n', timeout_time, timeout)
+
+    while b'\n' not in self.buffer:
+      (readable, _, _) = select.select([self.process.stdout], [], [], GetRemaining(timeout_time, timeout))
+      if not readable: continue
+
+      data = os.read(self.process.stdout.fileno(), READ_SIZE)
+      if not data:
+        raise EOFError(f'Worker exited: Status: {self.process.wait()}')
+
+      self.buffer += data
+
+    (line, self.buffer) = self.buffer.split(b'\n', 1)
+
+    return line
+
+
+  def _Write(self, data, timeout_time, timeout):
+    """Write all of `data` to the worker's stdin, as it reads it.  Raises TimeoutError at `timeout_time`"""
+    fd = self.process.stdin.fileno()
+    remaining_data = memoryview(data)
+
+    while remaining_data:
+      (_, writable, _) = select.select([], [fd], [], GetRemaining(timeout_time, timeout))
+      if not writable: continue
+
+      try:
+        remaining_data = remaining_data[os.write(fd, remaining_data):]
+      except BlockingIOError:
+        pass
+
+
+  def Stop(self, kill=False):
+    """Stop this worker.  Normally by closing its stdin, so it finishes up, or `kill` if it cant be trusted"""
+    try:
+      if kill:
+        self.process.kill()
+      else:
+        self.process.stdin.close()
+      self.process.wait(STOP_TIMEOUT)
+
+    except subprocess.TimeoutExpired:
+      self.process.kill()
+      self.process.wait()
+
+    except OSError:
+      pass
+
+    LOG.info(f'Command Pool: Stopped worker: PID: {self.process.pid}  Requests: {self.requests}  Command: {self.command}')
+
+
+class CommandPool():
+  """Workers for 1 command.  Runs block until a worker is free, so call them from a thread, not the event loop"""
+
+  def __init__(self, command, cwd, size=DEFAULT_POOL_SIZE, max_requests=DEFAULT_MAX_REQUESTS):
+    self.command = command
+    self.cwd = cwd
+    self.size = size
+    self.max_requests = max_requests
+
+    # Idle workers, ready for a request
+    self.idle = []
+    self.lock = threading.Lock()
+
+    # Limits how many workers are running requests at once
+    self.slots = threading.Semaphore(size)
+
+    # Set by Shutdown(), so busy workers are stopped instead of going back to idle
+    self.closed = False
+
+
+  def Execute(self, input_data, timeout=None):
+    """Run 1 request on a free worker.  Returns tuple: status (int), output (bytes), error (bytes), the same as utility.ExecuteCommand()"""
+    with self.slots:
+      with self.lock:
+        worker = self.idle.pop() if self.idle else None
+
+      try:
+        if worker is None or not worker.IsAlive():
+          worker = PersistentWorker(self.command, self.cwd)
+
+        output = worker.Request(input_data, timeout=timeout)
+        (status, error) = GetReplyStatus(output)
+
+      except Exception as e:
+        LOG.error(f'Command Pool: Request failed, replacing worker: Command: {self.command}  Error: {e}')
+        if worker: worker.Stop(kill=True)
+        return (1, b'', str(e).encode())
+
+      # Put the worker back for the next request, unless it has served enough, or we were shut down
+      with self.lock:
+        is_retired = worker.requests >= self.max_requests or self.closed
+        if not is_retired:
+          self.idle.append(worker)
+
+      if is_retired:
+        worker.Stop()
+
+    return (status, output, error)
+
+
+  def Shutdown(self):
+    """Stop all the idle workers.  Workers running a request are stopped when it finishes"""
+    with self.lock:
+      self.closed = True
+      workers = self.idle
+      self.idle = []
+
+    for worker in workers:
+      worker.Stop()
+
+
+def GetRemaining(timeout_time, timeout):
+  """Returns seconds left until `timeout_time`, or None if we dont have one.  Raises TimeoutError once it has passed"""
+  if timeout_time is None: return None
+
+  remaining = timeout_time - time.time()
+  if remaining <= 0:
+    raise TimeoutError(f'Timed out after {timeout}s')
+
+  return remaining
+
+
+def GetReplyStatus(output):
+  """Returns tuple: status (int), error (bytes), from the reply's REPLY_ERROR_FIELD and REPLY_STATUS_FIELD.  Replies without them succeeded"""
+  # Only parse replies that could have them, the caller parses the output anyway
+  if not output.startswith(b'{') or (REPLY_ERROR_FIELD.encode() not in output and REPLY_STATUS_FIELD.encode() not in output):
+    return (0, b'')
+
+  try:
+    reply = codec.Loads(output)
+  except codec.DecodeError:
+    return (0, b'')
+
+  error = reply.get(REPLY_ERROR_FIELD, None)
+  status = reply.get(REPLY_STATUS_FIELD, None)
+
+  if status is None:
+    status = 1 if error else 0
+
+  return (int(status), str(error).encode() if error else b'')
+
+
+def Execute(command, cwd, input_data, timeout=None, pool_size=DEFAULT_POOL_SIZE, max_requests=DEFAULT_MAX_REQUESTS):
+  """Run a persistent command with this input, on its pool, starting the pool if needed.  Returns tuple: status (int), output (bytes), error (bytes)"""
+  key = (command, cwd)
+  replaced_pool = None
+
+  with LOCK_POOLS:
+    # The command's settings changed, so start a new pool with them.  The old one finishes its running requests
+    if key in POOLS and (POOLS[key].size != pool_size or POOLS[key].max_requests != max_requests):
+      replaced_pool = POOLS.pop(key)
+
+    if key not in POOLS:
+      POOLS[key] = CommandPool(command, cwd, size=pool_size, max_requests=max_requests)
+    pool = POOLS[key]
+
+  if replaced_pool:
+    LOG.info(f'Command Pool: Settings changed, replacing pool: Command: {command}  Pool Size: {pool_size}  Max Requests: {max_requests}')
+    replaced_pool.Shutdown()
+
+  return pool.Execute(input_data, timeout=timeout)
+
+
+def Shutdown():
+  """Stop every pool's workers"""
+  with LOCK_POOLS:
+    pools = list(POOLS.values())
+    POOLS.clear()
+
+  for pool in pools:
+    pool.Shutdown()
@@ -0,0 +1,134 @@
+"""
+Dependency Graph: Which commands use which other commands' cache keys as `input`, compiled once per Bundle version, like the Key Table.
+
+Nodes are command cache keys (`schedule.period.<name>`, `execute.api.<name>`), and an edge goes from each key in a command's `input` to the
+command.  Only commands with `recompute: true` are rerun when their inputs change, see dependency_manager.
+
+Input keys that are formatted from the request (`execute.api.site_user.{request.username}`) cant be known until a request has them, so they
+arent edges.  A command reading its own last output (`existing`) isnt an edge either.  Commands in a cycle are never recomputed.
+
+Reruns have no request, and a command that reads its own output would change its input with every rerun, so `recompute: true` commands with
+request input, or their own key as input, are logged and never recomputed.
+"""
+
+
+import graphlib
+import hashlib
+
+from logic.log import LOG
+
+from logic import codec
+
+
+# Fields every payload gets on each run, so they arent part of its content hash
+VOLATILE_FIELDS = ['__time']
+
+
+class DependencyGraph():
+  """Dependencies between the commands of 1 version of a Bundle"""
+
+  def __init__(self, bundle_info):
+    # Command specs by cache key
+    self.commands = {}
+
+    for (period_key, period_data) in bundle_info.get('schedule', {}).get('period', {}).items():
+      self.commands[f'schedule.period.{period_key}'] = period_data
+
+    for (api_key, api_data) in bundle_info.get('execute', {}).get('api', {}).items():
+      self.commands[f'execute.api.{api_key}'] = api_data
+
+    # Commands each command reads as input:  {cache_key: set of cache_keys}
+    self.inputs = {}
+
+    # Commands that read each command as input:  {cache_key: set of cache_keys}
+    self.downstream = {}
+
+    for (cache_key, command) in self.commands.items():
+      self.inputs[cache_key] = set()
+
+      for input_key in (command.get('input', None) or {}):
+        if input_key == cache_key or input_key not in self.commands: continue
+
+        self.inputs[cache_key].add(input_key)
+        self.downstream.setdefault(input_key, set()).add(cache_key)
+
+    # Commands with `recompute: true` that cant be, see GetRecomputeProblem()
+    self.unrecomputable = set()
+
+    for (cache_key, command) in self.commands.items():
+      if not command.get('recompute', False): continue
+
+      problem = GetRecomputeProblem(cache_key, command)
+      if problem:
+        LOG.error(f'Dependency Graph: Command cant be recomputed, it wont be: {cache_key}  Problem: {problem}')
+        self.unrecomputable.add(cache_key)
+
+    # Every command in dependency order, upstream first.  Commands in a cycle are left out
+    self.order = GetTopologicalOrder(self.inputs)
+    self.positions = {cache_key: position for (position, cache_key) in enumerate(self.order)}
+
+    # Keys that have recomputed commands downstream, so finishing commands can check with a set lookup
+    self.upstream_keys = set(cache_key for cache_key in self.downstream if self.GetDownstream([cache_key]))
+
+
+  def IsRecomputed(self, cache_key):
+    """Returns boolean, True if this command is rerun when its inputs change"""
+    return cache_key in self.positions and bool(self.commands[cache_key].get('recompute', False)) and cache_key not in self.unrecomputable
+
+
+  def HasDownstream(self, cache_key):
+    """Returns boolean, True if a recomputed command reads this key, directly or through other commands"""
+    return cache_key in self.upstream_keys
+
+
+  def GetDownstream(self, cache_keys):
+    """Returns list of the recomputed commands that read these keys, directly or through other commands, upstream first"""
+    found = set()
+    pending = list(cache_keys)
+
+    while pending:
+      for downstream_key in self.downstream.get(pending.pop(), ()):
+        if downstream_key not in found:
+          found.add(downstream_key)
+          pending.append(downstream_key)
+
+    return sorted([cache_key for cache_key in found if self.IsRecomputed(cache_key)], key=lambda cache_key: self.positions[cache_key])
+
+
+def GetRecomputeProblem(cache_key, command):
+  """Returns string, why this command cant be rerun by the Dependency Manager, or None if it can"""
+  for input_key in (command.get('input', None) or {}):
+    if input_key == cache_key:
+      return 'It reads its own output, so every rerun would change its input'
+
+    if input_key == 'request' or '{' in input_key:
+      return f'Its input needs a request, and reruns dont have one: {input_key}'
+
+  return None
+
+
+def GetTopologicalOrder(inputs):
+  """Returns list of keys, each after all of its inputs.  Keys in a cycle are logged and left out, along with everything after them"""
+  sorter = graphlib.TopologicalSorter(inputs)
+
+  # We still get everything before the cycle
+  try:
+    sorter.prepare()
+  except graphlib.CycleError as e:
+    LOG.error(f'Dependency Graph: Commands input each other in a cycle, they wont be recomputed: {e.args[1]}')
+
+  order = []
+  while sorter.is_active():
+    ready = sorted(sorter.get_ready())
+    order += ready
+    sorter.done(*ready)
+
+  return order
+
+
+def GetContentHash(payload):
+  """Returns bytes, the hash of this payload's content, ignoring key order and VOLATILE_FIELDS, so we can tell if a run changed anything"""
+  if type(payload) == dict:
+    payload = {key: value for (key, value) in payload.items() if key not in VOLATILE_FIELDS}
+
+  return hashlib.blake2b(codec.Dumps(payload, default=str, sort_keys=True), digest_size=16).digest()
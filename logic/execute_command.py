@@ -1,27 +1,288 @@
 """
 Execute Command: One module to handle the most important thing we do, generically
+
+Jobs run commands from their own threads with ExecuteCommand().  HTTP requests run them on the event loop with ExecuteCommandAsync(), which waits
+on the subprocess without blocking the loop, and runs the cache reads and writes around it in a thread, so other requests keep being served.
 """
 
 
-import json
+import asyncio
+import hashlib
+import os
+import threading
 import time
 import pprint
 
 from logic import utility
+from logic import codec
+from logic import command_pool
+from logic import cache_replica
+from logic import zygote
+from logic import single_flight
+from logic import memoize
+from logic import file_lock
+from logic import thread_manager
 
 from logic.log import LOG
 
 
+# Identical runs in flight at once, from requests and jobs, share 1 execution.  Keyed on tuple: (bundle_name, set_cache_key, input hash), see GetFlightKey()
+SINGLE_FLIGHT = single_flight.SingleFlight()
+
+# Recent results of commands with `memoize: {ttl: 30s}`, so the same input within the TTL doesnt run again.  Same keys as SINGLE_FLIGHT
+MEMO = memoize.Memo()
+
+# Commands whose `input_path` has no `{uuid}` all share 1 input file, so jobs and requests, in every worker process, run them 1 at a time per
+#   path:  {input_path: file_lock.FileLock}
+INPUT_PATH_LOCKS = {}
+
+# Only 1 FileLock is created per path, so all our threads wait on the same one
+INPUT_PATH_LOCKS_LOCK = threading.Lock()
+
+# How a command gets its input, with `input_mode`.  `file` writes `input_path`, `stdin` pipes the JSON to its stdin, and `memfd` writes it to an
+#   in-memory file, and puts that file's path in place of `input_path` in the command.  Default: file
+INPUT_MODES = ['file', 'stdin', 'memfd']
+DEFAULT_INPUT_MODE = 'file'
+
+
+class CommandInput():
+  """The input for 1 run of a command.  Close() it when the command is done, which removes its file"""
+
+  def __init__(self, data=None, stdin=None, path=None, memfd=None):
+    # Input dict, sent as the request for persistent commands
+    self.data = data
+
+    # Bytes for the command's stdin
+    self.stdin = stdin
+
+    # Temporary `input_path` file we wrote, to remove, or our in-memory file descriptor, to close
+    self.path = path
+    self.memfd = memfd
+
+
+  def Close(self):
+    """Remove our file, or close our in-memory file.  Safe to call more than once"""
+    if self.path:
+      (success, reason) = utility.RemoveFilePath(self.path)
+      if not success:
+        LOG.error(f'Failed to remove command input file: {reason}')
+      self.path = None
+
+    if self.memfd is not None:
+      os.close(self.memfd)
+      self.memfd = None
+
+
 def ExecuteCommand(config, command, bundle_name, bundle, set_cache_key, update_data=None):
-  """Execute a command"""
-  # Ensure we have unique input paths
-  uuid = utility.GetUUID()
+  """Execute a command.  If the same command with the same input is already running, we get its result instead of running it again"""
+  input_data = GetInputData(config, command, bundle_name, update_data)
+  flight_key = GetFlightKey(bundle_name, set_cache_key, command, input_data)
+
+  payload = GetMemoized(command, flight_key)
+  if payload is not None:
+    return payload
+
+  def Execute():
+    input_lock = GetInputPathLock(command)
+
+    # Hold the input file from writing it until the command has read it
+    if input_lock: input_lock.acquire()
+    try:
+      (command_unique, running_cwd, timeout, command_input) = PrepareCommand(config, command, bundle, input_data)
+
+      # Execute the command.  Output stays bytes, it goes straight to the JSON decoder
+      try:
+        (status, output, error) = RunCommand(command, command_unique, running_cwd, timeout, command_input)
+      finally:
+        command_input.Close()
+
+    finally:
+      if input_lock: input_lock.release()
+
+    payload = FinishCommand(config, command_unique, bundle_name, set_cache_key, status, output, error)
+    SetMemoized(command, flight_key, status, output, payload)
+
+    return payload
+
+  return SINGLE_FLIGHT.Do(flight_key, Execute)
+
+
+async def ExecuteCommandAsync(config, command, bundle_name, bundle, set_cache_key, update_data=None):
+  """Execute a command, from the event loop.  Same as ExecuteCommand(), but only the subprocess runs on the loop, everything else is in a thread"""
+  input_data = await asyncio.to_thread(GetInputData, config, command, bundle_name, update_data)
+  flight_key = GetFlightKey(bundle_name, set_cache_key, command, input_data)
+
+  payload = GetMemoized(command, flight_key)
+  if payload is not None:
+    return payload
+
+  async def Execute():
+    return await _ExecuteCommandAsync(config, command, bundle_name, bundle, set_cache_key, input_data, flight_key)
+
+  return await SINGLE_FLIGHT.DoAsync(flight_key, Execute)
+
+
+async def _ExecuteCommandAsync(config, command, bundle_name, bundle, set_cache_key, input_data, flight_key):
+  """Run the command for ExecuteCommandAsync(), once we know we are the only run of it in flight"""
+  input_lock = GetInputPathLock(command)
+
+  # Hold the input file from writing it until the command has read it.  The same lock as jobs take, so we wait for it in a thread
+  if input_lock: await AcquireLockAsync(input_lock)
+  try:
+    (command_unique, running_cwd, timeout, command_input) = await asyncio.to_thread(PrepareCommand, config, command, bundle, input_data)
+
+    try:
+      # Persistent workers and zygotes block while they wait on their command, so they run in a thread too
+      if command.get('mode', None) in ('persistent', 'zygote'):
+        (status, output, error) = await asyncio.to_thread(RunCommand, command, command_unique, running_cwd, timeout, command_input)
+      else:
+        (status, output, error) = await utility.ExecuteCommandAsync(command_unique, input=command_input.stdin, set_cwd=running_cwd, timeout=timeout)
+    finally:
+      command_input.Close()
+
+  finally:
+    if input_lock: input_lock.release()
+
+  payload = await asyncio.to_thread(FinishCommand, config, command_unique, bundle_name, set_cache_key, status, output, error)
+  SetMemoized(command, flight_key, status, output, payload)
+
+  return payload
+
+
+def GetInputPathLock(command):
+  """Returns the lock for this command's shared `input_path`, or None if its runs dont share an input file"""
+  if 'input' not in command or 'input_path' not in command or '{uuid}' in command['input_path'] or GetInputMode(command) != 'file':
+    return None
+
+  with INPUT_PATH_LOCKS_LOCK:
+    if command['input_path'] not in INPUT_PATH_LOCKS:
+      INPUT_PATH_LOCKS[command['input_path']] = file_lock.FileLock(command['input_path'])
+
+    return INPUT_PATH_LOCKS[command['input_path']]
+
 
-  # If this doesnt get set, then we dont need to remove the temporary file
-  command_input_path = None
+async def AcquireLockAsync(lock):
+  """Acquire a threading.Lock or FileLock without blocking the event loop.  If we are cancelled while waiting, it is released as soon as we get it"""
+  if lock.acquire(blocking=False): return
 
-  # Create our output file, if specified
-  if 'input' in command and 'input_path' in command:
+  acquire = asyncio.ensure_future(asyncio.to_thread(lock.acquire))
+  try:
+    await asyncio.shield(acquire)
+  except asyncio.CancelledError:
+    acquire.add_done_callback(lambda _: lock.release())
+    raise
+
+
+def RunCommand(command, command_unique, running_cwd, timeout, command_input):
+  """Run the command by its `mode`, blocking until it finishes.  Returns tuple: status (int), output (bytes), error (bytes)"""
+  mode = command.get('mode', None)
+
+  if mode == 'persistent':
+    return ExecutePersistent(command, command_unique, running_cwd, timeout, command_input.data)
+
+  # Forked from a pre-warmed Python process, see zygote
+  elif mode == 'zygote':
+    return zygote.Execute(command_unique, running_cwd, preload=command.get('preload', []), input=command_input.stdin, timeout=timeout)
+
+  return utility.ExecuteCommand(command_unique, input=command_input.stdin, set_cwd=running_cwd, text=False, timeout=timeout)
+
+
+def GetInputMode(command):
+  """Returns how this command gets its input, one of INPUT_MODES.  Persistent commands always get it as their request, so they return None"""
+  if IsPersistent(command): return None
+
+  input_mode = command.get('input_mode', DEFAULT_INPUT_MODE)
+  if input_mode not in INPUT_MODES:
+    LOG.error(f'''Unknown input_mode, using {DEFAULT_INPUT_MODE}: {input_mode}  Command: {command['command']}''')
+    return DEFAULT_INPUT_MODE
+
+  # In-memory files are Linux only, otherwise we fall back to a file
+  if input_mode == 'memfd' and not hasattr(os, 'memfd_create'):
+    return DEFAULT_INPUT_MODE
+
+  return input_mode
+
+
+def WriteCommandInput(command, command_text, input_data, uuid):
+  """Returns tuple (CommandInput, command_text):  The input for this run, by `input_mode`.  With `memfd` the command text gets the in-memory file's path"""
+  input_mode = GetInputMode(command)
+
+  if input_data is None or input_mode is None:
+    return (CommandInput(data=input_data), command_text)
+
+  if input_mode == 'stdin':
+    return (CommandInput(data=input_data, stdin=codec.Dumps(input_data)), command_text)
+
+  if input_mode == 'memfd':
+    memfd = os.memfd_create('opsland_input')
+    os.write(memfd, codec.Dumps(input_data))
+
+    # Our /proc path to the file, which the command opens like any file, even a zygote child, without inheriting our descriptor
+    command_text = command_text.replace(command['input_path'], f'/proc/{os.getpid()}/fd/{memfd}')
+
+    return (CommandInput(data=input_data, memfd=memfd), command_text)
+
+  command_input_path = command['input_path'].replace('{uuid}', uuid)
+  utility.SaveJson(command_input_path, input_data)
+
+  # Only unique files are removed.  A shared `input_path` is rewritten every run, and another run may be about to read it
+  return (CommandInput(data=input_data, path=command_input_path if '{uuid}' in command['input_path'] else None), command_text)
+
+
+def IsPersistent(command):
+  """Returns boolean, True if this command runs on long lived workers.  See command_pool"""
+  return command.get('mode', None) == 'persistent'
+
+
+def ExecutePersistent(command, command_unique, running_cwd, timeout, input_data):
+  """Run a `mode: persistent` command on its worker pool, sending `input_data` as its request.  Returns the same tuple as utility.ExecuteCommand()"""
+  pool_size = int(command.get('pool_size', command_pool.DEFAULT_POOL_SIZE))
+  max_requests = int(command.get('max_requests', command_pool.DEFAULT_MAX_REQUESTS))
+
+  return command_pool.Execute(command_unique, running_cwd, input_data if input_data is not None else {}, timeout=timeout, pool_size=pool_size, max_requests=max_requests)
+
+
+def GetFlightKey(bundle_name, set_cache_key, command, input_data):
+  """Returns the key for SINGLE_FLIGHT and MEMO.  Runs of the same command line with the same input JSON, ignoring key order and the command's
+  `memo_ignore` fields, are the same run"""
+  # Requests pass their whole page payload, which has the client's headers and session, so by default clients only share runs with themselves.
+  #   Commands whose result doesnt depend on them opt in to sharing with:  `memo_ignore: [header, session]`
+  ignore_fields = command.get('memo_ignore', None)
+  if ignore_fields and type(input_data) == dict:
+    input_data = {key: value for (key, value) in input_data.items() if key not in ignore_fields}
+
+  input_hash = hashlib.blake2b(codec.Dumps([command['command'], input_data], default=str, sort_keys=True), digest_size=16).digest()
+
+  return (bundle_name, set_cache_key, input_hash)
+
+
+def GetMemoized(command, flight_key):
+  """Returns the memoized payload for this run, or None if the command isnt memoized or we dont have a fresh result"""
+  if not command.get('memoize', None):
+    return None
+
+  payload = MEMO.Get(flight_key)
+  if payload is not None:
+    LOG.debug(f'Memoized: {flight_key[0]}: {flight_key[1]}')
+
+  return payload
+
+
+def SetMemoized(command, flight_key, status, output, payload):
+  """Memoize a successful run, if the command has `memoize: {ttl}`.  Failures are never memoized, so they run again"""
+  if not command.get('memoize', None) or status != 0 or not payload:
+    return
+
+  ttl = utility.ConvertStringDurationToSeconds(command['memoize']['ttl'])
+  MEMO.Set(flight_key, payload, len(output), ttl)
+
+
+def GetInputData(config, command, bundle_name, update_data=None):
+  """Returns the command's input dict, assembled from `update_data` and the cache, or None if it takes no input"""
+  input_data = None
+
+  # Create our input, if specified.  Only `file` and `memfd` need an `input_path`
+  if 'input' in command and ('input_path' in command or GetInputMode(command) in (None, 'stdin')):
     input_data = {}
     if update_data:
       input_data.update(update_data)
@@ -45,14 +306,23 @@ def ExecuteCommand(config, command, bundle_name, bundle, set_cache_key, update_d
         else:
           LOG.error(f'Failed to Get Spec Key: {spec_key}  Field List: {field_list}  -- Setting to None')
           input_data[spec_key] = None
-    
 
-    command_input_path = command['input_path'].replace('{uuid}', uuid)
-    utility.SaveJson(command_input_path, input_data)
+  return input_data
 
-    # LOG.debug(f'''Command Input Path: {command_input_path}''')
 
-  command_unique = command['command'].replace('{uuid}', uuid)
+def PrepareCommand(config, command, bundle, input_data):
+  """Returns tuple: command (str), cwd (str), timeout (float or None), input (CommandInput).
+
+  The input is given to the command by its `input_mode`, see WriteCommandInput().  Close() the input when the command is done.
+  """
+  # Ensure we have unique input paths
+  uuid = utility.GetUUID()
+
+  (command_input, command_unique) = WriteCommandInput(command, command['command'], input_data, uuid)
+
+  # Persistent commands are started once and reused, so they cant have a unique `{uuid}`
+  if not IsPersistent(command):
+    command_unique = command_unique.replace('{uuid}', uuid)
 
   LOG.info(f'''Execute Command Actual: {command_unique}''')
 
@@ -62,22 +332,26 @@ def ExecuteCommand(config, command, bundle_name, bundle, set_cache_key, update_d
   if 'dir' in command:
     running_cwd = command['dir']
   
-  # Execute the command
-  (status, output, error) = utility.ExecuteCommand(command_unique, set_cwd=running_cwd)
+  # A `timeout` kills the command, so a hung command doesnt hold its job slot forever
+  timeout = utility.ConvertStringDurationToSeconds(command['timeout']) if 'timeout' in command else None
+
+  return (command_unique, running_cwd, timeout, command_input)
 
 
+def FinishCommand(config, command_unique, bundle_name, set_cache_key, status, output, error):
+  """Parse the command's output, and cache it if the command succeeded.  Returns the payload, empty dict on failure"""
   if status == 0:
     # LOG.debug(f'Output: {output}')
     pass
   else:
-    LOG.debug(f'Status: {status}  Error: {error}')
+    LOG.debug(f'''Status: {status}  Error: {error.decode(errors='replace')}''')
 
   # If we got any output, parse it
   if output:
     try:
-      payload = json.loads(output)
-    except json.decoder.JSONDecodeError as e:
-      LOG.info(f'Output cant be parsed.  Returning empty dict: Command: {command_unique}\n\nOutput: {output}\n\nException: {e}\n\n')
+      payload = codec.Loads(output)
+    except codec.DecodeError as e:
+      LOG.info(f'''Output cant be parsed.  Returning empty dict: Command: {command_unique}\n\nOutput: {output.decode(errors='replace')}\n\nException: {e}\n\n''')
       payload = {}
 
   # Else, we didnt, so just give an empty string
@@ -99,8 +373,10 @@ def ExecuteCommand(config, command, bundle_name, bundle, set_cache_key, update_d
   if status == 0 and payload:
     config.cache.Set(bundle_name, set_cache_key, payload)
 
-  # # Remove the temp file
-  # if command_input_path:
-  #   utility.RemoveFilePath(command_input_path)
+    # If this changed, recompute the commands that take it as input.  Worker processes tell the leader, which runs the Dependency Manager
+    if thread_manager.DEPENDENCY_MANAGER:
+      thread_manager.DEPENDENCY_MANAGER.Changed(bundle_name, set_cache_key, payload)
+    elif type(config.cache) == cache_replica.CacheReplica:
+      config.cache.Changed(bundle_name, set_cache_key, payload)
 
   return payload
@@ -0,0 +1,77 @@
+"""
+File Lock: A lock on a path that holds across threads and processes.
+
+With `--workers`, every worker process runs commands, so a threading.Lock alone only keeps 1 process's threads apart.  A FileLock also takes an
+`fcntl.flock()` on `<path>.lock`, which every process opening that file shares, and the kernel releases it if the process dies holding it.
+It has the same acquire() and release() as a threading.Lock, so it can be waited on from a thread the same way.
+"""
+
+
+import fcntl
+import os
+import threading
+
+
+# Suffix of the file we lock, next to the path it guards.  The path itself is rewritten while locked, so we cant lock it
+LOCK_SUFFIX = '.lock'
+
+
+class FileLock():
+  """Exclusive lock on a path, for threads in this process with a threading.Lock, and for other processes with flock()"""
+
+  def __init__(self, path):
+    self.path = os.path.expanduser(path) + LOCK_SUFFIX
+
+    # Threads in this process wait here, so only 1 of them at a time holds the file open and locked
+    self.lock = threading.Lock()
+
+    # Our open lock file, while we hold the lock
+    self.fd = None
+
+
+  def acquire(self, blocking=True):
+    """Returns True once we hold the lock.  If not `blocking`, returns False instead of waiting"""
+    if not self.lock.acquire(blocking=blocking):
+      return False
+
+    try:
+      os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+      fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+    except BaseException:
+      self.lock.release()
+      raise
+
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+      os.close(fd)
+      self.lock.release()
+      return False
+    except BaseException:
+      os.close(fd)
+      self.lock.release()
+      raise
+
+    self.fd = fd
+    return True
+
+
+  def release(self):
+    """Release the lock, for the other threads and processes"""
+    fd = self.fd
+    self.fd = None
+
+    # Closing the file drops our flock()
+    try:
+      os.close(fd)
+    finally:
+      self.lock.release()
+
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+
+  def __exit__(self, *args):
+    self.release()
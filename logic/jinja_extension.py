@@ -2,17 +2,17 @@
 Jinja Extensions
 """
 
-import json
-
 from logic.log import LOG
 
+from logic import codec
+
 
 def from_json(text_json):
   """Converts a JSON string to a Python object."""
   try:
-    return json.loads(text_json)
+    return codec.Loads(text_json)
   
-  except json.JSONDecodeError as e:
+  except codec.DecodeError as e:
     return f"Invalid JSON: {e}"
 
 
@@ -0,0 +1,142 @@
+"""
+Key Index: Sorted index of the cache keys in a Bundle silo, so glob lookups only walk the keys that could possibly match.
+
+Cache keys are dotted and hierarchical (ex: `execute.api.site_user.{username}`), so nearly every glob has a literal prefix.  We binary search
+to the start of that prefix and only regex test the keys inside the range, instead of every key in the bundle.
+
+The sorted key list is copy-on-write: a new list is built and the reference swapped, so readers can walk a consistent list without a lock.
+Writers dont build it.  Added and removed keys go into pending sets in O(1), and the next glob merges them into a new sorted list, so a
+burst of new keys (loading a Bundle, or many new `unique_key` entries) costs 1 sort, not a copy per key.  Every key added or removed is seen
+by the next glob that starts after it.
+"""
+
+
+import bisect
+import functools
+import re
+import threading
+
+from logic import utility
+
+
+# Any of these characters ends the literal prefix of a glob pattern
+GLOB_SPECIAL_CHARS = '*?['
+
+# How many compiled glob patterns we keep around.  Glob patterns come from the Bundle specs, so there are not many distinct ones
+GLOB_CACHE_SIZE = 1024
+
+
+class KeyIndex():
+  """Sorted list of keys for a single Bundle silo.  Writers must hold the Bundle lock, readers dont need any lock."""
+
+  def __init__(self):
+    # Sorted so we can bisect to prefix ranges.  Never changed in place, only replaced, so readers always have a consistent list
+    self.keys = []
+
+    # Every key in the index, including pending ones.  Only used by writers
+    self.key_set = set()
+
+    # Keys added that arent in `keys` yet, and keys removed that still are.  Merged into `keys` by the next reader, see _GetSortedKeys()
+    self.added = set()
+    self.removed = set()
+
+    # Protects `added`, `removed` and publishing `keys`, between writers and the reader that merges them.  Only held for O(1), or the merge
+    self.lock = threading.Lock()
+
+
+  def __len__(self):
+    return len(self.key_set)
+
+
+  def Add(self, key):
+    """Add a key to the index, if it isnt already there"""
+    if key in self.key_set: return
+
+    self.key_set.add(key)
+
+    with self.lock:
+      # Removed since the last merge, so it is still in the sorted list
+      if key in self.removed:
+        self.removed.discard(key)
+      else:
+        self.added.add(key)
+
+
+  def Remove(self, key):
+    """Remove a key from the index, if it is there"""
+    if key not in self.key_set: return
+
+    self.key_set.discard(key)
+
+    with self.lock:
+      # Added since the last merge, so it isnt in the sorted list yet
+      if key in self.added:
+        self.added.discard(key)
+      else:
+        self.removed.add(key)
+
+
+  def AddMany(self, keys):
+    """Add many keys.  They are sorted in with 1 merge, on the next glob"""
+    for key in keys:
+      self.Add(key)
+
+
+  def _GetSortedKeys(self):
+    """Returns the sorted list of keys, merging in any added or removed since the last call"""
+    if not self.added and not self.removed:
+      return self.keys
+
+    with self.lock:
+      # Another reader may have merged them while we waited
+      if self.added or self.removed:
+        keys = sorted(self.keys + list(self.added)) if self.added else self.keys
+        if self.removed:
+          keys = [key for key in keys if key not in self.removed]
+
+        # Publish in one reference swap
+        self.keys = keys
+        self.added = set()
+        self.removed = set()
+
+      return self.keys
+
+
+  def GetPrefixRange(self, prefix):
+    """Returns a list of all keys that start with `prefix`, in sorted order"""
+    # Take our snapshot of the sorted keys once, writers may publish a new list while we walk this one
+    sorted_keys = self._GetSortedKeys()
+
+    keys = []
+
+    index = bisect.bisect_left(sorted_keys, prefix)
+    while index < len(sorted_keys):
+      key = sorted_keys[index]
+      if not key.startswith(prefix): break
+
+      keys.append(key)
+      index += 1
+
+    return keys
+
+
+  def Match(self, pattern):
+    """Returns a list of all keys that match the glob `pattern`.  Only the keys inside the pattern's literal prefix range are tested."""
+    key_regex_compiled = CompileGlob(pattern)
+
+    return [key for key in self.GetPrefixRange(GetGlobPrefix(pattern)) if key_regex_compiled.match(key)]
+
+
+def GetGlobPrefix(pattern):
+  """Returns the literal prefix of the glob `pattern`, which is everything before the first special character"""
+  for (index, char) in enumerate(pattern):
+    if char in GLOB_SPECIAL_CHARS:
+      return pattern[:index]
+
+  return pattern
+
+
+@functools.lru_cache(maxsize=GLOB_CACHE_SIZE)
+def CompileGlob(pattern):
+  """Returns the compiled regex for this glob `pattern`.  Cached, because we see the same patterns on every request."""
+  return re.compile(utility.GlobToRegex(pattern))
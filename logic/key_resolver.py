@@ -0,0 +1,83 @@
+"""
+Key Resolver: Each loaded Bundle is compiled once into a Key Table, which resolves a cache key to its spec with a dict lookup.
+
+Cache keys are strictly named from the Bundle spec (`schedule.period.<name>`, `execute.api.<name>`, `static.<name>`), so we can build every
+base key up front.  `unique_key` entries (`execute.api.<name>.<unique>`) resolve by looking up their first 3 dotted sections.
+"""
+
+
+import re
+
+
+# Only `execute.api.` keys can have a `unique_key` suffix
+UNIQUE_KEY_PREFIX = 'execute.api.'
+
+
+class KeyResolution():
+  """Everything Set() needs to know about a base cache key"""
+
+  def __init__(self, cache_info, base_cache_key):
+    self.cache_info = cache_info
+    self.base_cache_key = base_cache_key
+
+    # Store type, `single` is the default if nothing is specified
+    self.store = cache_info.get('store', 'single')
+
+    # Precompile the `unique_key` format into the field names it uses
+    self.unique_key = cache_info.get('unique_key', None)
+    self.unique_key_fields = re.findall(r'{([^{}]*)}', self.unique_key) if self.unique_key else []
+
+
+  def FormatUniqueKey(self, value):
+    """Returns the `unique_key` formatted from the `value` dict.  Same as utility.FormatTextFromDictKeys(), but only looks at the fields we use"""
+    text = self.unique_key
+
+    for field in self.unique_key_fields:
+      if field in value:
+        # Must enforce replace gets a string value
+        text = text.replace(f'{{{field}}}', str(value[field]))
+
+    return text
+
+
+class KeyTable():
+  """Key resolution table for 1 version of a Bundle"""
+
+  def __init__(self, bundle_info, version=0):
+    self.bundle_info = bundle_info
+    self.version = version
+
+    # Base cache key to KeyResolution
+    self.entries = {}
+
+    for (period_key, period_data) in bundle_info.get('schedule', {}).get('period', {}).items():
+      self._AddEntry(f'schedule.period.{period_key}', period_data)
+
+    for (api_key, api_data) in bundle_info.get('execute', {}).get('api', {}).items():
+      self._AddEntry(f'execute.api.{api_key}', api_data)
+
+    for (static_key, static_data) in bundle_info.get('static', {}).items():
+      self._AddEntry(f'static.{static_key}', static_data)
+
+
+  def _AddEntry(self, base_cache_key, cache_info):
+    """Add a base cache key.  Specs that arent dicts (ex: `static` paths) still resolve, but have no options"""
+    if type(cache_info) != dict:
+      cache_info = {'path': cache_info}
+
+    self.entries[base_cache_key] = KeyResolution(cache_info, base_cache_key)
+
+
+  def Resolve(self, cache_key):
+    """Returns the KeyResolution for this cache key, or None if the Bundle doesnt have a spec for it"""
+    resolution = self.entries.get(cache_key, None)
+    if resolution is not None:
+      return resolution
+
+    # Check if this is a `unique_key` by splitting off the first dotted section after the prefix and testing it
+    if cache_key.startswith(UNIQUE_KEY_PREFIX):
+      dot_index = cache_key.find('.', len(UNIQUE_KEY_PREFIX))
+      if dot_index != -1:
+        return self.entries.get(cache_key[:dot_index], None)
+
+    return None
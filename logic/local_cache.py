@@ -7,24 +7,21 @@ Simple library to cache data, and check if the cache exists.  We use JSON to cac
 
 import os
 import sys
-import json
 import time
 import pprint
 
+from logic import codec
+
 
 def SaveJson(path, data):
-    with open(path, 'w') as fp:
-        content = json.dumps(data)
-        fp.write(content)
+    codec.Save(path, data)
 
 
 def Get(path_raw):
     path = os.path.expanduser(path_raw)
 
     try:
-        with open(path) as fp:
-            wrapped_data = json.load(fp)
-            return wrapped_data
+        return codec.Load(path)
 
     except FileNotFoundError as e:
         return None
@@ -39,15 +36,20 @@ def GetData(path):
         return result
 
 
+def EnsureCacheDirectory(path):
+    """Ensure the directory for this cache path exists"""
+    dir_path = os.path.dirname(path)
+    if not os.path.isdir(dir_path):
+        print(f'Creating cache directory: {dir_path}')
+        os.makedirs(dir_path, exist_ok=True)
+
+
 def Set(path_raw, data):
     """Put the data in this cache, at the path specified.  Will save the time and time cache was cleared"""
     path = os.path.expanduser(path_raw)
 
     # Ensure the directory exists
-    dir_path = os.path.dirname(path)
-    if not os.path.isdir(dir_path):
-        print(f'Creating cache directory: {dir_path}')
-        os.makedirs(dir_path)
+    EnsureCacheDirectory(path)
 
     # Wrap our data so it can be tested as cache, and marked as cleared
     wrapped_data = {
@@ -59,6 +61,18 @@ def Set(path_raw, data):
     SaveJson(path ,wrapped_data)
 
 
+def SetJson(path_raw, data_json):
+    """Same as Set(), but the data is already serialized to JSON bytes.  Lets the caller hash the content without serializing it twice."""
+    path = os.path.expanduser(path_raw)
+
+    # Ensure the directory exists
+    EnsureCacheDirectory(path)
+
+    # Wrap our data the same way as Set(), but as bytes
+    with open(path, 'wb') as fp:
+        fp.write(b'{"time":%r,"cleared":0,"data":%b}' % (time.time(), data_json))
+
+
 def Clear(path_raw, destroy=False):
     """Clear the cache path, we will just delete this file"""
     path = os.path.expanduser(path_raw)
@@ -126,9 +140,9 @@ def Main(args=None):
         print('Enter 1 line of JSON data now from STDIN:')
         raw_data = input()
         try:
-            data = json.loads(raw_data)
+            data = codec.Loads(raw_data)
             Set(path, data)
-        except json.decoder.JSONDecodeError as e:
+        except codec.DecodeError as e:
             Error(f'Input JSON data is invalid: {e}')
 
     # Clear the cache (set cleared time)
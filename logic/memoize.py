@@ -0,0 +1,100 @@
+"""
+Memoize: Recent command results, for commands with `memoize: {ttl: 30s}` that are pure functions of their input.
+
+A memoized command that runs again with the same input JSON within `ttl` gets the last result, without running.  Results are keyed like the
+Single Flight:  (bundle_name, set_cache_key, input hash), where the input includes the client's headers and session, unless the command lists
+them in `memo_ignore`.  Only successful runs are kept.
+
+Memory is bounded by entries and by bytes (the size of the command's output), and the least recently used results are dropped first.  Each
+process has its own, so with `--workers` every worker memoizes separately.
+"""
+
+
+import collections
+import threading
+import time
+
+
+# Most results we keep, across all commands
+DEFAULT_MAX_ENTRIES = 4096
+
+# Most bytes of command output we keep, across all commands.  A single result bigger than this isnt kept
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class Memo():
+  """Results with a TTL, in LRU order, with hit and miss counts per command"""
+
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+
+    # Results, least recently used first:  {key: (expire_time, size, payload)}
+    self.entries = collections.OrderedDict()
+    self.total_bytes = 0
+
+    # Counts per command, keyed on tuple: (bundle_name, set_cache_key)
+    self.hits = {}
+    self.misses = {}
+
+    self.lock = threading.Lock()
+
+
+  def Get(self, key):
+    """Returns the result for this key, or None if we dont have one that is still fresh"""
+    command_key = key[:2]
+
+    with self.lock:
+      entry = self.entries.get(key, None)
+
+      if entry is not None and entry[0] < time.time():
+        self._Remove(key)
+        entry = None
+
+      if entry is None:
+        self.misses[command_key] = self.misses.get(command_key, 0) + 1
+        return None
+
+      self.entries.move_to_end(key)
+      self.hits[command_key] = self.hits.get(command_key, 0) + 1
+
+      return entry[2]
+
+
+  def Set(self, key, payload, size, ttl):
+    """Keep this result for `ttl` seconds.  `size` is its output bytes, for our memory bound"""
+    if size > self.max_bytes: return
+
+    with self.lock:
+      if key in self.entries:
+        self._Remove(key)
+
+      self.entries[key] = (time.time() + ttl, size, payload)
+      self.total_bytes += size
+
+      # Drop the least recently used until we are in bounds
+      while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+        self._Remove(next(iter(self.entries)))
+
+
+  def _Remove(self, key):
+    """Forget a result.  Called with our lock held"""
+    (_, size, _) = self.entries.pop(key)
+    self.total_bytes -= size
+
+
+  def GetStats(self):
+    """Returns dict:  Totals, and a list of rows with the counts per command, most hits first"""
+    with self.lock:
+      entries = {}
+      for key in self.entries:
+        entries[key[:2]] = entries.get(key[:2], 0) + 1
+
+      rows = []
+      for command_key in set(self.hits) | set(self.misses) | set(entries):
+        (hits, misses) = (self.hits.get(command_key, 0), self.misses.get(command_key, 0))
+        rows.append({'bundle': command_key[0], 'key': command_key[1], 'entries': entries.get(command_key, 0), 'hits': hits, 'misses': misses,
+                     'hit_rate': hits / (hits + misses) if hits + misses else None})
+
+      return {'entries': len(self.entries), 'bytes': self.total_bytes, 'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+              'rows': sorted(rows, key=lambda row: row['hits'], reverse=True)}
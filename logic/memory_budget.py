@@ -0,0 +1,85 @@
+"""
+Memory Budget: Bounds the memory used by `unique_key` entries in a Bundle silo, set with `path.memory_budget` in the Bundle.
+
+Unique key families (ex: `execute.api.site_user.{username}`) grow with their users, so we track the size of every entry and, once the Bundle is
+over budget, evict the least recently used ones down to the low watermark.  Evicted entries are still on disk in `path.cache`, which is our cold
+tier, and are reloaded on their next Get().
+
+Get() records access without a lock: it just stores a tick for the key, and eviction sorts by tick.
+"""
+
+
+import itertools
+
+
+# When we are over budget, evict down to this fraction of it, so we dont evict on every Set()
+LOW_WATERMARK = 0.9
+
+
+class MemoryBudget():
+  """Sizes and access order of the evictable entries in 1 Bundle silo.  Writers must hold the Bundle lock, Touch() needs no lock."""
+
+  def __init__(self, max_bytes, low_watermark=LOW_WATERMARK):
+    self.max_bytes = int(max_bytes)
+    self.target_bytes = int(self.max_bytes * low_watermark)
+
+    # Size in bytes of each tracked entry, and their total
+    self.sizes = {}
+    self.total_bytes = 0
+
+    # Tick of the last access of each tracked entry.  Higher is more recent
+    self.access = {}
+    self._tick = itertools.count()
+
+    # Entries whose value is already what is on disk, so evicting them doesnt need a write
+    self.clean = set()
+
+
+  def __len__(self):
+    return len(self.sizes)
+
+
+  def Add(self, key, size, clean=False):
+    """Track this entry with its new size.  `clean` means the value came from disk, unchanged"""
+    self.total_bytes += size - self.sizes.get(key, 0)
+    self.sizes[key] = size
+
+    if clean:
+      self.clean.add(key)
+    else:
+      self.clean.discard(key)
+
+    self.Touch(key)
+
+
+  def Remove(self, key):
+    """Stop tracking this entry"""
+    self.total_bytes -= self.sizes.pop(key, 0)
+    self.access.pop(key, None)
+    self.clean.discard(key)
+
+
+  def Touch(self, key):
+    """Mark this entry as just used"""
+    if key in self.sizes:
+      self.access[key] = next(self._tick)
+
+
+  def IsOver(self):
+    return self.total_bytes > self.max_bytes
+
+
+  def GetEvictionCandidates(self):
+    """Returns list of keys to evict, least recently used first, which bring us down to the low watermark"""
+    over_bytes = self.total_bytes - self.target_bytes
+    if over_bytes <= 0:
+      return []
+
+    candidates = []
+    for key in sorted(self.sizes, key=lambda key: self.access.get(key, -1)):
+      if over_bytes <= 0: break
+
+      candidates.append(key)
+      over_bytes -= self.sizes[key]
+
+    return candidates
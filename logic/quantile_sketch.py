@@ -0,0 +1,198 @@
+"""
+Quantile Sketch: DDSketch style streaming quantiles, for long horizon percentiles (p90, p95, p99) in the `summary` system.
+
+Values are counted into logarithmic bins, so any quantile is returned with a bounded relative error (`relative_accuracy`), no matter how many
+values we have seen.  Memory is bounded by `max_bins`: when we have too many bins, the lowest bins are collapsed together, which only costs
+accuracy on the lowest quantiles.  Sketches are mergeable, and serialize to a small dict so they persist with the summary files.
+
+Quantiles use the standard rank `q * (n - 1)`, interpolated between the values on each side of it, same as
+`statistics.quantiles(method='inclusive')`, so p50 of 0..7 is ~3.5.
+"""
+
+
+import math
+import threading
+
+
+# Default relative error of returned quantiles.  0.01 means p99 of 200ms is returned as 198-202ms
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# Default maximum number of bins per sketch.  At 1% accuracy, 2048 bins covers values from 1 to ~10^17
+DEFAULT_MAX_BINS = 2048
+
+
+class DDSketch():
+  """Mergeable quantile sketch with bounded relative error and bounded memory"""
+
+  def __init__(self, relative_accuracy=DEFAULT_RELATIVE_ACCURACY, max_bins=DEFAULT_MAX_BINS):
+    self.relative_accuracy = float(relative_accuracy)
+    self.max_bins = int(max_bins)
+
+    self._gamma = (1 + self.relative_accuracy) / (1 - self.relative_accuracy)
+    self._log_gamma = math.log(self._gamma)
+
+    # Bin index to count, for positive values and for the magnitude of negative values
+    self._positive = {}
+    self._negative = {}
+    self._zero_count = 0
+
+    self.count = 0
+    self.min = None
+    self.max = None
+
+    # The summary keeps the live sketch in the Bundle, so it is serialized by other threads while we add to it
+    self._lock = threading.Lock()
+
+
+  def _GetIndex(self, magnitude):
+    """Returns the bin index for a positive magnitude"""
+    return math.ceil(math.log(magnitude) / self._log_gamma)
+
+
+  def _GetBinValue(self, index):
+    """Returns the representative value for a bin index, which is within `relative_accuracy` of every value in the bin"""
+    return 2 * math.pow(self._gamma, index) / (self._gamma + 1)
+
+
+  def Add(self, value, count=1):
+    """Add a value to the sketch"""
+    with self._lock:
+      self._Add(value, count)
+
+
+  def _Add(self, value, count):
+    """Add a value to the sketch.  Must hold `_lock`."""
+    if value > 0:
+      index = self._GetIndex(value)
+      self._positive[index] = self._positive.get(index, 0) + count
+    elif value < 0:
+      index = self._GetIndex(-value)
+      self._negative[index] = self._negative.get(index, 0) + count
+    else:
+      self._zero_count += count
+
+    self.count += count
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+    if len(self._positive) + len(self._negative) > self.max_bins:
+      self._Collapse()
+
+
+  def _Collapse(self):
+    """Merge the lowest bins together until we are back under `max_bins`.  Lowest values are the most negative, then the smallest positive."""
+    while len(self._positive) + len(self._negative) > self.max_bins:
+      # Most negative values are the highest index in the negative store
+      if len(self._negative) > 1:
+        indexes = sorted(self._negative.keys(), reverse=True)
+        self._negative[indexes[1]] += self._negative.pop(indexes[0])
+      elif len(self._positive) > 1:
+        indexes = sorted(self._positive.keys())
+        self._positive[indexes[1]] += self._positive.pop(indexes[0])
+      else:
+        break
+
+
+  def Merge(self, other):
+    """Merge another sketch into this one.  They must have the same `relative_accuracy`"""
+    if other.relative_accuracy != self.relative_accuracy:
+      raise Exception(f'Cant merge sketches with different accuracy: {self.relative_accuracy} != {other.relative_accuracy}')
+
+    with self._lock:
+      for (index, count) in other._positive.items():
+        self._positive[index] = self._positive.get(index, 0) + count
+      for (index, count) in other._negative.items():
+        self._negative[index] = self._negative.get(index, 0) + count
+      self._zero_count += other._zero_count
+
+      self.count += other.count
+      if other.min is not None:
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+      self._Collapse()
+
+
+  def Quantile(self, quantile):
+    """Returns the value at this `quantile` (0.0 - 1.0), or None if the sketch is empty"""
+    with self._lock:
+      if not self.count:
+        return None
+
+      # Exact answers for the ends
+      if quantile <= 0: return self.min
+      if quantile >= 1: return self.max
+
+      # Interpolate between the values ranked on each side of it, which are the same value when it is a whole rank
+      rank = quantile * (self.count - 1)
+      lower_rank = math.floor(rank)
+      (lower, upper) = self._GetRankValues([lower_rank, min(lower_rank + 1, self.count - 1)])
+
+      return lower + (upper - lower) * (rank - lower_rank)
+
+
+  def _GetRankValues(self, ranks):
+    """Returns list of the values at these sorted 0-based ranks.  Must hold `_lock`."""
+    values = []
+
+    # Walk from the lowest values up: negatives from the largest magnitude, then zeros, then positives from the smallest
+    seen = 0
+    for (value, count) in self._GetBins():
+      seen += count
+      while len(values) < len(ranks) and seen > ranks[len(values)]:
+        values.append(self._Clamp(value))
+
+      if len(values) == len(ranks): return values
+
+    return values + [self.max] * (len(ranks) - len(values))
+
+
+  def _GetBins(self):
+    """Yields tuples (value, count) for every bin, lowest values first.  Must hold `_lock`."""
+    for index in sorted(self._negative.keys(), reverse=True):
+      yield (-self._GetBinValue(index), self._negative[index])
+
+    if self._zero_count:
+      yield (0.0, self._zero_count)
+
+    for index in sorted(self._positive.keys()):
+      yield (self._GetBinValue(index), self._positive[index])
+
+
+  def _Clamp(self, value):
+    """Never return a value outside what we have actually seen"""
+    return min(max(value, self.min), self.max)
+
+
+  def ToDict(self):
+    """Returns a JSON serializable dict of this sketch.  Costs a pass over every bin, so it is only done when the sketch is written or read"""
+    with self._lock:
+      return {
+        'relative_accuracy': self.relative_accuracy,
+        'max_bins': self.max_bins,
+        'positive': {str(index): count for (index, count) in self._positive.items()},
+        'negative': {str(index): count for (index, count) in self._negative.items()},
+        'zero_count': self._zero_count,
+        'count': self.count,
+        'min': self.min,
+        'max': self.max,
+      }
+
+
+def FromDict(data):
+  """Returns a new DDSketch from the dict made by DDSketch.ToDict()"""
+  sketch = DDSketch(data['relative_accuracy'], data['max_bins'])
+
+  sketch._positive = {int(index): count for (index, count) in data['positive'].items()}
+  sketch._negative = {int(index): count for (index, count) in data['negative'].items()}
+  sketch._zero_count = data['zero_count']
+  sketch.count = data['count']
+  sketch.min = data['min']
+  sketch.max = data['max']
+
+  return sketch
+
+
+def GetQuantileName(quantile):
+  """Returns the summary key name for a quantile.  ex: 0.95 -> `p95`, 0.999 -> `p99_9`"""
+  return 'p' + f'{quantile * 100:g}'.replace('.', '_')
@@ -0,0 +1,141 @@
+"""
+Queue Log: Append-only segment file persistence for `store: queue` cache keys.  One JSON record per line.
+
+Appending a record costs the size of the record, instead of rewriting the whole queue.  When the file grows past `max * COMPACT_FACTOR` records,
+we compact it down to the newest `max` records, so compaction is amortized over many appends.  On startup we replay the tail of the file.
+
+`max` comes with every write, so changing it in the Bundle applies to the next compaction.  A torn final line, from a crash in the middle of an
+append, is cut off before we append to the file again, so it cant join onto the next record.
+"""
+
+
+import os
+import threading
+import collections
+
+from logic.log import LOG
+
+from logic import local_cache
+from logic import codec
+
+
+# Queue log files are the cache path with this suffix, so they live next to the normal cache files
+QUEUE_LOG_SUFFIX = '.jsonl'
+
+# Compact once the file holds this many times the queue `max` records
+COMPACT_FACTOR = 2
+
+# Bytes to read at a time, when looking back from the end of the file for its last complete line
+TAIL_READ_SIZE = 64 * 1024
+
+
+class QueueLog():
+  """Append-only segment file for a single queue cache key"""
+
+  def __init__(self, path):
+    self.path = os.path.expanduser(path) + QUEUE_LOG_SUFFIX
+
+    # Number of records in the file, so we know when to compact.  We repair and count the file the first time we write to it
+    self.record_count = None
+
+    # Only 1 writer at a time per file
+    self.lock = threading.Lock()
+
+
+  def Write(self, records, max_records, rewrite=None):
+    """Append these `records` to the log, keeping at least the newest `max_records`.  If `rewrite` is a list, the file is replaced with it first"""
+    with self.lock:
+      local_cache.EnsureCacheDirectory(self.path)
+
+      # Replace the whole file
+      if rewrite is not None:
+        self._Rewrite((list(rewrite) + list(records))[-max_records:])
+        return
+
+      if self.record_count is None:
+        TruncateTornLine(self.path)
+        self.record_count = CountRecords(self.path)
+
+      # Append only the new records
+      with open(self.path, 'ab') as fp:
+        fp.write(b''.join([codec.Dumps(record) + b'\n' for record in records]))
+      self.record_count += len(records)
+
+      # Compact when we have too many records, keeping the newest `max`
+      if self.record_count > max_records * COMPACT_FACTOR:
+        self._Rewrite(Replay(self.path, max_records))
+        # LOG.debug(f'Compacted queue log: {self.path}  Records: {self.record_count}')
+
+
+  def _Rewrite(self, records):
+    """Atomically replace the file with these records.  Must hold `lock`."""
+    temp_path = f'{self.path}.tmp'
+    with open(temp_path, 'wb') as fp:
+      fp.write(b''.join([codec.Dumps(record) + b'\n' for record in records]))
+
+    os.replace(temp_path, self.path)
+    self.record_count = len(records)
+
+
+def TruncateTornLine(path):
+  """If the file doesnt end with a newline, cut it back to its last complete line.  Returns the number of bytes cut"""
+  try:
+    fp = open(path, 'r+b')
+  except FileNotFoundError:
+    return 0
+
+  with fp:
+    size = fp.seek(0, os.SEEK_END)
+    if size == 0: return 0
+
+    fp.seek(size - 1)
+    if fp.read(1) == b'\n': return 0
+
+    # Walk back a block at a time to the last newline.  No newline at all means the whole file is 1 torn record
+    end = size
+    keep = 0
+    while end > 0:
+      start = max(0, end - TAIL_READ_SIZE)
+      fp.seek(start)
+      index = fp.read(end - start).rfind(b'\n')
+      if index != -1:
+        keep = start + index + 1
+        break
+      end = start
+
+    fp.truncate(keep)
+
+  LOG.error(f'Queue log ended in a torn record, cut it off: {path}  Bytes: {size - keep}')
+
+  return size - keep
+
+
+def CountRecords(path):
+  """Returns the number of records in the queue log file, or 0 if it doesnt exist"""
+  try:
+    with open(path, 'rb') as fp:
+      return sum(1 for _ in fp)
+  except FileNotFoundError:
+    return 0
+
+
+def Replay(path, max_records):
+  """Returns a list of the newest `max_records` records in the queue log at `path`.  Records that cant be parsed are skipped, which is what a torn final write looks like."""
+  path = os.path.expanduser(path)
+
+  try:
+    with open(path, 'rb') as fp:
+      lines = collections.deque(fp, maxlen=max_records)
+  except FileNotFoundError:
+    return []
+
+  records = []
+  for line in lines:
+    if not line.strip(): continue
+
+    try:
+      records.append(codec.Loads(line))
+    except codec.DecodeError as e:
+      LOG.error(f'Queue log has a bad record, skipping: {path}  Error: {e}')
+
+  return records
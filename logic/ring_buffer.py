@@ -0,0 +1,175 @@
+"""
+Ring Buffer: Bounded queue for `store: queue` cache keys.  Appending is O(1), and once full the oldest item is evicted in O(1) instead of slicing a new list.
+
+Readers use Snapshot(), which is a plain list built once per change and shared by all readers until the next change.  That keeps templates,
+JSON serialization and summaries working on normal lists, while the writer never copies the queue.
+
+With `max_bytes`, the oldest items are also evicted while the items total more than `max_bytes` of JSON, always keeping the newest item.
+"""
+
+
+import threading
+
+from logic import codec
+from logic import quantile_sketch
+
+
+class RingBuffer():
+  """Fixed size ring of items, oldest first.  Writers must be serialized by the caller (the Bundle lock), readers can call Snapshot() any time."""
+
+  def __init__(self, max_size, items=None, max_bytes=None):
+    self.max_size = max(1, int(max_size))
+    self.max_bytes = int(max_bytes) if max_bytes else None
+
+    # Preallocated storage.  `_start` is the index of the oldest item, and `_count` is how many items we hold
+    self._items = [None] * self.max_size
+    self._start = 0
+    self._count = 0
+
+    # With `max_bytes`: the JSON size of each item, in the same slots as `_items`, and their total
+    self._sizes = [0] * self.max_size if self.max_bytes else None
+    self._bytes = 0
+
+    # Cached list of our items, oldest first.  None when it needs to be rebuilt
+    self._snapshot = None
+
+    # Protects the storage between the writer and a reader building a snapshot
+    self._lock = threading.Lock()
+
+    if items:
+      self.Extend(items)
+
+
+  def __len__(self):
+    return self._count
+
+
+  def __iter__(self):
+    return iter(self.Snapshot())
+
+
+  def __getitem__(self, index):
+    """Supports int indexes (including negative) and slices, same as a list"""
+    return self.Snapshot()[index]
+
+
+  def Append(self, item):
+    """Append an item.  Returns a list of the evicted items, which is empty unless we were full."""
+    with self._lock:
+      self._snapshot = None
+
+      # Full, so evict the oldest item to make room
+      evicted = []
+      if self._count == self.max_size:
+        evicted.append(self._PopOldestLocked())
+
+      index = (self._start + self._count) % self.max_size
+      self._items[index] = item
+      self._count += 1
+
+      # Over our byte limit, so evict the oldest items until we fit, but never the item we just added
+      if self.max_bytes:
+        size = GetJsonSize(item)
+        self._sizes[index] = size
+        self._bytes += size
+
+        while self._bytes > self.max_bytes and self._count > 1:
+          evicted.append(self._PopOldestLocked())
+
+      return evicted
+
+
+  def _PopOldestLocked(self):
+    """Remove and return the oldest item.  Must hold `_lock`."""
+    item = self._items[self._start]
+    self._items[self._start] = None
+
+    if self.max_bytes:
+      self._bytes -= self._sizes[self._start]
+      self._sizes[self._start] = 0
+
+    self._start = (self._start + 1) % self.max_size
+    self._count -= 1
+
+    return item
+
+
+  def Extend(self, items):
+    """Append all these items in bulk.  Returns a list of the evicted items, oldest first."""
+    items = list(items)
+
+    with self._lock:
+      self._snapshot = None
+
+      current = self._ToListLocked()
+      combined = current + items
+
+      # Keep only the newest `max_size` items, and lay them out from the start of storage
+      evicted = combined[:max(0, len(combined) - self.max_size)]
+      kept = combined[len(evicted):]
+
+      # Keep only the newest items that fit in `max_bytes`, and always the newest item
+      if self.max_bytes:
+        sizes = [GetJsonSize(item) for item in kept]
+        total = sum(sizes)
+
+        drop_count = 0
+        while total > self.max_bytes and drop_count < len(kept) - 1:
+          total -= sizes[drop_count]
+          drop_count += 1
+
+        evicted += kept[:drop_count]
+        kept = kept[drop_count:]
+
+        self._sizes = sizes[drop_count:] + [0] * (self.max_size - len(kept))
+        self._bytes = total
+
+      self._items = kept + [None] * (self.max_size - len(kept))
+      self._start = 0
+      self._count = len(kept)
+
+      return evicted
+
+
+  def Snapshot(self):
+    """Returns a list of all the items, oldest first.  The list is shared by all readers until the next change, so never change it."""
+    snapshot = self._snapshot
+    if snapshot is not None:
+      return snapshot
+
+    with self._lock:
+      if self._snapshot is None:
+        self._snapshot = self._ToListLocked()
+
+      return self._snapshot
+
+
+  def ToList(self):
+    """Returns a new list of all the items, oldest first, which the caller owns"""
+    return list(self.Snapshot())
+
+
+  def _ToListLocked(self):
+    """Returns a new list of all the items, oldest first.  Must hold `_lock`."""
+    end = self._start + self._count
+
+    if end <= self.max_size:
+      return self._items[self._start:end]
+    else:
+      return self._items[self._start:] + self._items[:end - self.max_size]
+
+
+def JsonDefault(value):
+  """Use as `default=` for codec.Dumps(), so any RingBuffer inside the data serializes as its list, and any DDSketch as its dict"""
+  if type(value) == RingBuffer:
+    return value.Snapshot()
+
+  if type(value) == quantile_sketch.DDSketch:
+    return value.ToDict()
+
+  raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def GetJsonSize(value):
+  """Returns the size in bytes of this value serialized as JSON.  This is what it costs us on disk, and approximates what it costs in memory."""
+  return len(codec.Dumps(value, default=JsonDefault))
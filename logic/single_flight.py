@@ -0,0 +1,132 @@
+"""
+Single Flight: Identical work that is already running is joined instead of run again.
+
+When a popular page misses, every request for it executes the same command with the same input at once.  With a SingleFlight, the first caller
+for a key runs the work, and everyone who asks for the same key while it is running waits for that result instead.  Once it finishes the key is
+forgotten, so the next caller runs it again, we only join work that is in flight, we dont cache results.
+
+Callers can be threads (the Job Manager) with Do(), or coroutines on the event loop (HTTP requests) with DoAsync(), and both join each other.
+"""
+
+
+import asyncio
+import threading
+
+
+class Flight():
+  """1 piece of work in flight, and everyone waiting on it"""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+    # Coroutines waiting on us, list of tuple: (loop, asyncio.Future).  Only changed with the SingleFlight lock held
+    self.futures = []
+
+    # With DoAsync(), the asyncio.Task running the work.  The Flight owns it, so it finishes even if the caller that started it is cancelled
+    self.task = None
+
+
+  def GetResult(self):
+    """Returns the result, or raises the leader's exception"""
+    if self.error is not None:
+      raise self.error
+
+    return self.result
+
+
+class SingleFlight():
+  """Runs work once per key at a time.  Callers for a key that is already running get the running work's result"""
+
+  def __init__(self):
+    # Work running now:  {key: Flight}
+    self.flights = {}
+    self.lock = threading.Lock()
+
+
+  def _Join(self, key):
+    """Returns tuple (Flight, is_leader).  The leader must run the work and call _Finish()"""
+    with self.lock:
+      flight = self.flights.get(key, None)
+      if flight is not None:
+        return (flight, False)
+
+      flight = Flight()
+      self.flights[key] = flight
+      return (flight, True)
+
+
+  def _Finish(self, key, flight, result=None, error=None):
+    """Publish the leader's result to everyone waiting, and forget the key"""
+    with self.lock:
+      del self.flights[key]
+
+      flight.result = result
+      flight.error = error
+      flight.done.set()
+
+      futures = flight.futures
+      flight.futures = []
+
+    for (loop, future) in futures:
+      loop.call_soon_threadsafe(SetFuture, future)
+
+
+  def Do(self, key, function):
+    """Returns function(), or the result of the same key already in flight.  Blocks the calling thread while waiting"""
+    (flight, is_leader) = self._Join(key)
+
+    if not is_leader:
+      flight.done.wait()
+      return flight.GetResult()
+
+    try:
+      result = function()
+    except BaseException as e:
+      self._Finish(key, flight, error=e)
+      raise
+
+    self._Finish(key, flight, result=result)
+
+    return result
+
+
+  async def DoAsync(self, key, coroutine_function):
+    """Returns `await coroutine_function()`, or the result of the same key already in flight.  Waiting doesnt block the event loop"""
+    (flight, is_leader) = self._Join(key)
+
+    if not is_leader:
+      loop = asyncio.get_running_loop()
+      future = loop.create_future()
+
+      with self.lock:
+        if flight.done.is_set():
+          return flight.GetResult()
+        flight.futures.append((loop, future))
+
+      await future
+      return flight.GetResult()
+
+    # If our request goes away, the waiters still want the real answer, so the work runs in the Flight's task, and only our wait is cancelled
+    flight.task = asyncio.ensure_future(self._RunAsync(key, flight, coroutine_function))
+    await asyncio.shield(flight.task)
+
+    return flight.GetResult()
+
+
+  async def _RunAsync(self, key, flight, coroutine_function):
+    """Run the work for the Flight's task, and publish its result or exception.  Never raises, the callers get the exception from the Flight"""
+    try:
+      result = await coroutine_function()
+    except BaseException as e:
+      self._Finish(key, flight, error=e)
+      return
+
+    self._Finish(key, flight, result=result)
+
+
+def SetFuture(future):
+  """Wake a waiting coroutine, on its own event loop.  The result is read from the Flight"""
+  if not future.done():
+    future.set_result(None)
@@ -0,0 +1,142 @@
+"""
+Summary Column: Contiguous float64 column for a summarized queue field, with a group code per value, for `group_by` summaries.
+
+Values are stored in a NumPy buffer twice the window size.  We append at the end, and when we hit the end of the buffer we copy the newest window
+back to the front.  That keeps the window contiguous (a view, never a copy) with amortized O(1) appends, so every group's summary is computed
+with vectorized reductions in one pass over the column.
+"""
+
+
+import numpy
+
+
+class GroupedColumn():
+  """Bounded window of (group, float) values, oldest first.  Caller is responsible for locking."""
+
+  def __init__(self, max_size):
+    self.max_size = max(1, int(max_size))
+
+    # Double sized buffers.  The window is always [_start:_end]
+    self._values = numpy.empty(self.max_size * 2, dtype=numpy.float64)
+    self._codes = numpy.empty(self.max_size * 2, dtype=numpy.int64)
+    self._start = 0
+    self._end = 0
+
+    # Group names to their int code, and back
+    self.group_codes = {}
+    self.group_names = []
+
+
+  def __len__(self):
+    return self._end - self._start
+
+
+  def Append(self, group, value):
+    """Append a value for this group, evicting the oldest value once we are full"""
+    # Out of room at the end of the buffer, so move the newest window back to the front
+    if self._end == len(self._values):
+      keep = self.max_size - 1
+      self._values[:keep] = self._values[self._end - keep:self._end]
+      self._codes[:keep] = self._codes[self._end - keep:self._end]
+      self._start = 0
+      self._end = keep
+
+    code = self.group_codes.get(group, None)
+    if code is None:
+      code = self._AddGroup(group)
+
+    self._values[self._end] = value
+    self._codes[self._end] = code
+    self._end += 1
+
+    # Evict the oldest
+    if self._end - self._start > self.max_size:
+      self._start += 1
+
+
+  def _AddGroup(self, group):
+    """Returns the code for a new group.  If we are holding many more group names than the window can contain, drop the ones no longer in the window."""
+    if len(self.group_names) >= self.max_size * 2:
+      self._CompactGroups()
+
+    code = len(self.group_names)
+    self.group_codes[group] = code
+    self.group_names.append(group)
+
+    return code
+
+
+  def _CompactGroups(self):
+    """Renumber the group codes so only groups still in the window have a code"""
+    codes = self.Codes()
+    (active_codes, new_codes) = numpy.unique(codes, return_inverse=True)
+
+    self.group_names = [self.group_names[code] for code in active_codes]
+    self.group_codes = {name: code for (code, name) in enumerate(self.group_names)}
+    self._codes[self._start:self._end] = new_codes
+
+
+  def Values(self):
+    """Returns the window of values as a contiguous NumPy view, oldest first.  Only valid until the next Append()"""
+    return self._values[self._start:self._end]
+
+
+  def Codes(self):
+    """Returns the group code for each value in the window, as a NumPy view"""
+    return self._codes[self._start:self._end]
+
+
+  def GetGroups(self):
+    """Returns set of the group names with at least 1 value in the window"""
+    counts = numpy.bincount(self.Codes(), minlength=len(self.group_names))
+
+    return set(self.group_names[code] for code in numpy.nonzero(counts)[0])
+
+
+  def GetGroupSummaries(self, min_count=3):
+    """Returns dict of {group_name: {'max', 'min', 'mean', 'median', 'stdev', 'timeseries'}} for every group with at least `min_count` values in the window.
+
+    All groups are computed together with vectorized reductions.  `stdev` is the sample standard deviation, same as statistics.stdev().
+    """
+    values = self.Values()
+    codes = self.Codes()
+
+    if not len(values):
+      return {}
+
+    group_count = len(self.group_names)
+
+    # Counts, sums and means for every group at once
+    counts = numpy.bincount(codes, minlength=group_count)
+    sums = numpy.bincount(codes, weights=values, minlength=group_count)
+    safe_counts = numpy.maximum(counts, 1)
+    means = sums / safe_counts
+
+    # Sum of squared differences from each value's group mean
+    squares = numpy.bincount(codes, weights=(values - means[codes]) ** 2, minlength=group_count)
+    stdevs = numpy.sqrt(squares / numpy.maximum(counts - 1, 1))
+
+    # Sort by group, then by value.  Each group is a contiguous run, so min, max and median are just indexes into the run
+    by_value = values[numpy.lexsort((values, codes))]
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+
+    # Sort by group, keeping time order inside each group, for the timeseries
+    by_time = values[numpy.argsort(codes, kind='stable')]
+
+    summaries = {}
+    for code in numpy.nonzero(counts >= min_count)[0]:
+      start = starts[code]
+      end = ends[code]
+      count = counts[code]
+
+      summaries[self.group_names[code]] = {
+        'max': float(by_value[end - 1]),
+        'min': float(by_value[start]),
+        'mean': float(means[code]),
+        'median': float((by_value[start + (count - 1) // 2] + by_value[start + count // 2]) / 2),
+        'stdev': float(stdevs[code]),
+        'timeseries': by_time[start:end].tolist(),
+      }
+
+    return summaries
@@ -0,0 +1,198 @@
+"""
+Summary Stats: Online statistics over a bounded window of values, for the `summary` system on queue cache keys.
+
+Values enter and leave the window in FIFO order, same as the queue they summarize, so every statistic is updated incrementally:
+  - mean and variance: Welford's algorithm, with the matching removal step
+  - min and max: monotonic deques of (sequence, value)
+  - median: two heaps with lazy deletion
+
+Each Add() is O(log n), instead of walking and sorting the whole queue on every append.
+"""
+
+
+import collections
+import heapq
+import math
+
+from logic import ring_buffer
+
+
+class WindowStats():
+  """Statistics over the newest `max_size` values.  Caller is responsible for locking."""
+
+  def __init__(self, max_size, values=None):
+    # The window itself, which is also our `timeseries`
+    self.values = ring_buffer.RingBuffer(max_size)
+
+    # Sequence number of the next value added, and of the oldest value still in the window
+    self._next_seq = 0
+    self._oldest_seq = 0
+
+    # Welford running mean and sum of squared differences
+    self._mean = 0.0
+    self._m2 = 0.0
+
+    # Monotonic deques of (seq, value).  Front is always the current min or max
+    self._min_deque = collections.deque()
+    self._max_deque = collections.deque()
+
+    # Median heaps.  `_low` is a max-heap (negated values) for the lower half, `_high` is a min-heap for the upper half
+    self._low = []
+    self._high = []
+    self._low_size = 0
+    self._high_size = 0
+
+    # Values removed from the window, but still sitting in a heap until they reach the top
+    self._delayed = collections.Counter()
+
+    # Removals since we last recomputed mean and variance exactly, to keep float drift bounded
+    self._removals = 0
+
+    if values:
+      for value in values:
+        self.Add(value)
+
+
+  def __len__(self):
+    return len(self.values)
+
+
+  def Add(self, value):
+    """Add a value to the window, evicting the oldest if we are full"""
+    # The window now holds the new value, and the evicted value is gone.  Remove the evicted one from our statistics first, as if the new value wasnt there yet
+    count = len(self.values)
+    for evicted in self.values.Append(value):
+      self._Remove(evicted, count - 1)
+
+    seq = self._next_seq
+    self._next_seq += 1
+
+    # Welford
+    count = len(self.values)
+    delta = value - self._mean
+    self._mean += delta / count
+    self._m2 += delta * (value - self._mean)
+
+    # Min and Max.  Drop anything from the back that can never be the min/max again while this value is in the window
+    while self._min_deque and self._min_deque[-1][1] >= value:
+      self._min_deque.pop()
+    self._min_deque.append((seq, value))
+
+    while self._max_deque and self._max_deque[-1][1] <= value:
+      self._max_deque.pop()
+    self._max_deque.append((seq, value))
+
+    # Median
+    if not self._low or value <= -self._low[0]:
+      heapq.heappush(self._low, -value)
+      self._low_size += 1
+    else:
+      heapq.heappush(self._high, value)
+      self._high_size += 1
+
+    self._Rebalance()
+
+    # Every window's worth of removals, recompute mean and variance exactly.  Amortized O(1), and stops rounding errors from accumulating forever
+    if self._removals >= self.values.max_size:
+      self._Recompute()
+
+
+  def _Remove(self, value, count):
+    """Remove the oldest value from all our statistics.  `count` is how many values remain after removing it."""
+    seq = self._oldest_seq
+    self._oldest_seq += 1
+
+    # Welford removal step
+    if count == 0:
+      self._mean = 0.0
+      self._m2 = 0.0
+    else:
+      mean_old = self._mean
+      self._mean = ((count + 1) * mean_old - value) / count
+      self._m2 -= (value - self._mean) * (value - mean_old)
+
+    # Min and Max only need to drop their front if it is the value leaving
+    if self._min_deque and self._min_deque[0][0] == seq:
+      self._min_deque.popleft()
+    if self._max_deque and self._max_deque[0][0] == seq:
+      self._max_deque.popleft()
+
+    # Median: mark it deleted, and remove it now if it is on top of its heap
+    self._delayed[value] += 1
+    if self._low and value <= -self._low[0]:
+      self._low_size -= 1
+      if value == -self._low[0]:
+        self._Prune(self._low, negated=True)
+    else:
+      self._high_size -= 1
+      if self._high and value == self._high[0]:
+        self._Prune(self._high, negated=False)
+
+    self._Rebalance()
+
+    self._removals += 1
+
+
+  def _Prune(self, heap, negated):
+    """Pop any values off the top of this heap which were already removed from the window"""
+    while heap:
+      value = -heap[0] if negated else heap[0]
+      if not self._delayed[value]: break
+
+      self._delayed[value] -= 1
+      if not self._delayed[value]: del self._delayed[value]
+      heapq.heappop(heap)
+
+
+  def _Rebalance(self):
+    """Keep the low half the same size as the high half, or 1 bigger"""
+    if self._low_size > self._high_size + 1:
+      heapq.heappush(self._high, -heapq.heappop(self._low))
+      self._low_size -= 1
+      self._high_size += 1
+      self._Prune(self._low, negated=True)
+
+    elif self._low_size < self._high_size:
+      heapq.heappush(self._low, -heapq.heappop(self._high))
+      self._low_size += 1
+      self._high_size -= 1
+      self._Prune(self._high, negated=False)
+
+
+  def _Recompute(self):
+    """Exactly recompute the mean and variance from the window"""
+    self._removals = 0
+
+    values = self.values.Snapshot()
+    if not values:
+      self._mean = 0.0
+      self._m2 = 0.0
+      return
+
+    self._mean = math.fsum(values) / len(values)
+    self._m2 = math.fsum([(value - self._mean) ** 2 for value in values])
+
+
+  def Max(self):
+    return self._max_deque[0][1]
+
+
+  def Min(self):
+    return self._min_deque[0][1]
+
+
+  def Mean(self):
+    return self._mean
+
+
+  def Median(self):
+    """Same as statistics.median(): the middle value, or the mean of the 2 middle values"""
+    if (self._low_size + self._high_size) % 2 == 1:
+      return -self._low[0]
+    else:
+      return (-self._low[0] + self._high[0]) / 2
+
+
+  def Stdev(self):
+    """Sample standard deviation, same as statistics.stdev().  Requires at least 2 values."""
+    return math.sqrt(max(self._m2, 0.0) / (len(self.values) - 1))
@@ -8,8 +8,21 @@ import threading
 from logic.threaded import bundle_manager
 from logic.threaded import job_manager
 from logic.threaded import job_scheduler
+from logic.threaded import dependency_manager
 from logic.threaded import git_manager
+from logic.threaded import cache_flusher
+from logic.threaded import cache_server
 
+from logic import cache_replica
+from logic import command_pool
+from logic import zygote
+
+
+# Write-behind persistence for the Cache Manager.  Coalesces cache writes to disk
+CACHE_FLUSHER = None
+
+# Streams our cache to the worker processes, when we have `--workers`.  None with a single process
+CACHE_SERVER = None
 
 # Keep our Bundles hot loaded
 BUNDLE_MANAGER = None
@@ -20,6 +33,9 @@ JOB_MANAGER = None
 # Job Scheduler.  Periodically add new jobs to the Job Manager queue
 JOB_SCHEDULER = None
 
+# Dependency Manager.  Recompute commands when the commands they take as input change
+DEPENDENCY_MANAGER = None
+
 # Sync Git Repos that we want to ensure are up to date with our Bundles specification, so we have fresh data
 GIT_MANAGER = None
 
@@ -29,6 +45,17 @@ def StartThreads(config):
   # Create lock for synchronizing threads.  Add this into our config we pass around everywhere
   config.lock_all = threading.Lock()
 
+  # Cache Flusher: Start before anything that writes to the cache, so all writes go through it
+  global CACHE_FLUSHER
+  CACHE_FLUSHER = cache_flusher.CacheFlusher('Cache Flusher', config, {}, sleep_duration=1, remove_task=False)
+  CACHE_FLUSHER.start()
+
+  # Cache Server: With worker processes, start before we load any Bundles, so every change is streamed to them
+  if config.workers > 1:
+    global CACHE_SERVER
+    CACHE_SERVER = cache_server.CacheServer('Cache Server', config, {'path': cache_replica.GetSocketPath()}, sleep_duration=0, remove_task=False)
+    CACHE_SERVER.start()
+
   # Bundle Manager: Hot reload any bundle changes
   global BUNDLE_MANAGER
   BUNDLE_MANAGER = bundle_manager.BundleManager('Bundle Manager', config, {}, sleep_duration=10, remove_task=False)
@@ -36,14 +63,19 @@ def StartThreads(config):
 
   # Job Manager: Process jobs in the queue
   global JOB_MANAGER
-  JOB_MANAGER = job_manager.JobManager('Job Manager', config, {}, sleep_duration=3)
+  JOB_MANAGER = job_manager.JobManager('Job Manager', config, {'max_jobs': config.jobs}, sleep_duration=0, remove_task=False)
   JOB_MANAGER.start()
 
-  # Job Schedule: Add new jobs to Job Manager queue
+  # Job Schedule: Add new jobs to Job Manager queue.  It sleeps until the next job is due itself
   global JOB_SCHEDULER
-  JOB_SCHEDULER = job_scheduler.JobScheduler('Job Scheduler', config, {}, sleep_duration=3, remove_task=False)
+  JOB_SCHEDULER = job_scheduler.JobScheduler('Job Scheduler', config, {}, sleep_duration=0, remove_task=False)
   JOB_SCHEDULER.start()
 
+  # Dependency Manager: Recompute derived cache keys when their inputs change
+  global DEPENDENCY_MANAGER
+  DEPENDENCY_MANAGER = dependency_manager.DependencyManager('Dependency Manager', config, {}, sleep_duration=0, remove_task=False)
+  DEPENDENCY_MANAGER.start()
+
   # Git Manager: Sync repos we care about, to keep our scripts and data fresh
   global GIT_MANAGER
   GIT_MANAGER = git_manager.GitManager('Git Manager', config)
@@ -55,5 +87,16 @@ def ShutdownThreads(config):
   BUNDLE_MANAGER.Shutdown()
   JOB_MANAGER.Shutdown()
   JOB_SCHEDULER.Shutdown()
+  DEPENDENCY_MANAGER.Shutdown()
   GIT_MANAGER.Shutdown()
 
+  if CACHE_SERVER:
+    CACHE_SERVER.Shutdown()
+
+  # Stop the `mode: persistent` command workers, and the `mode: zygote` zygotes
+  command_pool.Shutdown()
+  zygote.Shutdown()
+
+  # Shut down last, this flushes all the dirty cache keys to storage
+  CACHE_FLUSHER.Shutdown()
+
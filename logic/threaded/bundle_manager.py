@@ -10,11 +10,28 @@ from logic.log import LOG
 
 from logic import thread_base
 from logic import utility
+from logic import key_resolver
+from logic import dependency_graph
+from logic import thread_manager
 
 
 class BundleManager(thread_base.ThreadBase):
   """Will loop in it's own thread, checking out the bundle files for changes"""
 
+  def __init__(self, *args, **kwargs):
+    thread_base.ThreadBase.__init__(self, *args, **kwargs)
+
+    # Set up here instead of Init(), because the Cache Manager and webserver can resolve keys before our thread is running
+    # Compiled Key Table for every Bundle, replaced whole on every reload, so readers can use them without our lock
+    self.key_tables = {}
+
+    # Dependency Graph of every Bundle's commands, replaced whole on every reload like the Key Tables
+    self.dependency_graphs = {}
+
+    # Bumped every time any Bundle is loaded, so each Key Table knows which version of its Bundle it was compiled from
+    self.version = 0
+
+
   def Init(self):
     """Save our _data to vars"""
     # Latest bundle timestamps of when we last loaded it.  If the bundle is updated, load it again
@@ -39,8 +56,17 @@ class BundleManager(thread_base.ThreadBase):
       self._config.data[path] = bundle_data
       self.timestamps[path] = time.time()
 
+      # Compile the Key Table once per load, so cache key lookups never walk or copy the Bundle
+      self.version += 1
+      self.key_tables[path] = key_resolver.KeyTable(bundle_data, self.version)
+      self.dependency_graphs[path] = dependency_graph.DependencyGraph(bundle_data)
+
     LOG.debug(f'Loaded Bundle: {path}')
 
+    # Wake the Job Scheduler, so schedule changes apply now instead of when its next job is due
+    if thread_manager.JOB_SCHEDULER:
+      thread_manager.JOB_SCHEDULER.Wake()
+
     # If this is the first time, we want to load cache off storage so we start with the last data.  Allows smooth restarts
     if load_cache:
       self._config.cache.LoadInitialBundleCache(path, self.GetBundles())
@@ -112,3 +138,13 @@ class BundleManager(thread_base.ThreadBase):
         bundles[bundle] = dict(self._config.data[bundle])
 
     return bundles
+
+
+  def GetKeyTable(self, bundle_name):
+    """Returns the compiled Key Table for this Bundle, or None if it isnt loaded.  Lock-free, Key Tables are never changed after they are published."""
+    return self.key_tables.get(bundle_name, None)
+
+
+  def GetDependencyGraph(self, bundle_name):
+    """Returns the Dependency Graph for this Bundle, or None if it isnt loaded.  Lock-free, like GetKeyTable()"""
+    return self.dependency_graphs.get(bundle_name, None)
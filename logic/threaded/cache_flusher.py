@@ -0,0 +1,255 @@
+"""
+Cache Flusher: Write-behind persistence for the Cache Manager.  Cache changes mark their key dirty, and we write them to storage in the background.
+
+Repeated writes to the same key inside the flush window are coalesced into 1 write of the latest value, and writes whose content hasnt changed are skipped.
+Queue appends are batched the same way, and written to their queue as 1 append of all the new records.
+We also write the periodic Cache Snapshots, for Bundles with a `path.snapshot`.  Writes that fail are retried with backoff, never dropped.
+"""
+
+
+import hashlib
+import threading
+import time
+
+from logic.log import LOG
+
+from logic import thread_base
+from logic import ring_buffer
+from logic import cache_storage
+from logic import codec
+
+
+# Default seconds to wait after a key is first marked dirty before we write it, so repeated writes coalesce.  Bundles can set `path.flush_window`
+DEFAULT_FLUSH_WINDOW = 2
+
+# Seconds to wait before retrying a failed write, doubled for each failure in a row, up to the max
+RETRY_DELAY = 1
+RETRY_DELAY_MAX = 60
+
+
+class CacheFlusher(thread_base.ThreadBase):
+  """Will loop in it's own thread, writing dirty cache keys to storage"""
+
+  def __init__(self, *args, **kwargs):
+    thread_base.ThreadBase.__init__(self, *args, **kwargs)
+
+    # Set up here instead of Init(), because the Cache Manager can mark keys dirty before our thread is running
+    # Dirty keys waiting to be written, by their storage location:  {location: {'storage', 'kind', 'key', 'value', 'source', 'due': write_time, 'failures': count}}
+    self.dirty = {}
+    self.lock_dirty = threading.Lock()
+
+    # Pending queue writes, by their storage location:  {location: {'storage', 'key', 'max_records', 'records': [record], 'rewrite': None or [record], 'due': write_time, 'failures': count}}
+    self.queue_appends = {}
+
+    # Content hash of the last thing we wrote to each location, so we can skip unchanged writes.  Forget() drops keys that leave memory
+    self.hashes = {}
+
+    # Only 1 flush writes at a time, so an older value can never overwrite a newer one for the same key
+    self.lock_write = threading.Lock()
+
+
+  def Init(self):
+    """Give ourselves a single task which will never be removed and doesnt matter.  We just run forever like this."""
+    self.AddTask({})
+
+    LOG.debug(f'{self.name} Started')
+
+
+  def ExecuteTask(self, task):
+    """Write out any dirty keys that have waited out their flush window, and any Cache Snapshots that are due"""
+    self.Flush()
+
+    self._config.cache.WriteSnapshots()
+
+
+  def Shutdown(self):
+    """Tell this thread to shut down, and write everything that is still dirty so we dont lose it.  Then snapshot, so the restart is fast."""
+    thread_base.ThreadBase.Shutdown(self)
+
+    self.Flush(force=True)
+
+    self._config.cache.WriteSnapshots(force=True)
+
+
+  def MarkDirty(self, storage, kind, key, value, window=DEFAULT_FLUSH_WINDOW):
+    """Mark this key dirty in its storage with the latest `value`.  If it is already dirty, replace the value but keep its time, so it still flushes on schedule."""
+    # If we are shut down, nothing will flush later, so write it now
+    if self._shutdown:
+      with self.lock_write:
+        try:
+          self._WriteItems(storage, [(kind, key, value)])
+        except Exception as e:
+          LOG.error(f'Cache Flusher: Failed to write after shutdown, it is lost: {key}  Error: {e}')
+      return
+
+    location = storage.GetLocation(kind, key)
+
+    # Queues inside the value keep changing in place, so we keep what they have now.  `source` is the value itself, for WriteNow()
+    snapshot_value = SnapshotValue(value)
+
+    with self.lock_dirty:
+      if location in self.dirty:
+        self.dirty[location].update({'value': snapshot_value, 'source': value})
+      else:
+        self.dirty[location] = {'storage': storage, 'kind': kind, 'key': key, 'value': snapshot_value, 'source': value, 'due': time.time() + window, 'failures': 0}
+
+
+  def MarkQueueAppend(self, storage, key, records, max_records, rewrite=None, window=DEFAULT_FLUSH_WINDOW):
+    """Add `records` to the pending appends for this queue.  If `rewrite` is a list, it replaces the whole queue and drops any appends pending before it."""
+    # If we are shut down, nothing will flush later, so write it now
+    if self._shutdown:
+      storage.AppendQueue(key, records, max_records, rewrite=rewrite)
+      return
+
+    location = storage.GetLocation(cache_storage.KIND_QUEUE, key)
+
+    with self.lock_dirty:
+      if location not in self.queue_appends:
+        self.queue_appends[location] = {'storage': storage, 'key': key, 'max_records': max_records, 'records': [], 'rewrite': None, 'due': time.time() + window, 'failures': 0}
+
+      entry = self.queue_appends[location]
+
+      if rewrite is not None:
+        entry['rewrite'] = list(rewrite)
+        entry['records'] = []
+
+      entry['records'] += records
+
+
+  def WriteNow(self, storage, kind, key, value):
+    """Write this value to storage now, without waiting for the flush window.  Raises if it wasnt written.  A pending write of this same value
+    is dropped once it is written, a different value stays pending."""
+    location = storage.GetLocation(kind, key)
+
+    with self.lock_write:
+      self._WriteItems(storage, [(kind, key, value)])
+
+      with self.lock_dirty:
+        entry = self.dirty.get(location, None)
+        if entry is not None and entry['source'] is value:
+          del self.dirty[location]
+
+
+  def Forget(self, storage, kind, key):
+    """Drop what we know about this key, because it left memory.  Its next write is never skipped"""
+    self.hashes.pop(storage.GetLocation(kind, key), None)
+
+
+  def Flush(self, force=False):
+    """Write all dirty keys that are due.  If `force`, write all of them now.  Each storage gets 1 batch, which SQLite writes as 1 transaction."""
+    with self.lock_write:
+      cur_time = time.time()
+
+      # Take the ready items out of the dirty dict, so new changes to them start a new window while we write
+      with self.lock_dirty:
+        ready_locations = [location for (location, entry) in self.dirty.items() if force or entry['due'] <= cur_time]
+        ready = [self.dirty.pop(location) for location in ready_locations]
+
+        ready_queue_locations = [location for (location, entry) in self.queue_appends.items() if force or entry['due'] <= cur_time]
+        ready_queues = [self.queue_appends.pop(location) for location in ready_queue_locations]
+
+      # Group by storage, so each gets 1 batch
+      batches = {}
+      for entry in ready:
+        batches.setdefault(id(entry['storage']), (entry['storage'], []))[1].append(entry)
+
+      for (storage, entries) in batches.values():
+        try:
+          self._WriteItems(storage, [(entry['kind'], entry['key'], entry['value']) for entry in entries])
+        except cache_storage.WriteError as e:
+          # Only some failed, the rest are written
+          failed = set(e.failed)
+          LOG.error(f'Cache Flusher: Failed to write, will retry: {len(failed)} items  Storage: {type(storage).__name__}  Error: {e}')
+          self._Retry([entry for entry in entries if (entry['kind'], entry['key']) in failed])
+        except Exception as e:
+          LOG.error(f'Cache Flusher: Failed to write, will retry: {len(entries)} items  Storage: {type(storage).__name__}  Error: {e}')
+          self._Retry(entries)
+
+      for entry in ready_queues:
+        try:
+          entry['storage'].AppendQueue(entry['key'], entry['records'], entry['max_records'], rewrite=entry['rewrite'])
+        except Exception as e:
+          LOG.error(f'''Cache Flusher: Failed to write queue, will retry: {entry['key']}  Error: {e}''')
+          self._RetryQueue(entry)
+
+
+  def _Retry(self, entries):
+    """Put failed dirty keys back, due after their backoff.  A newer value marked since we took them wins"""
+    with self.lock_dirty:
+      for entry in entries:
+        location = entry['storage'].GetLocation(entry['kind'], entry['key'])
+        entry['failures'] += 1
+        entry['due'] = time.time() + GetRetryDelay(entry['failures'])
+
+        if location in self.dirty:
+          self.dirty[location]['failures'] = entry['failures']
+        else:
+          self.dirty[location] = entry
+
+
+  def _RetryQueue(self, entry):
+    """Put a failed queue write back, due after its backoff.  Its records go before any appended since we took it"""
+    location = entry['storage'].GetLocation(cache_storage.KIND_QUEUE, entry['key'])
+    entry['failures'] += 1
+    entry['due'] = time.time() + GetRetryDelay(entry['failures'])
+
+    with self.lock_dirty:
+      newer = self.queue_appends.get(location, None)
+
+      # A newer rewrite replaces the whole queue, so our records arent needed anymore
+      if newer is not None and newer['rewrite'] is not None:
+        return
+
+      if newer is not None:
+        entry['records'] += newer['records']
+        entry['max_records'] = newer['max_records']
+
+      self.queue_appends[location] = entry
+
+
+  def _WriteItems(self, storage, items):
+    """Write these items, list of tuples (kind, key, value), skipping any whose content is the same as what we last wrote.  Raises if any
+    failed, and only the ones written get their content hash.  Must hold `lock_write`."""
+    changed = []
+    for (kind, key, value) in items:
+      data_json = codec.Dumps(value, default=ring_buffer.JsonDefault)
+      content_hash = hashlib.blake2b(data_json, digest_size=16).digest()
+
+      # Skip if nothing changed
+      location = storage.GetLocation(kind, key)
+      if self.hashes.get(location, None) == content_hash:
+        continue
+
+      changed.append((kind, key, data_json, location, content_hash))
+
+    if not changed:
+      return
+
+    try:
+      storage.Write([(kind, key, data_json) for (kind, key, data_json, _, _) in changed])
+    except cache_storage.WriteError as e:
+      failed = set(e.failed)
+      for (kind, key, _, location, content_hash) in changed:
+        if (kind, key) not in failed:
+          self.hashes[location] = content_hash
+      raise
+
+    for (_, _, _, location, content_hash) in changed:
+      self.hashes[location] = content_hash
+
+
+def SnapshotValue(value):
+  """Returns `value` with any RingBuffer in it, or in its top level dict, replaced by its snapshot list, so later appends dont change what we write"""
+  # Quantile sketches are left live, so they are serialized once per flush instead of on every append.  They only ever count more values
+  if type(value) == ring_buffer.RingBuffer:
+    return value.Snapshot()
+
+  if type(value) == dict and any(type(item) == ring_buffer.RingBuffer for item in value.values()):
+    return {key: item.Snapshot() if type(item) == ring_buffer.RingBuffer else item for (key, item) in value.items()}
+
+  return value
+
+
+def GetRetryDelay(failures):
+  """Returns seconds to wait before retrying a write that has failed this many times in a row"""
+  return min(RETRY_DELAY * 2 ** (failures - 1), RETRY_DELAY_MAX)
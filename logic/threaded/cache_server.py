@@ -0,0 +1,292 @@
+"""
+Cache Server: Runs in the leader process when we have `--workers`, and keeps every worker's Cache Replica in sync with our Cache Manager.
+
+The Cache Manager publishes every change to us while it holds the Bundle lock, so changes are queued in the order they were made.  We send
+them to all the workers from our own thread, so a slow worker never slows down a cache write.  Workers send us their writes and cold key
+reads as requests, which can touch storage, so they are answered on a thread pool instead of our select() thread that every worker waits
+on.  The reply is queued after the changes the request made.
+
+See cache_replica for the messages.
+"""
+
+
+import collections
+import concurrent.futures
+import os
+import select
+import socket
+import threading
+
+from logic.log import LOG
+
+from logic import thread_base
+from logic import cache_replica
+from logic import thread_manager
+
+
+# Seconds to wait for socket activity, before we check for shutdown
+SELECT_TIMEOUT = 0.5
+
+# Threads answering worker requests.  Writes and cold reads can load or write storage, so they are kept off our select() thread
+REQUEST_THREADS = 8
+
+# Types of our config values we send to workers, so they are configured the same as we are.  Everything else is per process
+CONFIG_TYPES = (str, int, float, bool, list, dict, type(None))
+
+
+class CacheServer(thread_base.ThreadBase):
+  """Will loop in it's own thread, serving the worker processes"""
+
+  def __init__(self, *args, **kwargs):
+    thread_base.ThreadBase.__init__(self, *args, **kwargs)
+
+    # Set up here instead of Init(), because the Cache Manager can publish before our thread is running
+    self.path = self._data['path']
+
+    # Messages waiting to be sent, in order, tuple: (target_sock, message).  A `target_sock` of None goes to all workers
+    self.outbound = collections.deque()
+    self.lock_outbound = threading.Lock()
+
+    # Bundles whose whole silo needs to be sent again, after they are loaded or reloaded.  Added to from other threads, so under its lock
+    self.pending_syncs = set()
+    self.lock_pending_syncs = threading.Lock()
+
+    # Connected workers:  {sock: cache_replica.FrameReader}.  Only changed by our thread
+    self.clients = {}
+
+    # Answers worker requests, so storage I/O for one worker doesnt stall the stream to all of them
+    self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=REQUEST_THREADS, thread_name_prefix='Cache Server Request')
+
+    # Lets other threads wake us from select() when they queue messages
+    (self.wake_read, self.wake_write) = socket.socketpair()
+    self.wake_read.setblocking(False)
+    self.wake_write.setblocking(False)
+
+    # Listen now, so workers can connect as soon as they start
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+    self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.listener.bind(self.path)
+    self.listener.listen()
+
+
+  def Init(self):
+    """Give ourselves a single task which will never be removed and doesnt matter.  We just run forever like this."""
+    self.AddTask({})
+
+    LOG.debug(f'{self.name} Started: {self.path}')
+
+
+  def ExecuteTask(self, task):
+    """Accept workers, answer their requests, and send everything queued"""
+    try:
+      (readable, _, _) = select.select([self.listener, self.wake_read] + list(self.clients), [], [], SELECT_TIMEOUT)
+    except (OSError, ValueError):
+      # Our sockets were closed by Shutdown()
+      if self._shutdown: return
+      raise
+
+    for sock in readable:
+      if sock is self.listener:
+        self._AcceptClient()
+
+      elif sock is self.wake_read:
+        try:
+          while self.wake_read.recv(4096): pass
+        except BlockingIOError:
+          pass
+
+      else:
+        self._ReadClient(sock)
+
+    # Send whole silos for anything that was loaded or reloaded
+    with self.lock_pending_syncs:
+      pending_syncs = self.pending_syncs
+      self.pending_syncs = set()
+
+    for bundle_name in pending_syncs:
+      self._QueueBundles(None)
+      self._QueueLoad(None, bundle_name)
+
+    self._SendOutbound()
+
+
+  def Shutdown(self):
+    """Tell this thread to shut down, and close our socket so workers exit"""
+    thread_base.ThreadBase.Shutdown(self)
+
+    self.executor.shutdown(wait=False, cancel_futures=True)
+
+    for sock in list(self.clients):
+      sock.close()
+    self.clients = {}
+
+    self.listener.close()
+    if os.path.exists(self.path):
+      os.remove(self.path)
+
+
+  def _Queue(self, target_sock, message):
+    """Queue a message for `target_sock`, or all workers if None, and wake our thread"""
+    with self.lock_outbound:
+      self.outbound.append((target_sock, message))
+
+    try:
+      self.wake_write.send(b'\0')
+    except BlockingIOError:
+      pass
+
+
+  def PublishSet(self, bundle_name, items):
+    """Publish these changed keys, dict of {key: value}.  Called with the Bundle lock held"""
+    if items:
+      self._Queue(None, {'op': cache_replica.OP_SET, 'bundle': bundle_name, 'items': items})
+
+
+  def PublishAppend(self, bundle_name, cache_key, value, max_size, max_bytes):
+    """Publish an item appended to a queue.  Called with the Bundle lock held"""
+    self._Queue(None, {'op': cache_replica.OP_APPEND, 'bundle': bundle_name, 'key': cache_key, 'value': value, 'max': max_size, 'max_bytes': max_bytes})
+
+
+  def PublishEvict(self, bundle_name, keys):
+    """Publish keys moved to the cold tier.  Called with the Bundle lock held"""
+    if keys:
+      self._Queue(None, {'op': cache_replica.OP_EVICT, 'bundle': bundle_name, 'keys': keys})
+
+
+  def PublishDelete(self, bundle_name, keys):
+    """Publish keys that were removed.  Called with the Bundle lock held"""
+    if keys:
+      self._Queue(None, {'op': cache_replica.OP_DELETE, 'bundle': bundle_name, 'keys': keys})
+
+
+  def SyncBundle(self, bundle_name):
+    """Send this Bundle's whole silo to the workers again.  Used after a Bundle is loaded, which changes keys without Set()"""
+    with self.lock_pending_syncs:
+      self.pending_syncs.add(bundle_name)
+
+    try:
+      self.wake_write.send(b'\0')
+    except BlockingIOError:
+      pass
+
+
+  def _QueueConfig(self, target_sock):
+    """Queue our settings: the command line, and what opsland.Main() set up from it.  Bundle specs are sent by _QueueBundles()"""
+    settings = {key: value for (key, value) in vars(self._config).items() if key != 'data' and type(value) in CONFIG_TYPES}
+
+    self._Queue(target_sock, {'op': cache_replica.OP_CONFIG, 'data': settings})
+
+
+  def _QueueBundles(self, target_sock):
+    """Queue all the Bundle specs"""
+    self._Queue(target_sock, {'op': cache_replica.OP_BUNDLES, 'data': dict(self._config.data)})
+
+
+  def _QueueLoad(self, target_sock, bundle_name):
+    """Queue a whole Bundle silo.  Taken under the Bundle lock, so it is queued in order with the changes published around it"""
+    cache = self._config.cache
+    if bundle_name not in cache.lock_bundles_each: return
+
+    with cache.lock_bundles_each[bundle_name]:
+      items = cache.GetAll(bundle_name)
+      is_cold = bool(cache.cold_keys.get(bundle_name, None)) or bundle_name in cache.cold_queries
+
+      self._Queue(target_sock, {'op': cache_replica.OP_LOAD, 'bundle': bundle_name, 'items': items, 'cold': is_cold})
+
+
+  def _AcceptClient(self):
+    """Accept a new worker, and queue the initial cache for it: our settings, the Bundle specs, and every Bundle whose cache is loaded"""
+    (sock, _) = self.listener.accept()
+    self.clients[sock] = cache_replica.FrameReader()
+
+    self._QueueConfig(sock)
+    self._QueueBundles(sock)
+
+    # Bundles are only in `snapshot_times` once their initial cache load is done.  The rest are sent when they finish, from SyncBundle()
+    for bundle_name in list(self._config.cache.snapshot_times):
+      self._QueueLoad(sock, bundle_name)
+
+    self._Queue(sock, {'op': cache_replica.OP_READY})
+
+    LOG.info(f'Cache Server: Worker connected: Workers: {len(self.clients)}')
+
+
+  def _ReadClient(self, sock):
+    """Read requests from a worker, and hand them to our request threads"""
+    try:
+      data = sock.recv(cache_replica.READ_SIZE)
+    except OSError:
+      data = b''
+
+    if not data:
+      self._DropClient(sock)
+      return
+
+    for request in self.clients[sock].Feed(data):
+      # Read counts only update the stats, so they dont need a request thread
+      if request['op'] == cache_replica.OP_READS:
+        self._config.cache.stats.SetReplicaReads(request['pid'], request['reads'])
+        continue
+
+      # Commands that finished in the worker, which only queue recomputes
+      if request['op'] == cache_replica.OP_CHANGED:
+        if thread_manager.DEPENDENCY_MANAGER:
+          thread_manager.DEPENDENCY_MANAGER.ChangedHash(request['bundle'], request['key'], bytes.fromhex(request['hash']))
+        continue
+
+      self.executor.submit(self._AnswerRequest, sock, request)
+
+
+  def _AnswerRequest(self, sock, request):
+    """Answer 1 request from a worker.  Runs on our request threads, and the reply is sent by our thread"""
+    reply = {'op': cache_replica.OP_REPLY, 'id': request.get('id', None), 'value': None, 'error': None}
+
+    try:
+      # The worker already counted this read
+      if request['op'] == cache_replica.OP_GET:
+        reply['value'] = self._config.cache.Get(request['bundle'], request['key'], count_read=False)
+
+      elif request['op'] == cache_replica.OP_WRITE:
+        self._config.cache.Set(request['bundle'], request['key'], request['value'], set_all_data=request['set_all_data'], save=request['save'])
+
+      elif request['op'] == cache_replica.OP_STATS:
+        self._config.cache.stats.SetReplicaReads(request['pid'], request['reads'])
+        reply['value'] = self._config.cache.GetStats(request['bundle'])
+
+      else:
+        reply['error'] = f'''Unknown request: {request['op']}'''
+
+    except Exception as e:
+      reply['error'] = f'''Cache Server: {request['op']} failed: Bundle: {request.get('bundle', None)}  Key: {request.get('key', None)}  Error: {e}'''
+
+    # Queued after everything the request published, so the worker has its changes when it gets the reply
+    self._Queue(sock, reply)
+
+
+  def _DropClient(self, sock):
+    """Forget a worker that went away"""
+    self.clients.pop(sock, None)
+    sock.close()
+
+    LOG.info(f'Cache Server: Worker disconnected: Workers: {len(self.clients)}')
+
+
+  def _SendOutbound(self):
+    """Send everything queued.  Each message is encoded once, however many workers get it"""
+    with self.lock_outbound:
+      messages = list(self.outbound)
+      self.outbound.clear()
+
+    for (target_sock, message) in messages:
+      frame = cache_replica.EncodeFrame(message)
+
+      for sock in ([target_sock] if target_sock is not None else list(self.clients)):
+        if sock not in self.clients: continue
+
+        try:
+          sock.sendall(frame)
+        except OSError as e:
+          LOG.error(f'Cache Server: Failed to send to a worker, dropping it: {e}')
+          self._DropClient(sock)
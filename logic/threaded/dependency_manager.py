@@ -0,0 +1,144 @@
+"""
+Dependency Manager: Recompute derived cache keys when the commands they take as `input` change, so they stay fresh without periodic reruns.
+
+Every command that finishes tells us its payload.  If it has `recompute: true` commands downstream in its Bundle's Dependency Graph, and its
+content hash changed, we rerun those commands in our own thread, upstream first.  A rerun whose content comes out the same stops there, so
+commands that only depend on it arent rerun.  Reruns have no request data, their input only comes from the cache.
+
+We only run in the leader process.  Commands that finish in worker processes send us their content hash through the Cache Server.
+"""
+
+
+import queue
+import threading
+import traceback
+
+from logic.log import LOG
+
+from logic import thread_base
+from logic import dependency_graph
+from logic import execute_command
+from logic import thread_manager
+
+
+# Seconds to wait for a change, before we check for shutdown
+CHANGE_TIMEOUT = 0.5
+
+
+class DependencyManager(thread_base.ThreadBase):
+  """Will loop in it's own thread, recomputing the commands downstream of changed cache keys"""
+
+  def __init__(self, *args, **kwargs):
+    thread_base.ThreadBase.__init__(self, *args, **kwargs)
+
+    # Set up here instead of Init(), because commands can finish before our thread is running
+    # Changed keys to recompute from, tuples: (bundle_name, cache_key, content_hash)
+    self.changes = queue.Queue()
+
+    # Last content hash of each key with downstream commands:  {(bundle_name, cache_key): content_hash}
+    self.hashes = {}
+    self.lock_hashes = threading.Lock()
+
+
+  def Init(self):
+    """Save our _data to vars"""
+    # Content hash we last recomputed downstream from, per key, so a change we already handled isnt handled again.  Only our thread uses this
+    self.propagated = {}
+
+    # Give ourselves a single task which will never be removed and doesnt matter.  We just run forever like this.
+    self.AddTask({})
+
+    LOG.debug(f'{self.name} Started')
+
+
+  def ExecuteTask(self, task):
+    """Wait for changed keys, then recompute what is downstream of them, per Bundle"""
+    try:
+      changes = [self.changes.get(timeout=CHANGE_TIMEOUT)]
+    except queue.Empty:
+      return
+
+    # Take everything that changed meanwhile too, so commands downstream of several of them run once
+    while not self.changes.empty():
+      changes.append(self.changes.get_nowait())
+
+    changed_keys = {}
+    for (bundle_name, cache_key, content_hash) in changes:
+      if self.propagated.get((bundle_name, cache_key), None) == content_hash: continue
+
+      self.propagated[(bundle_name, cache_key)] = content_hash
+      changed_keys.setdefault(bundle_name, set()).add(cache_key)
+
+    for (bundle_name, cache_keys) in changed_keys.items():
+      self.Recompute(bundle_name, cache_keys)
+
+
+  def Changed(self, bundle_name, cache_key, payload):
+    """A command finished with this payload.  Returns boolean, True if its content changed, and its downstream commands will be recomputed"""
+    if not self.HasDownstream(bundle_name, cache_key):
+      return False
+
+    return self.ChangedHash(bundle_name, cache_key, dependency_graph.GetContentHash(payload))
+
+
+  def ChangedHash(self, bundle_name, cache_key, content_hash):
+    """Same as Changed(), with the payload's content hash, for commands that finished in a worker process.  Returns boolean"""
+    if not self.HasDownstream(bundle_name, cache_key):
+      return False
+
+    with self.lock_hashes:
+      previous_hash = self.hashes.get((bundle_name, cache_key), None)
+      self.hashes[(bundle_name, cache_key)] = content_hash
+
+    if content_hash == previous_hash:
+      return False
+
+    self.changes.put((bundle_name, cache_key, content_hash))
+
+    return True
+
+
+  def HasDownstream(self, bundle_name, cache_key):
+    """Returns boolean, True if this key has recomputed commands downstream of it"""
+    graph = thread_manager.BUNDLE_MANAGER.GetDependencyGraph(bundle_name)
+
+    return graph is not None and graph.HasDownstream(cache_key)
+
+
+  def GetHash(self, bundle_name, cache_key):
+    """Returns the last content hash of this key, or None if we havent seen it"""
+    with self.lock_hashes:
+      return self.hashes.get((bundle_name, cache_key), None)
+
+
+  def Recompute(self, bundle_name, cache_keys):
+    """Rerun the recomputed commands downstream of these changed keys, upstream first.  Commands whose inputs all came out unchanged are skipped"""
+    graph = thread_manager.BUNDLE_MANAGER.GetDependencyGraph(bundle_name)
+    bundle = thread_manager.BUNDLE_MANAGER.GetBundles().get(bundle_name, None)
+    if graph is None or bundle is None: return
+
+    changed = set(cache_keys)
+
+    for cache_key in graph.GetDownstream(cache_keys):
+      if self._shutdown: return
+
+      # Everything between it and the change came out the same
+      if not graph.inputs[cache_key] & changed: continue
+
+      LOG.info(f'{self.name}: Recompute: {bundle_name}: {cache_key}  Changed Inputs: {sorted(graph.inputs[cache_key] & changed)}')
+
+      previous_hash = self.GetHash(bundle_name, cache_key)
+
+      try:
+        execute_command.ExecuteCommand(self._config, graph.commands[cache_key], bundle_name, bundle, cache_key)
+
+      # Log and keep going, like ThreadBase.  Its downstream commands arent rerun, as it didnt change
+      except Exception as e:
+        LOG.error(f'{self.name}: Recompute failed: {bundle_name}: {cache_key}  Error: {e}\n{traceback.format_exc()}')
+        continue
+
+      # Our run already queued its change, but we handle it here, in order
+      content_hash = self.GetHash(bundle_name, cache_key)
+      if content_hash != previous_hash:
+        changed.add(cache_key)
+        self.propagated[(bundle_name, cache_key)] = content_hash
@@ -1,8 +1,18 @@
 """
-Job Manager: Watch our Job specifications for changes and hot reload them
+Job Manager: Execute the Jobs the Job Scheduler queues, in parallel on a pool of job threads.
+
+Jobs are commands, so a job thread spends its time waiting on a subprocess.  We run up to `max_jobs` at once across all Bundles, and each Bundle
+up to its own `schedule.concurrency`, so a slow or hung Bundle only ever holds its own slots, and the other Bundles keep running.
+
+A job that is already queued or running isnt queued again, so a job that runs longer than its period doesnt pile up behind itself.
 """
 
 
+import collections
+import queue
+import threading
+import traceback
+
 from logic.log import LOG
 
 from logic import thread_base
@@ -10,31 +20,134 @@ from logic import execute_command
 from logic import thread_manager
 
 
+# Jobs running at once, across all Bundles.  Set with `--jobs`
+DEFAULT_MAX_JOBS = 4
+
+# Jobs running at once per Bundle, unless the Bundle sets `schedule.concurrency`
+DEFAULT_BUNDLE_CONCURRENCY = 1
+
+# Seconds to wait for a job to be added or finish, before we check for shutdown
+DISPATCH_TIMEOUT = 0.5
+
+
 class JobManager(thread_base.ThreadBase):
-  """Will loop in it's own thread, checking out the Job files for changes"""
+  """Will loop in it's own thread, handing queued jobs to the job threads as their Bundle has free slots"""
+
+  def __init__(self, *args, **kwargs):
+    thread_base.ThreadBase.__init__(self, *args, **kwargs)
+
+    # Set up here instead of Init(), because the Job Scheduler can add jobs before our thread is running
+    self.max_jobs = self._data.get('max_jobs', DEFAULT_MAX_JOBS)
+
+    # Jobs waiting for a slot, in the order they were added.  Each is a task dict:  {'bundle', 'key', 'data'}
+    self.pending = collections.deque()
+
+    # Jobs running now, per Bundle:  {bundle_name: set of job keys}
+    self.running = {}
+
+    # Protects `pending` and `running`, which the job threads change when their job finishes
+    self.lock_jobs = threading.Lock()
+
+    # Set when a job is added or finishes, so we dispatch right away
+    self.wake = threading.Event()
+
+    # Jobs ready to run now, the job threads take from here.  Only dispatched jobs go in, so a job thread never waits on a Bundle slot
+    self.ready = queue.Queue()
+
 
   def Init(self):
-    """Save our _data to vars"""
+    """Start our job threads"""
+    # Daemon threads, so a hung command cant block us from exiting
+    for count in range(self.max_jobs):
+      threading.Thread(target=self._JobLoop, name=f'{self.name} Job {count}', daemon=True).start()
+
     # Give ourselves a single task which will never be removed and doesnt matter.  We just run forever like this.
     self.AddTask({})
 
-    LOG.debug(f'{self.name} Started')
+    LOG.debug(f'{self.name} Started: Max Jobs: {self.max_jobs}')
 
 
   def ExecuteTask(self, task):
-    """Proess the task data dict"""
-    # LOG.info(f'{self.name}: Executing Task: {task}')
+    """Wait for jobs to be added or finish, then dispatch every pending job whose Bundle has a free slot"""
+    self.wake.wait(DISPATCH_TIMEOUT)
+    self.wake.clear()
 
-    # Skip initial empty task
-    if 'data' not in task:
-      LOG.error(f'Cant execute this task, skipping: {task}')
-      return
-    
+    bundles = thread_manager.BUNDLE_MANAGER.GetBundles()
+
+    with self.lock_jobs:
+      for job in list(self.pending):
+        # Bundle was removed since this job was queued
+        if job['bundle'] not in bundles:
+          LOG.error(f'''Job Bundle is no longer loaded, skipping: {job['bundle']}  Key: {job['key']}''')
+          self.pending.remove(job)
+          continue
+
+        running = self.running.setdefault(job['bundle'], set())
+        if len(running) >= GetBundleConcurrency(bundles[job['bundle']]): continue
+
+        self.pending.remove(job)
+        running.add(job['key'])
+        self.ready.put(job)
+
+
+  def Shutdown(self):
+    """Tell this thread to shut down, and drop the jobs that havent started"""
+    thread_base.ThreadBase.Shutdown(self)
+
+    with self.lock_jobs:
+      self.pending.clear()
+
+
+  def AddJob(self, job):
+    """Queue a job, dict:  {'bundle', 'key', 'data'}.  Returns False if this job is already queued or running, so it wasnt added"""
+    with self.lock_jobs:
+      if job['key'] in self.running.get(job['bundle'], ()) or any(item['bundle'] == job['bundle'] and item['key'] == job['key'] for item in self.pending):
+        return False
+
+      self.pending.append(job)
+
+    self.wake.set()
+
+    return True
+
+
+  def ListJobs(self):
+    """Returns tuple (pending, running):  list of job dicts, and dict of {bundle_name: list of job keys}"""
+    with self.lock_jobs:
+      return (list(self.pending), {bundle_name: sorted(keys) for (bundle_name, keys) in self.running.items() if keys})
+
+
+  def _JobLoop(self):
+    """Job thread:  Run ready jobs forever"""
+    while True:
+      job = self.ready.get()
+
+      try:
+        self._RunJob(job)
+
+      # Log and keep going, like ThreadBase
+      except Exception as e:
+        LOG.error(f'''{self.name}: Job failed: Bundle: {job['bundle']}  Key: {job['key']}  Error: {e}\n{traceback.format_exc()}''')
+
+      finally:
+        with self.lock_jobs:
+          self.running[job['bundle']].discard(job['key'])
+
+        self.wake.set()
+
+
+  def _RunJob(self, job):
+    """Execute this job's command"""
     # Get the bundle
-    bundle = thread_manager.BUNDLE_MANAGER.GetBundles()[task['bundle']]
+    bundle = thread_manager.BUNDLE_MANAGER.GetBundles().get(job['bundle'], None)
+    if bundle is None:
+      LOG.error(f'''Job Bundle is no longer loaded, skipping: {job['bundle']}  Key: {job['key']}''')
+      return
 
     # Execute this command.  We wrap it here so we can call this from mutliple paths and all are handled the same
-    execute_command.ExecuteCommand(self._config, task['data'], task['bundle'], bundle, task['key'])
-
+    execute_command.ExecuteCommand(self._config, job['data'], job['bundle'], bundle, job['key'])
 
 
+def GetBundleConcurrency(bundle):
+  """Returns how many jobs this Bundle can run at once, from `schedule.concurrency`"""
+  return max(int(bundle.get('schedule', {}).get('concurrency', DEFAULT_BUNDLE_CONCURRENCY)), 1)
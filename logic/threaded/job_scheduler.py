@@ -1,8 +1,18 @@
 """
 Job Scheduler: Watch our Job specifications for changes and hot reload them
+
+Scheduled jobs are kept in a heap by the time they are next due, so we sleep exactly until the next job is due, instead of polling.  Each
+Bundle's periods are parsed once per Bundle version, and the Bundle Manager wakes us when a Bundle is reloaded, so changes apply right away.
+
+A job can set its first run with `phase` (an offset from when we start), otherwise its Bundle's `schedule.start_jitter` spreads first runs
+randomly, so jobs with the same period dont all fire together.  When a job is late by a period or more (suspended host, or it was still
+running), its `catch_up` policy decides what happens, see CATCH_UP_POLICIES.
 """
 
 
+import heapq
+import random
+import threading
 import time
 
 from logic.log import LOG
@@ -13,13 +23,57 @@ from logic import utility
 from logic import thread_manager
 
 
+# Longest we sleep without a job due.  We are woken for Bundle reloads and shutdown, so this is only a safety net
+MAX_SLEEP_DURATION = 60
+
+# Random delay for each job's first run, up to its period, unless the Bundle sets `schedule.start_jitter`.  Default: run at start
+DEFAULT_START_JITTER = 0
+
+# What a late job does, with `catch_up`.  `once` runs now and then a period from now.  `align` runs now, and stays on its original phase.
+#   `skip` drops the missed runs, and waits for its next run on its original phase.  Default: once
+CATCH_UP_POLICIES = ['once', 'align', 'skip']
+DEFAULT_CATCH_UP = 'once'
+
+
+class ScheduledJob():
+  """1 periodic job from a Bundle's `schedule.period`, with its parsed period and when it is next due"""
+
+  def __init__(self, bundle_path, period_key, data, period, catch_up, due):
+    self.bundle_path = bundle_path
+    self.key = f'schedule.period.{period_key}'
+    self.data = data
+
+    # Seconds between runs, parsed once per Bundle version
+    self.period = period
+    self.catch_up = catch_up
+
+    # When we next run this.  Heap entries with a different due time are stale, and skipped
+    self.due = due
+    self.last_run = None
+
+
 class JobScheduler(thread_base.ThreadBase):
-  """Will loop in it's own thread, checking out the Job files for changes"""
+  """Will loop in it's own thread, sleeping until the next Job is due, and queueing it on the Job Manager"""
+
+  def __init__(self, *args, **kwargs):
+    thread_base.ThreadBase.__init__(self, *args, **kwargs)
+
+    # Set up here instead of Init(), because the Bundle Manager can wake us before our thread is running
+    # Set when a Bundle is reloaded, or we are shutting down
+    self.wake = threading.Event()
+
 
   def Init(self):
     """Save our _data to vars"""
-    # Memory of what we have done, so we can schedule jobs properly
-    self.history = {}
+    # Scheduled jobs:  {(bundle_path, key): ScheduledJob}
+    self.jobs = {}
+
+    # Heap of list: (due, sequence, (bundle_path, key)).  The sequence keeps ties in the order they were pushed
+    self.heap = []
+    self.sequence = 0
+
+    # Bundle versions we parsed the schedules of:  {bundle_path: version}
+    self.versions = {}
 
     # Give ourselves a single task which will never be removed and doesnt matter.  We just run forever like this.
     self.AddTask({})
@@ -28,28 +82,124 @@ class JobScheduler(thread_base.ThreadBase):
 
 
   def ExecuteTask(self, task):
-    """Proess the task data dict"""
-    # LOG.debug(f'{self.name}: Updated')
+    """Queue every job that is due, then sleep until the next one is due, or we are woken"""
+    self.wake.clear()
+
+    self.UpdateSchedules()
+
+    now = time.time()
+    while self.heap and self.heap[0][0] <= now:
+      (due, _, job_key) = heapq.heappop(self.heap)
+
+      job = self.jobs.get(job_key, None)
+      # Stale entry, from a job that was removed or rescheduled
+      if job is None or job.due != due: continue
+
+      self.RunJob(job, now)
+
+    sleep_duration = self.heap[0][0] - time.time() if self.heap else MAX_SLEEP_DURATION
+    self.wake.wait(min(max(sleep_duration, 0), MAX_SLEEP_DURATION))
+
 
+  def Wake(self):
+    """Wake us now, ex: a Bundle was reloaded, so its schedule is parsed again right away"""
+    self.wake.set()
+
+
+  def Shutdown(self):
+    """Tell this thread to shut down, and wake it, so it doesnt wait for the next job"""
+    thread_base.ThreadBase.Shutdown(self)
+    self.wake.set()
+
+
+  def UpdateSchedules(self):
+    """Parse the schedules of Bundles that are new or have a new version, and drop the jobs of Bundles that are gone"""
     bundles = thread_manager.BUNDLE_MANAGER.GetBundles()
-    for bundle_path, bundle in bundles.items():
-      # Skip bundles without schedules
-      if 'schedule' not in bundle: continue
-
-      # Schedule Periodic tasks
-      for period_key, period_data in bundle['schedule'].get('period', {}).items():
-        period = utility.ConvertStringDurationToSeconds(period_data['period'])
-        key = f'schedule.period.{period_key}'
-
-        # If we havent run this task before, or it's been over the period time since last run, schedule it to be run
-        if key not in self.history or self.history[key] + period < time.time():
-          task = {
-            'bundle': bundle_path,
-            'key': key,
-            'data': period_data,
-          }
-          thread_manager.JOB_MANAGER.AddTask(task)
-
-          # Save that we schedule it, so we wait until the period to do it again
-          self.history[key] = time.time()
 
+    for bundle_path in list(self.versions):
+      if bundle_path not in bundles:
+        self._SetBundleJobs(bundle_path, {})
+        del self.versions[bundle_path]
+
+    for bundle_path, bundle in bundles.items():
+      key_table = thread_manager.BUNDLE_MANAGER.GetKeyTable(bundle_path)
+      version = key_table.version if key_table else None
+
+      if bundle_path in self.versions and self.versions[bundle_path] == version: continue
+
+      self._SetBundleJobs(bundle_path, bundle.get('schedule', {}))
+      self.versions[bundle_path] = version
+
+
+  def _SetBundleJobs(self, bundle_path, schedule):
+    """Replace this Bundle's jobs with the ones in `schedule`.  Jobs we already have keep when they last ran, so a reload doesnt run them again"""
+    now = time.time()
+    start_jitter = utility.ConvertStringDurationToSeconds(schedule.get('start_jitter', DEFAULT_START_JITTER))
+
+    period_jobs = schedule.get('period', None) or {}
+
+    # Drop jobs that were removed from the Bundle.  Their heap entries are skipped as stale
+    keys = set(f'schedule.period.{period_key}' for period_key in period_jobs)
+    for job_key in [job_key for job_key in self.jobs if job_key[0] == bundle_path and job_key[1] not in keys]:
+      del self.jobs[job_key]
+
+    for period_key, period_data in period_jobs.items():
+      period = utility.ConvertStringDurationToSeconds(period_data['period'])
+      catch_up = period_data.get('catch_up', DEFAULT_CATCH_UP)
+
+      if period <= 0:
+        LOG.error(f'Job Scheduler: Period must be more than 0, skipping: {bundle_path}: {period_key}: {period_data["period"]}')
+        continue
+      if catch_up not in CATCH_UP_POLICIES:
+        LOG.error(f'Job Scheduler: Unknown catch_up, using {DEFAULT_CATCH_UP}: {bundle_path}: {period_key}: {catch_up}  Policies: {CATCH_UP_POLICIES}')
+        catch_up = DEFAULT_CATCH_UP
+
+      job = ScheduledJob(bundle_path, period_key, period_data, period, catch_up, None)
+      existing = self.jobs.get((bundle_path, job.key), None)
+
+      # Already scheduled:  Keep its next run, unless the period changed, then it is a new period after the last run
+      if existing is not None:
+        job.last_run = existing.last_run
+        if existing.period != period and existing.last_run is not None:
+          job.due = existing.last_run + period
+        else:
+          job.due = existing.due
+      # New job:  Its first run is at its `phase`, or spread randomly over the start jitter
+      elif 'phase' in period_data:
+        job.due = now + utility.ConvertStringDurationToSeconds(period_data['phase'])
+      else:
+        job.due = now + random.uniform(0, min(start_jitter, period))
+
+      self.jobs[(bundle_path, job.key)] = job
+      self._Push(job)
+
+
+  def _Push(self, job):
+    """Add this job to the heap at its due time"""
+    self.sequence += 1
+    heapq.heappush(self.heap, (job.due, self.sequence, (job.bundle_path, job.key)))
+
+
+  def RunJob(self, job, now):
+    """Queue this due job on the Job Manager, unless its catch up policy skips it, and schedule its next run"""
+    missed = now - job.due >= job.period
+
+    if missed and job.catch_up == 'skip':
+      LOG.info(f'Job Scheduler: Skipping missed runs: {job.bundle_path}: {job.key}  Late: {now - job.due:.1f}s')
+    else:
+      task = {
+        'bundle': job.bundle_path,
+        'key': job.key,
+        'data': job.data,
+      }
+      # If it's still queued or running from last time, it isnt added again
+      thread_manager.JOB_MANAGER.AddJob(task)
+      job.last_run = now
+
+    # `once` runs a period from now.  `align` and `skip` stay on their phase:  The first time on it that is after now
+    if job.catch_up == 'once':
+      job.due = now + job.period
+    else:
+      job.due += job.period * (int((now - job.due) // job.period) + 1)
+
+    self._Push(job)
@@ -2,9 +2,9 @@
 Utility helper functions
 """
 
+import asyncio
 import shlex
 import subprocess
-import json
 import uuid
 import datetime as dt
 import os
@@ -20,6 +20,7 @@ import string
 from logic.log import LOG
 
 from logic import local_cache
+from logic import codec
 
 # from logic import thread_manager
 
@@ -28,19 +29,52 @@ class MissingCachePath(Exception):
   """We are missing the class path"""
 
 
-def ExecuteCommand(execute_script, input='', debug=False, set_cwd=None):
-  """Run a command and return tuple: status (int), output (string), error (string).  `set_cwd` will set the CWD if not None"""
+def ExecuteCommand(execute_script, input='', debug=False, set_cwd=None, text=True, timeout=None):
+  """Run a command and return tuple: status (int), output (string), error (string).  `set_cwd` will set the CWD if not None.  If not `text`, output and error are bytes.
+  
+  If `input` is given it is written to the command's stdin (str, or bytes if not `text`).  If `timeout` seconds pass first, the command is killed,
+  and status is negative (the signal).
+  """
   if debug: LOG.debug(f'Execute Command: {execute_script}')
 
+  if not text and type(input) == str:
+    input = input.encode()
+
   # Execute the script
   args = shlex.split(execute_script)
-  pipe = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, cwd=set_cwd)
-  output, error = pipe.communicate(input)
+  pipe = subprocess.Popen(args, stdin=subprocess.PIPE if input else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=text, cwd=set_cwd)
+  try:
+    output, error = pipe.communicate(input or None, timeout=timeout)
+  except subprocess.TimeoutExpired:
+    LOG.error(f'Execute Command: Timed out after {timeout}s, killing: {execute_script}')
+    pipe.kill()
+    output, error = pipe.communicate()
   status = pipe.returncode
 
   return (status, output, error)
 
 
+async def ExecuteCommandAsync(execute_script, input=None, set_cwd=None, timeout=None):
+  """Run a command without blocking the event loop, and return tuple: status (int), output (bytes), error (bytes).  Same as ExecuteCommand(), for request handlers"""
+  args = shlex.split(execute_script)
+  process = await asyncio.create_subprocess_exec(*args, stdin=asyncio.subprocess.PIPE if input is not None else None, 
+                                                 stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=set_cwd)
+  try:
+    output, error = await asyncio.wait_for(process.communicate(input.encode() if type(input) == str else input), timeout)
+  except asyncio.TimeoutError:
+    LOG.error(f'Execute Command: Timed out after {timeout}s, killing: {execute_script}')
+    process.kill()
+    output, error = await process.communicate()
+  except asyncio.CancelledError:
+    # Our request went away, so dont leave the command running without anyone reading it
+    if process.returncode is None:
+      process.kill()
+    await process.wait()
+    raise
+
+  return (process.returncode, output, error)
+
+
 def GetPathModifiedTime(path):
   """Gets the mtime for a path, or None if the file doesnt exist"""
   if os.path.isfile(path):
@@ -83,8 +117,7 @@ def SaveJson(path_raw, data, create_dirs=True):
   if create_dirs:
     EnsureDirectoryExists(path)
 
-  with open(path, 'w') as stream:
-    json.dump(data, stream)
+  codec.Save(path, data)
 
 
 def EnsureDirectoryExists(path):
@@ -100,19 +133,17 @@ def LoadJson(path):
   """Load JSON data from path"""
   path = os.path.expanduser(path)
   
-  with open(path, 'r') as stream:
-    data = json.load(stream)
-    return data
+  return codec.Load(path)
 
 
 def LoadJsonFromString(text):
   """Load JSON data from string"""
   try:
-    data = json.loads(text)
+    data = codec.Loads(text)
   
     return data
   
-  except json.decoder.JSONDecodeError as e:
+  except codec.DecodeError as e:
     LOG.error(f'Failed to load JSON: {e}  Input: \n\n{text}')
     raise e
 
@@ -144,8 +175,8 @@ def GetUUID():
 
 def IsDataEqual(a, b):
   """Uses JSON to ensure any data type that is serializable can be compared"""
-  a_json = json.dumps(a)
-  b_json = json.dumps(b)
+  a_json = codec.Dumps(a)
+  b_json = codec.Dumps(b)
 
   # Return if they are equal
   return a_json == b_json
@@ -193,6 +224,32 @@ def ConvertStringDurationToSeconds(text):
     raise Exception(f'Unknown time duration format: {text}')
 
 
+def ConvertStringSizeToBytes(text):
+  """Returns int in bytes, using 512B, 64KB, 10MB, 2GB style sizes.  Handles bytes, kilobytes, megabytes and gigabytes, in powers of 1024"""
+  # If we somehow got a raw number, just return it as-is
+  try:
+    return int(text)
+  except ValueError as e:
+    pass
+
+  text = text.strip().upper()
+
+  # Allow the short form too, ex: 10M
+  if not text.endswith('B'):
+    text += 'B'
+
+  if text[-2:] == 'KB':
+    return int(float(text[:-2]) * 1024)
+  elif text[-2:] == 'MB':
+    return int(float(text[:-2]) * 1024 * 1024)
+  elif text[-2:] == 'GB':
+    return int(float(text[:-2]) * 1024 * 1024 * 1024)
+  elif text[:-1].strip().replace('.', '', 1).isdigit():
+    return int(float(text[:-1]))
+  else:
+    raise Exception(f'Unknown size format: {text}')
+
+
 def IsPastDuration(initial_time, duration, cur_time):
   """From an initial time.time(), uses duration in seconds and returns bool if cur_time is past duration"""
   test_time = initial_time + duration
@@ -4,6 +4,7 @@ Webserver using FastAPI
 This module starts and stops the webserver, and so it also invokes ShutdownThreads().
 """
 
+import asyncio
 import pprint
 
 # FastAPI
@@ -39,6 +40,10 @@ from logic import webserver_render
 
 from logic import utility
 from logic import jinja_extension
+from logic import cache_replica
+from logic import cache_stats
+from logic import codec
+from logic import execute_command
 
 
 # Globals to connect to other OpsLand components
@@ -69,6 +74,10 @@ TEMPLATES.env.globals['content_search_single'] = jinja_extension.content_search_
 # Add custom functions and filters to our Jinja
 utility_jinja.AddJinjaUtilities(TEMPLATES)
 
+# Rows per page of the cache accounting JSON, by default and at most.  The summary page shows the first page
+CACHE_STATS_PAGE_SIZE = 100
+CACHE_STATS_PAGE_SIZE_MAX = 1000
+
 # Create the FastAPI server here, so we can add routes using decorators
 APP = FastAPI()
 APP.mount("/static", StaticFiles(directory="web/static"), name="static")
@@ -76,20 +85,20 @@ APP.mount("/uploads", StaticFiles(directory="../uploads/"), name="uploads")
 APP.mount("/content", StaticFiles(directory="../content/"), name="content")
 APP.mount("/derived", StaticFiles(directory="../derived/"), name="derived")
 
-# Number of Async thread works for FastAPI
-NUM_WORKERS = 4
-
-
 def Start(thread_manager, config):
   """Webserver: Called from the opsland.Main(), this brings up the Uvicorn server as the primary process thread and blocks"""
   global THREAD_MANAGER, CONFIG, SERVER
   THREAD_MANAGER = thread_manager
   CONFIG = config
 
-  # Start the server
-  config = uvicorn.Config("logic.webserver:APP", host="0.0.0.0", port=CONFIG.port, log_level="info", workers=NUM_WORKERS)
-  SERVER = uvicorn.Server(config)
-  SERVER.run()
+  # Start the server.  With more than 1 worker, Uvicorn forks worker processes which serve, and they connect back to our Cache Server from StartWorker()
+  if CONFIG.workers > 1:
+    os.environ[cache_replica.SOCKET_ENV] = THREAD_MANAGER.CACHE_SERVER.path
+    uvicorn.run("logic.webserver:APP", host="0.0.0.0", port=CONFIG.port, log_level="info", workers=CONFIG.workers)
+  else:
+    config = uvicorn.Config("logic.webserver:APP", host="0.0.0.0", port=CONFIG.port, log_level="info")
+    SERVER = uvicorn.Server(config)
+    SERVER.run()
 
   # Once we get here, the server has shutdown gracefully
   pass
@@ -98,6 +107,14 @@ def Start(thread_manager, config):
   THREAD_MANAGER.ShutdownThreads(CONFIG)
 
 
+@APP.on_event("startup")
+def StartWorker():
+  """Webserver: In a worker process, we werent started from opsland.Main(), so get our config and cache from the leader process"""
+  global CONFIG
+  if CONFIG is None and os.environ.get(cache_replica.SOCKET_ENV, None):
+    CONFIG = cache_replica.StartWorker(os.environ[cache_replica.SOCKET_ENV])
+
+
 def Shutdown():
   """Webserver: Shut it all down cleanly.  Ignore if this is not in development mode"""
   # Shutdown threads.  This reaches back into the OpsLand system to shut things down, then we terminate
@@ -191,9 +208,13 @@ def GetBundlePathData(method, path, domain=None, domain_path=None):
 async def Web_GET(request: Request):
   """Returns all the data for the Bundles"""
 
-  data = {'bundles': CONFIG.cache.bundles}
+  def Render():
+    data = {'bundles': {bundle_name: CONFIG.cache.GetAll(bundle_name) for bundle_name in list(CONFIG.cache.bundles.keys())}}
 
-  return TEMPLATES.TemplateResponse(name='pages/opsland_data.html.j2', context=data, request=request)
+    return TEMPLATES.TemplateResponse(name='pages/opsland_data.html.j2', context=data, request=request)
+
+  # Copying and rendering every Bundle is slow, so dont block the event loop
+  return await asyncio.to_thread(Render)
 
 
 # OpsLand Cache Data printed out for manual inspection
@@ -206,6 +227,42 @@ async def Web_GET(request: Request):
   return TEMPLATES.TemplateResponse(name='pages/opsland_pages.html.j2', context=data, request=request)
 
 
+# OpsLand Cache accounting, per Bundle and key prefix, as paginated JSON
+@APP.get("/opsland/cache.json")
+async def Web_GET(request: Request, bundle: str = None, prefix: str = None, offset: int = 0, limit: int = CACHE_STATS_PAGE_SIZE):
+  """Returns the cache accounting rows, largest first.  Filter with `bundle`, and `prefix` which matches the start of the key prefix"""
+  rows = await asyncio.to_thread(CONFIG.cache.GetStats, bundle)
+  if prefix:
+    rows = [row for row in rows if row['prefix'].startswith(prefix)]
+
+  offset = max(0, offset)
+  limit = max(1, min(limit, CACHE_STATS_PAGE_SIZE_MAX))
+
+  payload = {'total': len(rows), 'offset': offset, 'limit': limit, 'rows': rows[offset:offset + limit]}
+
+  return Response(status_code=200, content=codec.Dumps(payload), media_type='application/json')
+
+
+# OpsLand memoized command results, with hit and miss counts per command, as JSON.  Each worker process has its own
+@APP.get("/opsland/memoize.json")
+async def Web_GET(request: Request):
+  """Returns the memoize totals and counts per command, most hits first"""
+  payload = execute_command.MEMO.GetStats()
+
+  return Response(status_code=200, content=codec.Dumps(payload), media_type='application/json')
+
+
+# OpsLand Cache accounting summary, per Bundle with their largest key prefixes
+@APP.get("/opsland/cache", response_class=HTMLResponse)
+async def Web_GET(request: Request):
+  """Returns the cache accounting summary page"""
+  rows = await asyncio.to_thread(CONFIG.cache.GetStats)
+
+  data = {'totals': cache_stats.GetTotals(rows), 'rows': rows[:CACHE_STATS_PAGE_SIZE], 'total_rows': len(rows)}
+
+  return await asyncio.to_thread(TEMPLATES.TemplateResponse, name='pages/opsland_cache.html.j2', context=data, request=request)
+
+
 # UPLOAD: Multiple Files
 @APP.post("/upload_multi")
 def Upload_CreateUploadFileMulti(files: List[UploadFile] = File(...)):
@@ -301,7 +358,7 @@ async def Web_GET(request: Request, full_path: str):
 
   LOG.info(f'GET: {full_path}  Args: {data}  Is Dynamic: {is_dynamic}')#  Headers: {headers}')
 
-  return webserver_render.RenderPathData(request, CONFIG, full_path, bundle_name, bundle, path_data, domain, domain_path, is_dynamic, request_headers=headers, request_data=data)
+  return await webserver_render.RenderPathData(request, CONFIG, full_path, bundle_name, bundle, path_data, domain, domain_path, is_dynamic, request_headers=headers, request_data=data)
 
 
 # POST
@@ -318,7 +375,7 @@ async def Web_POST(request: Request, full_path: str):
 
   LOG.info(f'POST: {full_path}  Is Dynamic: {is_dynamic}')#  Data: {request_data}')#  Headers: {request_headers}')
 
-  return webserver_render.RenderPathData(request, CONFIG, full_path, bundle_name, bundle, path_data, domain, domain_path, is_dynamic, request_data=request_data, request_headers=request_headers)
+  return await webserver_render.RenderPathData(request, CONFIG, full_path, bundle_name, bundle, path_data, domain, domain_path, is_dynamic, request_data=request_data, request_headers=request_headers)
 
 
 # PUT
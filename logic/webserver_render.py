@@ -1,9 +1,12 @@
 """
 Render the Webserver Requests: Keep rendering and serving logic separated for readability
+
+RenderPathData() runs on the event loop, so it never does blocking work itself:  cache reads and template rendering run in a thread, and
+`execute` commands run as asyncio subprocesses.  A slow command only delays its own request.
 """
 
 
-import json
+import asyncio
 import pprint
 
 from fastapi import Response
@@ -14,6 +17,7 @@ from logic.log import LOG
 
 from logic import utility
 from logic import local_cache
+from logic import codec
 from logic import webserver
 from logic import generic_widget
 from logic import execute_command
@@ -165,8 +169,8 @@ def ProcessPayloadData(config, bundle_name, bundle, path_data, payload_in, reque
   return payload
 
 
-def ExecuteStoredCommand(config, bundle_name, bundle, execute_name_to_cache_key, update_data):
-  """Execute a command from the Bundle Spec"""
+async def ExecuteStoredCommand(config, bundle_name, bundle, execute_name_to_cache_key, update_data):
+  """Execute a command from the Bundle Spec, without blocking the event loop"""
   parts = execute_name_to_cache_key.split('.')
 
   execute_data = config.data[bundle_name]['execute'][parts[1]][parts[2]]
@@ -174,7 +178,7 @@ def ExecuteStoredCommand(config, bundle_name, bundle, execute_name_to_cache_key,
   LOG.info(f'Exec Stored Command: {execute_name_to_cache_key}   Data: {execute_data}')
 
   # Execute the command
-  result = execute_command.ExecuteCommand(config, execute_data, bundle_name, bundle, execute_name_to_cache_key, update_data=update_data)
+  result = await execute_command.ExecuteCommandAsync(config, execute_data, bundle_name, bundle, execute_name_to_cache_key, update_data=update_data)
 
   # LOG.info(f'Exec Stored Command: {execute_name}   Result: {result}')
 
@@ -259,8 +263,23 @@ def UnenhanceUriWithDomain(enchanced_uri):
   return (domain, domain_path)
 
 
-def RenderPathData(request, config, uri, bundle_name, bundle, path_data, domain, domain_path, is_domain_path_dynamic, request_headers=None, request_data=None):
-  """Render the Path Data"""
+async def RenderPathData(request, config, uri, bundle_name, bundle, path_data, domain, domain_path, is_domain_path_dynamic, request_headers=None, request_data=None):
+  """Render the Path Data.  Blocking work is done in threads, so we never block the event loop"""
+  # Session and cache data
+  (payload, request_data) = await asyncio.to_thread(GetPathPayload, request, config, uri, bundle_name, bundle, path_data, domain, domain_path, is_domain_path_dynamic, request_headers, request_data)
+
+  # Check if we want to execute a command directly (API)
+  if 'execute' in path_data:
+    exec_result = await ExecuteStoredCommand(config, bundle_name, bundle, path_data['execute'], payload)
+    if exec_result:
+      payload[path_data['execute']] = exec_result
+      # LOG.info(f'''Execute Stored Command: {path_data['execute']}  Result: {exec_result}''')
+
+  return await asyncio.to_thread(RenderPayload, request, config, bundle_name, bundle, path_data, payload, domain, domain_path, request_headers, request_data)
+
+
+def GetPathPayload(request, config, uri, bundle_name, bundle, path_data, domain, domain_path, is_domain_path_dynamic, request_headers, request_data):
+  """Returns tuple (payload, request_data):  The starting payload for the Path Data, with the auth session and cache data"""
   # Our starting payload
   payload = {'request': {}, 'header': {}, 'session': {}}
 
@@ -319,15 +338,11 @@ def RenderPathData(request, config, uri, bundle_name, bundle, path_data, domain,
       if payload[payload_key] == None:
         LOG.error(f'Couldnt find cache key: Bundle: {bundle_name}  Key: {cache_key}')
 
+  return (payload, request_data)
 
-  # Check if we want to execute a command directly (API)
-  if 'execute' in path_data:
-    exec_result = ExecuteStoredCommand(config, bundle_name, bundle, path_data['execute'], payload)
-    if exec_result:
-      payload[path_data['execute']] = exec_result
-      # LOG.info(f'''Execute Stored Command: {path_data['execute']}  Result: {exec_result}''')
-  
-  
+
+def RenderPayload(request, config, bundle_name, bundle, path_data, payload, domain, domain_path, request_headers, request_data):
+  """Returns the Response for the Path Data:  the rendered template, or the payload as JSON"""
   LOG.debug(f'''Payload: {pprint.pformat(payload, indent=2)}''')
 
   # If we have a template, then run it through Jinja
@@ -347,6 +362,6 @@ def RenderPathData(request, config, uri, bundle_name, bundle, path_data, domain,
 
   # Else, just return the output  
   else:
-    return Response(status_code=200, content=json.dumps(payload))
+    return Response(status_code=200, content=codec.Dumps(payload), media_type='application/json')
   
 
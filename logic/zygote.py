@@ -0,0 +1,274 @@
+"""
+Zygote: Runs `mode: zygote` commands by forking them from a pre-warmed Python process, instead of starting a new interpreter every time.
+
+The zygote (zygote_server) is started once per (python, cwd, preload), imports the `preload` modules, and forks a child per run.  Each child
+gets its own stdin, stdout and stderr pipes, cwd and argv, the same as subprocess.Popen() gives it, so a run is still its own process, and the
+command doesnt know the difference.  It just skips interpreter startup and the preloaded imports.
+
+Commands must be Python scripts:  `script.py args` or `python3 script.py args`.  If the zygote dies it is started again on the next run.
+A script run directly only uses a zygote when its `#!` line resolves to the interpreter we are running on, because that is what the zygote
+runs it under.  Scripts for another interpreter, or with interpreter options in their `#!` line, are executed normally.
+"""
+
+
+import os
+import select
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from logic.log import LOG
+
+from logic import codec
+from logic import utility
+
+
+# The zygote process script
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'zygote_server.py')
+
+# Bytes to read from a child's pipes at a time
+READ_SIZE = 64 * 1024
+
+# Seconds to wait for a child's exit status after its stdout and stderr close
+STATUS_TIMEOUT = 5
+
+# Status when the child died without reporting one, ex: it was killed
+STATUS_UNKNOWN = -1
+
+# Most bytes of a script we read looking for its `#!` line
+SHEBANG_SIZE = 256
+
+
+# Interpreters of the scripts we have run, so we only read them again when they change:  {script_path: (mtime, interpreter)}
+SHEBANGS = {}
+
+
+# All the zygotes:  {(python, cwd, preload): Zygote}
+ZYGOTES = {}
+LOCK_ZYGOTES = threading.Lock()
+
+
+class Zygote():
+  """1 pre-warmed zygote process, forking children for commands.  Runs from many threads at once are fine"""
+
+  def __init__(self, python, cwd, preload):
+    self.python = python
+    self.cwd = cwd
+    self.preload = list(preload)
+
+    self.process = None
+    self.control = None
+
+    # Only 1 thread sends a request or restarts the zygote at a time
+    self.lock = threading.Lock()
+
+
+  def _Start(self):
+    """Start the zygote process.  Called with our lock held"""
+    (self.control, child_control) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    args = [self.python, SERVER_PATH, str(child_control.fileno())] + self.preload
+    self.process = subprocess.Popen(args, pass_fds=[child_control.fileno()], stdin=subprocess.DEVNULL, cwd=self.cwd)
+    child_control.close()
+
+    LOG.info(f'Zygote: Started: PID: {self.process.pid}  Python: {self.python}  CWD: {self.cwd}  Preload: {self.preload}')
+
+
+  def _Send(self, request, fds):
+    """Send a request to the zygote, starting it if it isnt running"""
+    with self.lock:
+      if self.process is None or self.process.poll() is not None:
+        if self.process is not None:
+          LOG.error(f'Zygote: Exited, restarting: Status: {self.process.returncode}  CWD: {self.cwd}  Preload: {self.preload}')
+          self.control.close()
+        self._Start()
+
+      socket.send_fds(self.control, [codec.Dumps(request)], fds)
+
+
+  def Execute(self, argv, cwd, input=None, timeout=None):
+    """Run `argv` in a forked child.  Returns tuple: status (int), output (bytes), error (bytes), the same as utility.ExecuteCommand()"""
+    (stdin_read, stdin_write) = os.pipe()
+    (stdout_read, stdout_write) = os.pipe()
+    (stderr_read, stderr_write) = os.pipe()
+    (status_sock, child_status) = socket.socketpair()
+
+    # Our ends, as files, so they are closed exactly once
+    stdin = os.fdopen(stdin_write, 'wb', buffering=0)
+    stdout = os.fdopen(stdout_read, 'rb', buffering=0)
+    stderr = os.fdopen(stderr_read, 'rb', buffering=0)
+
+    try:
+      try:
+        self._Send({'argv': argv, 'cwd': cwd}, [stdin_read, stdout_write, stderr_write, child_status.fileno()])
+      finally:
+        # The child has its own copies now.  Closing ours is how we see EOF when it exits
+        for fd in [stdin_read, stdout_write, stderr_write]:
+          os.close(fd)
+        child_status.close()
+
+      return self._Communicate(argv, stdin, stdout, stderr, status_sock, input, timeout)
+
+    finally:
+      for item in [stdin, stdout, stderr, status_sock]:
+        item.close()
+
+
+  def _Communicate(self, argv, stdin, stdout, stderr, status_sock, input, timeout):
+    """Write the child's input, and read its output and status until it exits, like Popen.communicate().  Kills it if `timeout` passes"""
+    timeout_time = time.time() + timeout if timeout else None
+
+    pending_input = memoryview(input or b'')
+    if not pending_input:
+      stdin.close()
+
+    outputs = {stdout: bytearray(), stderr: bytearray(), status_sock: bytearray()}
+    readers = set(outputs)
+
+    while readers or pending_input:
+      # Once the pipes close, the status only has a moment to arrive, the child is exiting
+      remaining = timeout_time - time.time() if timeout_time else None
+      if readers == {status_sock}:
+        remaining = min(remaining, STATUS_TIMEOUT) if remaining is not None else STATUS_TIMEOUT
+
+      if remaining is not None and remaining <= 0:
+        pid = ParseStatus(outputs[status_sock], 'pid')
+        LOG.error(f'Zygote: Timed out after {timeout}s, killing: PID: {pid}  Command: {argv}')
+        if pid:
+          try:
+            os.kill(pid, signal.SIGKILL)
+          except ProcessLookupError:
+            pass
+        return (-signal.SIGKILL, bytes(outputs[stdout]), bytes(outputs[stderr]))
+
+      (readable, writable, _) = select.select(list(readers), [stdin] if pending_input else [], [], remaining)
+
+      if writable:
+        try:
+          written = stdin.write(pending_input[:select.PIPE_BUF])
+          pending_input = pending_input[written:]
+        except BrokenPipeError:
+          pending_input = memoryview(b'')
+
+        if not pending_input:
+          stdin.close()
+
+      for item in readable:
+        data = os.read(item.fileno(), READ_SIZE)
+        if data:
+          outputs[item] += data
+        else:
+          readers.discard(item)
+
+    status = ParseStatus(outputs[status_sock], 'status')
+
+    return (status if status is not None else STATUS_UNKNOWN, bytes(outputs[stdout]), bytes(outputs[stderr]))
+
+
+  def Shutdown(self):
+    """Stop the zygote.  Closing the control socket tells it to exit.  Children already running finish on their own"""
+    with self.lock:
+      if self.process is None: return
+
+      self.control.close()
+      try:
+        self.process.wait(STATUS_TIMEOUT)
+      except subprocess.TimeoutExpired:
+        self.process.kill()
+
+      LOG.info(f'Zygote: Stopped: PID: {self.process.pid}  CWD: {self.cwd}')
+      self.process = None
+
+
+def ParseStatus(status_data, field):
+  """Returns the last value of `field` from a child's status lines, or None if it didnt send it.  Fields:  `pid` when it starts, `status` when it exits"""
+  value = None
+  for line in bytes(status_data).splitlines():
+    value = codec.Loads(line).get(field, value)
+
+  return value
+
+
+def GetScriptArgs(command, cwd):
+  """Returns tuple (python, argv) for a command line, or None if a zygote cant run it.  An explicit interpreter is kept, otherwise the
+  script's `#!` line must resolve to the one we are running on"""
+  args = shlex.split(command)
+
+  if os.path.basename(args[0]).startswith('python'):
+    if len(args) < 2 or args[1].startswith('-'):
+      raise Exception(f'Zygote commands must run a script, interpreter options arent supported: {command}')
+    return (args[0], args[1:])
+
+  # Found the same way exec finds it:  On the PATH without a slash, otherwise from the cwd
+  script_path = os.path.join(cwd, args[0]) if os.sep in args[0] else shutil.which(args[0])
+
+  if script_path is None or GetShebangInterpreter(script_path) != os.path.realpath(sys.executable):
+    return None
+
+  return (sys.executable, args)
+
+
+def GetShebangInterpreter(script_path):
+  """Returns the real path of the interpreter in this script's `#!` line, or None if it doesnt have one, or it passes interpreter options"""
+  try:
+    mtime = os.stat(script_path).st_mtime
+  except OSError:
+    return None
+
+  cached = SHEBANGS.get(script_path, None)
+  if cached is not None and cached[0] == mtime:
+    return cached[1]
+
+  try:
+    with open(script_path, 'rb') as fp:
+      line = fp.readline(SHEBANG_SIZE)
+  except OSError:
+    return None
+
+  parts = line[2:].decode(errors='replace').split() if line.startswith(b'#!') else []
+
+  # `#!/usr/bin/env python3` finds it on the PATH
+  if parts and os.path.basename(parts[0]) == 'env':
+    parts = parts[1:]
+    interpreter = shutil.which(parts[0]) if len(parts) == 1 else None
+  else:
+    interpreter = parts[0] if len(parts) == 1 else None
+
+  interpreter = os.path.realpath(interpreter) if interpreter else None
+  SHEBANGS[script_path] = (mtime, interpreter)
+
+  return interpreter
+
+
+def Execute(command, cwd, preload=None, input=None, timeout=None):
+  """Run a command line on its zygote, starting the zygote if needed.  Returns tuple: status (int), output (bytes), error (bytes).
+  Commands a zygote cant run, see GetScriptArgs(), are executed normally"""
+  script_args = GetScriptArgs(command, cwd)
+  if script_args is None:
+    LOG.debug(f'Zygote: Script isnt for our interpreter, executing it normally: {command}')
+    return utility.ExecuteCommand(command, input=input, set_cwd=cwd, text=False, timeout=timeout)
+
+  (python, argv) = script_args
+  key = (python, cwd, tuple(preload or ()))
+
+  with LOCK_ZYGOTES:
+    if key not in ZYGOTES:
+      ZYGOTES[key] = Zygote(python, cwd, preload or ())
+    zygote = ZYGOTES[key]
+
+  return zygote.Execute(argv, cwd, input=input, timeout=timeout)
+
+
+def Shutdown():
+  """Stop every zygote"""
+  with LOCK_ZYGOTES:
+    zygotes = list(ZYGOTES.values())
+    ZYGOTES.clear()
+
+  for zygote in zygotes:
+    zygote.Shutdown()
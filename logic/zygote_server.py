@@ -0,0 +1,112 @@
+"""
+Zygote Server: A pre-warmed Python process, which forks a child to run each `mode: zygote` command.  See zygote for the OpsLand side.
+
+This is run as its own process, not imported, and only uses the standard library, so the children only have what their command imports.
+
+  python3 zygote_server.py <control_fd> [preload_module ...]
+
+We import the preload modules once, then wait on the control socket.  Each request is JSON:  {'argv', 'cwd'}, with 4 file descriptors:  stdin,
+stdout, stderr and a status socket.  We fork, and the child wires them up as fd 0, 1 and 2, changes to `cwd`, and runs `argv[0]` as `__main__`
+with `sys.argv = argv`, the same as running the script.  The child writes JSON lines to the status socket:  {'pid'} when it starts, and
+{'status'} with its exit code when it finishes.
+
+When the control socket is closed, OpsLand has gone away, so we exit.
+"""
+
+
+import importlib
+import json
+import os
+import runpy
+import signal
+import socket
+import sys
+import traceback
+
+
+# Largest request we read from the control socket
+MESSAGE_SIZE = 64 * 1024
+
+# File descriptors sent with each request:  stdin, stdout, stderr, status
+REQUEST_FDS = 4
+
+
+def Serve(control_fd, preload):
+  """Import the preload modules, then fork a child for each request until the control socket closes"""
+  # Import from the command directory we were started in, like the commands do
+  sys.path[0] = os.getcwd()
+
+  for module_name in preload:
+    importlib.import_module(module_name)
+
+  control = socket.socket(fileno=control_fd)
+
+  # We never wait on our children, let the kernel reap them
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+  while True:
+    (data, fds, _, _) = socket.recv_fds(control, MESSAGE_SIZE, REQUEST_FDS)
+    if not data: break
+
+    if len(fds) != REQUEST_FDS:
+      print(f'Zygote Server: Bad request, expected {REQUEST_FDS} file descriptors, got: {len(fds)}', file=sys.stderr)
+    elif os.fork() == 0:
+      control.close()
+      RunChild(json.loads(data), fds)
+
+    for fd in fds:
+      os.close(fd)
+
+
+def RunChild(request, fds):
+  """In the forked child:  Run the command's script as `__main__`, and report our exit code.  Never returns"""
+  (stdin_fd, stdout_fd, stderr_fd, status_fd) = fds
+  status = socket.socket(fileno=status_fd)
+  code = 1
+
+  try:
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    status.sendall(json.dumps({'pid': os.getpid()}).encode() + b'\n')
+
+    for (fd, target_fd) in [(stdin_fd, 0), (stdout_fd, 1), (stderr_fd, 2)]:
+      os.dup2(fd, target_fd)
+      os.close(fd)
+
+    os.chdir(request['cwd'])
+
+    script_path = request['argv'][0]
+    sys.argv = list(request['argv'])
+    sys.path[0] = os.path.dirname(os.path.abspath(script_path))
+
+    try:
+      runpy.run_path(script_path, run_name='__main__')
+      code = 0
+
+    # Same exit codes as the interpreter gives
+    except SystemExit as e:
+      if e.code is None:
+        code = 0
+      elif type(e.code) == int:
+        code = e.code
+      else:
+        print(e.code, file=sys.stderr)
+        code = 1
+
+    except BaseException:
+      traceback.print_exc()
+      code = 1
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+  finally:
+    try:
+      status.sendall(json.dumps({'status': code}).encode() + b'\n')
+    except OSError:
+      pass
+
+    os._exit(code)
+
+
+if __name__ == '__main__':
+  Serve(int(sys.argv[1]), sys.argv[2:])
@@ -22,6 +22,7 @@ from logic import problem_manager
 from logic import test_manager
 
 from logic import utility
+from logic import codec
 
 from logic import log
 from logic.log import LOG
@@ -37,6 +38,12 @@ VERSION = '0.000001 pre-pre-beta'
 # Default listening port
 DEFAULT_PORT = 4040
 
+# Default HTTP serving processes.  1 serves from this process, more share this process's cache through the Cache Server
+DEFAULT_WORKERS = 1
+
+# Default scheduled jobs running at once, across all Bundles.  Each Bundle also has its own limit, `schedule.concurrency`
+DEFAULT_JOBS = 4
+
 
 def SignalHandler_SIGINT(sig, frame):
   """We ignore this, but FastAPI's Uvicorn HTTP server will process it to quit quickly."""
@@ -48,6 +55,8 @@ def Main(config):
     log.SetLogLevel(log.logging.DEBUG)
     LOG.debug('Log level: Debug')
 
+  LOG.debug(f'JSON codec: {codec.BACKEND}')
+
   # Capture the path, so we know the directory
   config.exec_path = __file__
   config.dir_path = os.path.dirname(__file__)
@@ -91,6 +100,9 @@ if __name__ == '__main__':
 
   parser.add_argument('-d', '--debug', default=False, action='store_true', help='Debug logging')
   parser.add_argument('-p', '--port', default=DEFAULT_PORT, type=int, help='Listening port')
+  parser.add_argument('-w', '--workers', default=DEFAULT_WORKERS, type=int, help='HTTP serving processes.  With more than 1, they share the cache of this leader process, which runs all the background work')
+
+  parser.add_argument('-j', '--jobs', default=DEFAULT_JOBS, type=int, help='Scheduled jobs running at once, across all Bundles.  Each Bundle also limits its own with `schedule.concurrency`')
 
   # Testing
   parser.add_argument('--test-list', default=None, type=str, help='List the tests available')
@@ -0,0 +1,159 @@
+"""
+Cache Flusher: Dirty keys coalesce to their latest value, unchanged content is skipped, and failed writes are retried, never dropped
+"""
+
+
+import pytest
+
+from logic import cache_storage
+from logic.threaded import cache_flusher
+
+
+class FakeStorage():
+  """Storage that keeps its writes in a list, and fails the keys in `failing` with WriteError"""
+
+  def __init__(self):
+    self.writes = []
+    self.failing = set()
+
+
+  def GetLocation(self, kind, key):
+    return f'{kind}/{key}'
+
+
+  def Write(self, items):
+    failed = [(kind, key) for (kind, key, _) in items if key in self.failing]
+    self.writes += [(key, data_json) for (kind, key, data_json) in items if key not in self.failing]
+
+    if failed:
+      raise cache_storage.WriteError('Fake Storage: Failing', failed)
+
+
+def GetFlusher():
+  """Returns a Cache Flusher that isnt started, so the test calls Flush() itself"""
+  return cache_flusher.CacheFlusher('Cache Flusher', None, {})
+
+
+def test_coalesces_to_the_latest_value():
+  flusher = GetFlusher()
+  storage = FakeStorage()
+
+  for count in range(3):
+    flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', {'count': count}, window=0)
+
+  flusher.Flush()
+
+  assert storage.writes == [('a', b'{"count":2}')]
+  assert not flusher.dirty
+
+
+def test_waits_for_the_flush_window():
+  flusher = GetFlusher()
+  storage = FakeStorage()
+
+  flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', 1, window=60)
+  flusher.Flush()
+  assert storage.writes == []
+
+  flusher.Flush(force=True)
+  assert storage.writes == [('a', b'1')]
+
+
+def test_skips_unchanged_content():
+  flusher = GetFlusher()
+  storage = FakeStorage()
+
+  for _ in range(2):
+    flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', {'same': True}, window=0)
+    flusher.Flush()
+
+  assert len(storage.writes) == 1
+
+  # Once it leaves memory, the next write isnt skipped
+  flusher.Forget(storage, cache_storage.KIND_CACHE, 'a')
+  flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', {'same': True}, window=0)
+  flusher.Flush()
+
+  assert len(storage.writes) == 2
+
+
+def test_retries_only_the_failed_writes():
+  flusher = GetFlusher()
+  storage = FakeStorage()
+  storage.failing.add('bad')
+
+  flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'good', 1, window=0)
+  flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'bad', 2, window=0)
+  flusher.Flush()
+
+  assert storage.writes == [('good', b'1')]
+  assert list(flusher.dirty) == ['cache/bad']
+  assert flusher.dirty['cache/bad']['failures'] == 1
+
+  # It backs off, so it isnt due yet
+  flusher.Flush()
+  assert storage.writes == [('good', b'1')]
+
+  # Once storage works again it is written, its failed write didnt record its content as written
+  storage.failing.clear()
+  flusher.Flush(force=True)
+
+  assert storage.writes == [('good', b'1'), ('bad', b'2')]
+  assert not flusher.dirty
+
+
+def test_retry_keeps_a_newer_value():
+  flusher = GetFlusher()
+  storage = FakeStorage()
+  storage.failing.add('a')
+
+  flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', 'old', window=0)
+
+  # Marked while the write is failing
+  original_write = storage.Write
+  def Write(items):
+    flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', 'new', window=0)
+    original_write(items)
+  storage.Write = Write
+
+  flusher.Flush()
+
+  storage.Write = original_write
+  storage.failing.clear()
+  flusher.Flush(force=True)
+
+  assert storage.writes == [('a', b'"new"')]
+
+
+def test_write_now_raises_and_keeps_the_key_dirty():
+  flusher = GetFlusher()
+  storage = FakeStorage()
+  storage.failing.add('a')
+
+  value = {'a': 1}
+  flusher.MarkDirty(storage, cache_storage.KIND_CACHE, 'a', value, window=60)
+
+  with pytest.raises(cache_storage.WriteError) as error:
+    flusher.WriteNow(storage, cache_storage.KIND_CACHE, 'a', value)
+
+  assert error.value.failed == [(cache_storage.KIND_CACHE, 'a')]
+  assert 'cache/a' in flusher.dirty
+
+  storage.failing.clear()
+  flusher.WriteNow(storage, cache_storage.KIND_CACHE, 'a', value)
+
+  assert storage.writes == [('a', b'{"a":1}')]
+  assert not flusher.dirty
+
+
+def test_file_storage_reports_failed_writes(tmp_path):
+  storage = cache_storage.FileStorage({'path': {'cache': str(tmp_path / '{key}.json'), 'summary': str(tmp_path / 'summary_{key}.json')}})
+
+  # A directory where the file should be, so writing it fails
+  (tmp_path / 'bad.json').mkdir()
+
+  with pytest.raises(cache_storage.WriteError) as error:
+    storage.Write([(cache_storage.KIND_CACHE, 'good', b'1'), (cache_storage.KIND_CACHE, 'bad', b'2')])
+
+  assert error.value.failed == [(cache_storage.KIND_CACHE, 'bad')]
+  assert storage.Get(cache_storage.KIND_CACHE, 'good') == 1
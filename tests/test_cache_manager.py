@@ -0,0 +1,32 @@
+"""
+Cache Manager: Reads tell a key stored as None apart from a missing key
+"""
+
+
+from logic import cache_manager
+
+
+def GetCache(items):
+  """Returns a Cache Manager with these items in the `test` Bundle, put in its silo directly, without a Bundle spec"""
+  cache = cache_manager.CacheManager(None)
+
+  bundle = cache._GetBundleSilo('test')
+  for (key, value) in items.items():
+    bundle[key] = value
+    cache.key_indexes['test'].Add(key)
+
+  return cache
+
+
+def test_stored_none_isnt_missing():
+  cache = GetCache({'execute.api.empty': None, 'execute.api.full': {'a': 1}})
+
+  assert cache.Get('test', 'execute.api.empty', default='missing') is None
+  assert cache.Get('test', 'execute.api.full', default='missing') == {'a': 1}
+  assert cache.Get('test', 'execute.api.other', default='missing') == 'missing'
+
+
+def test_glob_includes_stored_none():
+  cache = GetCache({'execute.api.empty': None, 'execute.api.full': {'a': 1}})
+
+  assert cache.Get('test', 'execute.api.*') == {'execute.api.empty': None, 'execute.api.full': {'a': 1}}
@@ -0,0 +1,101 @@
+"""
+Command Pool: Persistent workers answer JSON lines, are reused and retired, and are replaced when they fail
+"""
+
+
+import sys
+
+import pytest
+
+from logic import codec
+from logic import command_pool
+
+
+WORKER_SCRIPT = '''
+import json, os, sys, time
+
+for line in sys.stdin:
+  request = json.loads(line)
+  if request.get('crash'):
+    sys.exit(1)
+  if request.get('sleep'):
+    time.sleep(request['sleep'])
+  if request.get('fail'):
+    print(json.dumps({'__error': 'Failed on purpose', '__status': 3}), flush=True)
+    continue
+  print(json.dumps({'echo': request, 'pid': os.getpid()}), flush=True)
+'''
+
+
+@pytest.fixture
+def command(tmp_path):
+  """Returns the command line of a persistent worker script, and stops its pools after the test"""
+  script_path = tmp_path / 'worker.py'
+  script_path.write_text(WORKER_SCRIPT)
+
+  yield f'{sys.executable} {script_path}'
+
+  command_pool.Shutdown()
+
+
+def Execute(command, cwd, input_data, **kwargs):
+  """Returns tuple: status, reply (dict or None), error"""
+  (status, output, error) = command_pool.Execute(command, cwd, input_data, **kwargs)
+  return (status, codec.Loads(output) if output else None, error)
+
+
+def test_round_trip_reuses_the_worker(command, tmp_path):
+  (status, first, error) = Execute(command, str(tmp_path), {'a': 1})
+  assert (status, first['echo'], error) == (0, {'a': 1}, b'')
+
+  (status, second, error) = Execute(command, str(tmp_path), {'b': 2})
+  assert (status, second['echo']) == (0, {'b': 2})
+  assert second['pid'] == first['pid']
+
+
+def test_retires_after_max_requests(command, tmp_path):
+  pids = [Execute(command, str(tmp_path), {}, max_requests=2)[1]['pid'] for _ in range(3)]
+
+  assert pids[0] == pids[1]
+  assert pids[2] != pids[1]
+
+
+def test_error_reply_fails_the_run(command, tmp_path):
+  (status, reply, error) = Execute(command, str(tmp_path), {'fail': True})
+
+  assert status == 3
+  assert error == b'Failed on purpose'
+
+  # The worker is fine, and keeps serving
+  (status, _, _) = Execute(command, str(tmp_path), {})
+  assert status == 0
+
+
+def test_crashed_worker_is_replaced(command, tmp_path):
+  first_pid = Execute(command, str(tmp_path), {})[1]['pid']
+
+  (status, reply, error) = Execute(command, str(tmp_path), {'crash': True})
+  assert status == 1
+  assert reply is None
+
+  (status, reply, _) = Execute(command, str(tmp_path), {})
+  assert status == 0
+  assert reply['pid'] != first_pid
+
+
+def test_timed_out_worker_is_replaced(command, tmp_path):
+  first_pid = Execute(command, str(tmp_path), {})[1]['pid']
+
+  (status, _, error) = Execute(command, str(tmp_path), {'sleep': 5}, timeout=0.5)
+  assert status == 1
+  assert b'Timed out' in error
+
+  assert Execute(command, str(tmp_path), {})[1]['pid'] != first_pid
+
+
+def test_reply_status():
+  assert command_pool.GetReplyStatus(b'{"a": 1}') == (0, b'')
+  assert command_pool.GetReplyStatus(b'{"__error": "No such user"}') == (1, b'No such user')
+  assert command_pool.GetReplyStatus(b'{"__error": "No such user", "__status": 2}') == (2, b'No such user')
+  assert command_pool.GetReplyStatus(b'{"__status": 0}') == (0, b'')
+  assert command_pool.GetReplyStatus(b'[1, 2]') == (0, b'')
@@ -0,0 +1,77 @@
+"""
+Dependency Graph: Recomputed commands run upstream first, and commands in a cycle, or that need a request, are never recomputed
+"""
+
+
+from logic import dependency_graph
+
+
+def GetBundleInfo(api):
+  """Returns a Bundle with these `execute.api` commands"""
+  return {'execute': {'api': api}}
+
+
+def test_downstream_in_dependency_order():
+  graph = dependency_graph.DependencyGraph(GetBundleInfo({
+    'report': {'command': 'report', 'recompute': True, 'input': {'execute.api.totals': None, 'execute.api.users': None}},
+    'totals': {'command': 'totals', 'recompute': True, 'input': {'execute.api.users': None}},
+    'users': {'command': 'users'},
+    'unrelated': {'command': 'unrelated', 'recompute': True},
+  }))
+
+  assert graph.GetDownstream(['execute.api.users']) == ['execute.api.totals', 'execute.api.report']
+  assert graph.GetDownstream(['execute.api.totals']) == ['execute.api.report']
+  assert graph.GetDownstream(['execute.api.report']) == []
+
+  assert graph.HasDownstream('execute.api.users')
+  assert not graph.HasDownstream('execute.api.report')
+  assert graph.order.index('execute.api.users') < graph.order.index('execute.api.totals') < graph.order.index('execute.api.report')
+
+
+def test_only_recomputed_commands_are_downstream():
+  graph = dependency_graph.DependencyGraph(GetBundleInfo({
+    'middle': {'command': 'middle', 'input': {'execute.api.source': None}},
+    'end': {'command': 'end', 'recompute': True, 'input': {'execute.api.middle': None}},
+    'source': {'command': 'source'},
+  }))
+
+  # `middle` isnt rerun, but what reads it through it still is
+  assert graph.GetDownstream(['execute.api.source']) == ['execute.api.end']
+  assert not graph.IsRecomputed('execute.api.middle')
+
+
+def test_cycles_are_never_recomputed():
+  graph = dependency_graph.DependencyGraph(GetBundleInfo({
+    'first': {'command': 'first', 'recompute': True, 'input': {'execute.api.second': None}},
+    'second': {'command': 'second', 'recompute': True, 'input': {'execute.api.first': None}},
+    'source': {'command': 'source'},
+    'after': {'command': 'after', 'recompute': True, 'input': {'execute.api.source': None}},
+  }))
+
+  assert 'execute.api.first' not in graph.order
+  assert 'execute.api.second' not in graph.order
+  assert not graph.IsRecomputed('execute.api.first')
+  assert graph.GetDownstream(['execute.api.first']) == []
+
+  # Commands outside the cycle still are
+  assert graph.GetDownstream(['execute.api.source']) == ['execute.api.after']
+
+
+def test_commands_that_need_a_request_are_never_recomputed():
+  graph = dependency_graph.DependencyGraph(GetBundleInfo({
+    'source': {'command': 'source'},
+    'own': {'command': 'own', 'recompute': True, 'input': {'execute.api.own': None, 'execute.api.source': None}},
+    'user': {'command': 'user', 'recompute': True, 'input': {'execute.api.source': None, 'request': None}},
+    'formatted': {'command': 'formatted', 'recompute': True, 'input': {'execute.api.source': None, 'execute.api.user.{request.username}': None}},
+  }))
+
+  assert graph.unrecomputable == {'execute.api.own', 'execute.api.user', 'execute.api.formatted'}
+  assert graph.GetDownstream(['execute.api.source']) == []
+
+
+def test_content_hash_ignores_volatile_fields_and_order():
+  first = dependency_graph.GetContentHash({'a': 1, 'b': 2, '__time': 1})
+  second = dependency_graph.GetContentHash({'b': 2, 'a': 1, '__time': 2})
+
+  assert first == second
+  assert first != dependency_graph.GetContentHash({'a': 1, 'b': 3})
@@ -0,0 +1,55 @@
+"""
+Key Index: Globs see every key added or removed before they start, and only walk their literal prefix range
+"""
+
+
+from logic import key_index
+
+
+def test_globs_see_added_and_removed_keys():
+  index = key_index.KeyIndex()
+  for key in ['execute.api.user.b', 'execute.api.user.a', 'execute.api.page', 'summary.total']:
+    index.Add(key)
+
+  assert index.Match('execute.api.user.*') == ['execute.api.user.a', 'execute.api.user.b']
+
+  index.Remove('execute.api.user.a')
+  index.Add('execute.api.user.c')
+
+  assert index.Match('execute.api.user.*') == ['execute.api.user.b', 'execute.api.user.c']
+  assert index.GetPrefixRange('execute.') == ['execute.api.page', 'execute.api.user.b', 'execute.api.user.c']
+  assert len(index) == 4
+
+
+def test_remove_and_add_again_before_a_glob():
+  index = key_index.KeyIndex()
+  index.AddMany(['a.1', 'a.2'])
+  assert index.Match('a.*') == ['a.1', 'a.2']
+
+  # Removed and added back while it is still in the sorted list
+  index.Remove('a.1')
+  index.Add('a.1')
+
+  # Added and removed before it was ever merged
+  index.Add('a.3')
+  index.Remove('a.3')
+
+  assert index.Match('a.*') == ['a.1', 'a.2']
+  assert len(index) == 2
+
+
+def test_readers_keep_their_snapshot():
+  index = key_index.KeyIndex()
+  index.AddMany(['a.1', 'a.2'])
+
+  keys = index.GetPrefixRange('a.')
+  index.Add('a.0')
+
+  assert keys == ['a.1', 'a.2']
+  assert index.GetPrefixRange('a.') == ['a.0', 'a.1', 'a.2']
+
+
+def test_glob_prefix():
+  assert key_index.GetGlobPrefix('execute.api.user.*') == 'execute.api.user.'
+  assert key_index.GetGlobPrefix('execute.api.[ab]?') == 'execute.api.'
+  assert key_index.GetGlobPrefix('static.page') == 'static.page'
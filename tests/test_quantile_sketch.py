@@ -0,0 +1,54 @@
+"""
+Quantile Sketch: Quantiles match `statistics.quantiles(method='inclusive')` within the sketch's relative accuracy
+"""
+
+
+import random
+import statistics
+
+from logic import quantile_sketch
+
+
+def AssertQuantiles(values, relative_accuracy=quantile_sketch.DEFAULT_RELATIVE_ACCURACY):
+  """Every percentile of the sketch is within `relative_accuracy` of the exact one"""
+  sketch = quantile_sketch.DDSketch(relative_accuracy)
+  for value in values:
+    sketch.Add(value)
+
+  expected = statistics.quantiles(values, n=100, method='inclusive')
+
+  for (percentile, expected_value) in enumerate(expected, start=1):
+    value = sketch.Quantile(percentile / 100)
+    assert abs(value - expected_value) <= relative_accuracy * abs(expected_value) + 1e-9, (percentile, value, expected_value)
+
+
+def test_median_of_small_range():
+  sketch = quantile_sketch.DDSketch()
+  for value in range(8):
+    sketch.Add(value)
+
+  assert abs(sketch.Quantile(0.5) - 3.5) <= 3.5 * quantile_sketch.DEFAULT_RELATIVE_ACCURACY
+
+
+def test_small_range():
+  AssertQuantiles(list(range(8)))
+
+
+def test_random_values():
+  generator = random.Random(1)
+  AssertQuantiles([generator.lognormvariate(0, 2) for _ in range(5000)])
+
+
+def test_negative_and_zero_values():
+  generator = random.Random(2)
+  AssertQuantiles([generator.randint(-1000, 1000) for _ in range(2000)])
+
+
+def test_dict_round_trip():
+  sketch = quantile_sketch.DDSketch()
+  for value in range(1, 1000):
+    sketch.Add(value)
+
+  restored = quantile_sketch.FromDict(sketch.ToDict())
+
+  assert [restored.Quantile(quantile) for quantile in (0.5, 0.9, 0.99)] == [sketch.Quantile(quantile) for quantile in (0.5, 0.9, 0.99)]
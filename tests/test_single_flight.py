@@ -0,0 +1,119 @@
+"""
+Single Flight: Identical runs in flight share 1 execution, keyed on the command and its input, including the client's fields unless ignored
+"""
+
+
+import asyncio
+import threading
+
+import pytest
+
+from logic import single_flight
+from logic import execute_command
+
+
+COMMAND = {'command': 'page.py render'}
+
+
+def test_key_ignores_input_order():
+  first = execute_command.GetFlightKey('bundle', 'execute.api.page', COMMAND, {'a': 1, 'b': {'c': 2, 'd': 3}})
+  second = execute_command.GetFlightKey('bundle', 'execute.api.page', COMMAND, {'b': {'d': 3, 'c': 2}, 'a': 1})
+
+  assert first == second
+
+
+def test_key_differs_by_command_and_input():
+  key = execute_command.GetFlightKey('bundle', 'execute.api.page', COMMAND, {'a': 1})
+
+  assert key != execute_command.GetFlightKey('bundle', 'execute.api.page', COMMAND, {'a': 2})
+  assert key != execute_command.GetFlightKey('bundle', 'execute.api.page', {'command': 'page.py other'}, {'a': 1})
+  assert key != execute_command.GetFlightKey('bundle', 'execute.api.other', COMMAND, {'a': 1})
+
+
+def test_key_keeps_client_fields_by_default():
+  first = execute_command.GetFlightKey('bundle', 'execute.api.page', COMMAND, {'a': 1, 'session': {'user': 'first'}, 'header': {'cookie': '1'}})
+  second = execute_command.GetFlightKey('bundle', 'execute.api.page', COMMAND, {'a': 1, 'session': {'user': 'second'}, 'header': {'cookie': '2'}})
+
+  assert first != second
+
+
+def test_key_ignores_memo_ignore_fields():
+  command = dict(COMMAND, memo_ignore=['header', 'session'])
+
+  first = execute_command.GetFlightKey('bundle', 'execute.api.page', command, {'a': 1, 'session': {'user': 'first'}, 'header': {'cookie': '1'}})
+  second = execute_command.GetFlightKey('bundle', 'execute.api.page', command, {'a': 1, 'session': {'user': 'second'}, 'header': {'cookie': '2'}})
+
+  assert first == second
+  assert first != execute_command.GetFlightKey('bundle', 'execute.api.page', command, {'a': 2})
+
+
+def test_threads_share_one_run():
+  flight = single_flight.SingleFlight()
+  started = threading.Event()
+  release = threading.Event()
+  runs = []
+
+  def Work():
+    runs.append(1)
+    started.set()
+    release.wait(5)
+    return 'result'
+
+  results = []
+  leader = threading.Thread(target=lambda: results.append(flight.Do('key', Work)))
+  leader.start()
+  started.wait(5)
+
+  waiters = [threading.Thread(target=lambda: results.append(flight.Do('key', Work))) for _ in range(4)]
+  for waiter in waiters:
+    waiter.start()
+
+  release.set()
+  for thread in [leader] + waiters:
+    thread.join(5)
+
+  assert runs == [1]
+  assert results == ['result'] * 5
+
+  # Once it finishes, the next caller runs it again
+  assert flight.Do('key', lambda: 'again') == 'again'
+
+
+def test_waiters_get_the_leaders_error():
+  flight = single_flight.SingleFlight()
+
+  async def Fail():
+    await asyncio.sleep(0.05)
+    raise ValueError('failed')
+
+  async def Main():
+    return await asyncio.gather(flight.DoAsync('key', Fail), flight.DoAsync('key', Fail), return_exceptions=True)
+
+  results = asyncio.run(Main())
+
+  assert [type(result) for result in results] == [ValueError, ValueError]
+
+
+def test_cancelled_leader_still_answers_waiters():
+  flight = single_flight.SingleFlight()
+  runs = []
+
+  async def Work():
+    runs.append(1)
+    await asyncio.sleep(0.1)
+    return 'result'
+
+  async def Main():
+    leader = asyncio.ensure_future(flight.DoAsync('key', Work))
+    await asyncio.sleep(0.01)
+    waiter = asyncio.ensure_future(flight.DoAsync('key', Work))
+    await asyncio.sleep(0.01)
+
+    leader.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await leader
+
+    return await waiter
+
+  assert asyncio.run(Main()) == 'result'
+  assert runs == [1]
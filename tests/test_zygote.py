@@ -0,0 +1,86 @@
+"""
+Zygote: Scripts forked from a zygote get their argv, cwd, stdin and exit status, and scripts for another interpreter run normally
+"""
+
+
+import os
+import sys
+
+import pytest
+
+from logic import zygote
+
+
+SCRIPT = '''
+import os, sys
+
+data = sys.stdin.read()
+sys.stdout.write(f'argv={sys.argv[1:]} cwd={os.getcwd()} stdin={data}')
+sys.stderr.write('to stderr')
+sys.exit(3)
+'''
+
+
+def WriteScript(path, shebang, body=SCRIPT):
+  """Write an executable script with this `#!` line"""
+  path.write_text(f'#!{shebang}\n{body}')
+  os.chmod(path, 0o755)
+
+
+@pytest.fixture(autouse=True)
+def shutdown():
+  """Stop the zygotes after each test"""
+  yield
+
+  zygote.Shutdown()
+
+
+def test_round_trip(tmp_path):
+  WriteScript(tmp_path / 'script.py', sys.executable)
+
+  (status, output, error) = zygote.Execute(f'{sys.executable} script.py first second', str(tmp_path), input=b'hello')
+
+  assert status == 3
+  assert output == f'''argv=['first', 'second'] cwd={tmp_path} stdin=hello'''.encode()
+  assert error == b'to stderr'
+
+
+def test_zygote_is_reused(tmp_path):
+  WriteScript(tmp_path / 'script.py', sys.executable, body='import os\nprint(os.getppid())\n')
+
+  parents = [zygote.Execute(f'{sys.executable} script.py', str(tmp_path))[1] for _ in range(2)]
+
+  # Both were forked from the same zygote
+  assert parents[0] == parents[1]
+  assert len(zygote.ZYGOTES) == 1
+
+
+def test_timeout_kills_the_child(tmp_path):
+  WriteScript(tmp_path / 'script.py', sys.executable, body='import time\ntime.sleep(10)\n')
+
+  (status, _, _) = zygote.Execute(f'{sys.executable} script.py', str(tmp_path), timeout=0.5)
+
+  assert status < 0
+
+
+def test_script_args_follow_the_shebang(tmp_path):
+  WriteScript(tmp_path / 'ours.py', sys.executable)
+  WriteScript(tmp_path / 'shell.sh', '/bin/sh')
+  WriteScript(tmp_path / 'options.py', f'{sys.executable} -u')
+
+  assert zygote.GetScriptArgs('./ours.py a', str(tmp_path)) == (sys.executable, ['./ours.py', 'a'])
+  assert zygote.GetScriptArgs('./shell.sh', str(tmp_path)) is None
+  assert zygote.GetScriptArgs('./options.py', str(tmp_path)) is None
+  assert zygote.GetScriptArgs('python3 ours.py', str(tmp_path)) == ('python3', ['ours.py'])
+
+  with pytest.raises(Exception):
+    zygote.GetScriptArgs('python3 -u ours.py', str(tmp_path))
+
+
+def test_other_interpreters_run_normally(tmp_path):
+  WriteScript(tmp_path / 'shell.sh', '/bin/sh', body='cat\nexit 2\n')
+
+  (status, output, _) = zygote.Execute('./shell.sh', str(tmp_path), input=b'hello')
+
+  assert (status, output) == (2, b'hello')
+  assert not zygote.ZYGOTES